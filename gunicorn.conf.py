@@ -1,2 +1,24 @@
+import os
+import shutil
+
 bind = "0.0.0.0:8888"
+# Sync workers, one request per process at a time. The change feed long-polls are served by the threaded pool of
+# gunicorn.feed.conf.py instead, nginx routes them there.
 workers = 3
+# Catalog imports of a few hundred thousand products take minutes
+timeout = 300
+
+# Every worker writes its Prometheus metrics to memory mapped files in this directory, /metrics merges them.
+# It must be set before the workers import prometheus_client.
+metrics_dir = os.environ.setdefault('prometheus_multiproc_dir', '/tmp/shop_api_metrics')
+
+
+def on_starting(server):
+    # Files left over by a previous run would be merged with the new counters
+    shutil.rmtree(metrics_dir, ignore_errors=True)
+    os.makedirs(metrics_dir)
+
+
+def child_exit(server, worker):
+    from prometheus_client import multiprocess
+    multiprocess.mark_process_dead(worker.pid)
@@ -0,0 +1,26 @@
+import os
+import shutil
+
+# Pool of the change feed alone, nginx routes /shops/<id>/orders/changes/ here (see default.conf). Consumers
+# long-polling the feed hold a thread for up to 30 seconds while they wait, so these workers are threaded.
+bind = "0.0.0.0:8889"
+workers = 2
+threads = 16
+# Longer than the longest wait of a long-poll
+timeout = 60
+
+# The Prometheus samples of this pool are kept apart from those of the main pool, Prometheus scrapes the /metrics
+# of each pool on its own port
+metrics_dir = os.environ.get('API_FEED_METRICS_DIR', '/tmp/shop_api_feed_metrics')
+os.environ['prometheus_multiproc_dir'] = metrics_dir
+
+
+def on_starting(server):
+    # Files left over by a previous run would be merged with the new counters
+    shutil.rmtree(metrics_dir, ignore_errors=True)
+    os.makedirs(metrics_dir)
+
+
+def child_exit(server, worker):
+    from prometheus_client import multiprocess
+    multiprocess.mark_process_dead(worker.pid)
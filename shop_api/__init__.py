@@ -0,0 +1 @@
+default_app_config = 'shop_api.apps.ShopApiConfig'
@@ -0,0 +1,195 @@
+from collections import namedtuple
+from decimal import Decimal
+
+from django.db import IntegrityError, transaction
+from django.db.models import Case, Count, DecimalField, F, IntegerField, Q, Sum, Value, When
+from django.utils import timezone
+from shop_api.models import LineItem, ShopDailySales, ProductDailySales
+
+
+# Daily sales rollups of the shops and products.
+#
+# Sales are attributed to the day their order was placed. The rollups are shifted by the changes of every line item
+# in the transaction making the change, so reports never aggregate line items. The backfill_sales_rollups command
+# rebuilds them from the line items.
+
+
+class Sales(namedtuple('Sales', ['revenue', 'units', 'orders'])):
+
+    def __add__(self, other):
+        return Sales(self.revenue + other.revenue, self.units + other.units, self.orders + other.orders)
+
+    def __neg__(self):
+        return Sales(-self.revenue, -self.units, -self.orders)
+
+    def __bool__(self):
+        return bool(self.revenue or self.units or self.orders)
+
+
+NO_SALES = Sales(Decimal(0), 0, 0)
+
+
+def sales_day(order):
+    return timezone.localdate(order.created_at)
+
+
+def shift_columns(sales):
+    return {
+        'revenue': F('revenue') + sales.revenue,
+        'units': F('units') + sales.units,
+        'orders': F('orders') + sales.orders,
+    }
+
+
+def upsert(model, lookup, sales):
+    """
+    Adds sales to the row matching lookup, creating it if needed
+    """
+    if model.objects.filter(**lookup).update(**shift_columns(sales)):
+        return
+
+    try:
+        with transaction.atomic():
+            model.objects.create(revenue=sales.revenue, units=sales.units, orders=sales.orders, **lookup)
+    except IntegrityError:
+        # A concurrent transaction created the row first
+        model.objects.filter(**lookup).update(**shift_columns(sales))
+
+
+def shift_products(shop_id, day, products):
+    """
+    Adds sales to the rollups of several products with one UPDATE and one INSERT
+    """
+    existing = set(
+        ProductDailySales.objects.filter(day=day, product_id__in=products).values_list('product_id', flat=True)
+    )
+
+    if existing:
+        def column(name, output_field):
+            return F(name) + Case(
+                *[When(product_id=pk, then=Value(getattr(products[pk], name))) for pk in existing],
+                default=Value(0), output_field=output_field
+            )
+
+        ProductDailySales.objects.filter(day=day, product_id__in=existing).update(
+            revenue=column('revenue', DecimalField(max_digits=19, decimal_places=2)),
+            units=column('units', IntegerField()),
+            orders=column('orders', IntegerField()),
+        )
+
+    missing = [pk for pk in products if pk not in existing]
+    if not missing:
+        return
+
+    try:
+        with transaction.atomic():
+            ProductDailySales.objects.bulk_create([
+                ProductDailySales(product_id=pk, shop_id=shop_id, day=day, revenue=products[pk].revenue,
+                                  units=products[pk].units, orders=products[pk].orders)
+                for pk in missing
+            ])
+    except IntegrityError:
+        for pk in missing:
+            upsert(ProductDailySales, {'product_id': pk, 'shop_id': shop_id, 'day': day}, products[pk])
+
+
+def record_sales(order, products, orders):
+    """
+    Shifts the rollups of the day of order by the sales of each product in products ({product_id: Sales}),
+    and the order count of the shop by orders
+    """
+    products = dict((pk, sales) for pk, sales in products.items() if sales)
+    if not products and not orders:
+        return
+
+    day = sales_day(order)
+    shop_sales = sum(products.values(), NO_SALES)._replace(orders=orders)
+    upsert(ShopDailySales, {'shop_id': order.shop_id, 'day': day}, shop_sales)
+
+    if len(products) == 1:
+        pk, sales = products.popitem()
+        upsert(ProductDailySales, {'product_id': pk, 'shop_id': order.shop_id, 'day': day}, sales)
+    elif products:
+        shift_products(order.shop_id, day, products)
+
+
+def order_sales(line_items):
+    """
+    Sales of each product of a list of line items, counting each of their orders once
+    """
+    products = {}
+    seen = set()
+
+    for item in line_items:
+        first = (item.order_id, item.product_id) not in seen
+        seen.add((item.order_id, item.product_id))
+        products[item.product_id] = products.get(item.product_id, NO_SALES) + \
+            Sales(item.subtotal, item.quantity, 1 if first else 0)
+
+    return products
+
+
+def other_line_items(line_item):
+    """
+    Number of the other line items of the order of line_item, and of those selling the same product
+    """
+    counts = LineItem.objects.filter(order_id=line_item.order_id).exclude(pk=line_item.pk).aggregate(
+        order=Count('id'), product=Count('id', filter=Q(product_id=line_item.product_id))
+    )
+    return counts['order'], counts['product']
+
+
+def line_item_added(line_item):
+    in_order, in_product = other_line_items(line_item)
+    sales = Sales(line_item.subtotal, line_item.quantity, 0 if in_product else 1)
+    record_sales(line_item.order, {line_item.product_id: sales}, 0 if in_order else 1)
+
+
+def line_item_changed(line_item, previous):
+    sales = Sales(line_item.subtotal - previous.subtotal, line_item.quantity - previous.quantity, 0)
+    record_sales(line_item.order, {line_item.product_id: sales}, 0)
+
+
+def line_item_removed(line_item):
+    # Called once the line item is deleted
+    in_order, in_product = other_line_items(line_item)
+    sales = Sales(-line_item.subtotal, -line_item.quantity, 0 if in_product else -1)
+    record_sales(line_item.order, {line_item.product_id: sales}, 0 if in_order else -1)
+
+
+def order_added(order, line_items):
+    record_sales(order, order_sales(line_items), 1 if line_items else 0)
+
+
+def order_removed(order, line_items):
+    products = dict((pk, -sales) for pk, sales in order_sales(line_items).items())
+    record_sales(order, products, -1 if line_items else 0)
+
+
+def sales_report(shop_id, start, end, top=10):
+    """
+    Daily sales of a shop between start and end included, and its best selling products over the period
+    """
+    days = list(
+        ShopDailySales.objects.filter(shop_id=shop_id, day__range=(start, end))
+        .order_by('day').values('day', 'revenue', 'units', 'orders')
+    )
+
+    products = (
+        ProductDailySales.objects.filter(shop_id=shop_id, day__range=(start, end))
+        .values('product_id')
+        .annotate(name=F('product__name'), total_revenue=Sum('revenue'), total_units=Sum('units'),
+                  total_orders=Sum('orders'))
+        .order_by('-total_revenue', 'product_id')
+    )
+
+    totals = sum((Sales(day['revenue'], day['units'], day['orders']) for day in days), NO_SALES)
+
+    return {
+        'shop': shop_id,
+        'start': start,
+        'end': end,
+        'totals': totals._asdict(),
+        'days': days,
+        'top_products': products[:top],
+    }
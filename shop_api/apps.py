@@ -3,3 +3,7 @@ from django.apps import AppConfig
 
 class ShopApiConfig(AppConfig):
     name = 'shop_api'
+
+    def ready(self):
+        # Connects the signal receivers
+        from shop_api import signals  # noqa: F401
@@ -0,0 +1,220 @@
+import datetime
+import struct
+import time
+import zlib
+from decimal import Decimal
+
+from django.conf import settings
+from django.db import transaction
+from django.db.models import F
+from django.utils import timezone
+from shop_api.analytics import NO_SALES, order_sales, sales_day
+from shop_api.models import Shop, Order, LineItem, ArchivedOrder
+
+
+# Archival of the old orders.
+#
+# Orders are never deleted, the archive_orders command keeps the order and line item tables small by moving the orders
+# placed more than SHOP_API_ARCHIVE_AFTER_DAYS days ago to the archive of their shard: one ArchivedOrder row per order,
+# its line items packed in a compressed column. Archived orders keep their id, their detail is still served by the
+# order endpoint, the export streams them along with the live orders and the sales rollups still count them.
+# They can't be changed anymore.
+
+FORMAT_VERSION = 1
+
+# id, product id, quantity and price in cents of a line item
+LINE_ITEM = struct.Struct('<qqiq')
+
+
+def archive_after():
+    return datetime.timedelta(days=getattr(settings, 'SHOP_API_ARCHIVE_AFTER_DAYS', 365))
+
+
+def pack_line_items(rows):
+    """
+    Packs (id, product_id, quantity, price) rows into the bytes stored by ArchivedOrder.line_items
+    """
+    data = b''.join(
+        LINE_ITEM.pack(pk, product_id, quantity, int(price.scaleb(2))) for pk, product_id, quantity, price in rows
+    )
+    return bytes([FORMAT_VERSION]) + zlib.compress(data)
+
+
+def unpack_line_items(data):
+    """
+    Returns the (id, product_id, quantity, price) rows packed by pack_line_items()
+    """
+    data = bytes(data)
+    if data[0] != FORMAT_VERSION:
+        raise ValueError('Unknown archive format %d' % data[0])
+
+    return [
+        (pk, product_id, quantity, Decimal(cents).scaleb(-2))
+        for pk, product_id, quantity, cents in LINE_ITEM.iter_unpack(zlib.decompress(data[1:]))
+    ]
+
+
+def restore(archived):
+    """
+    Unsaved Order standing in for an archived order, with its line items, for the serializers and the analytics
+    """
+    order = Order(id=archived.id, client_id=archived.client_id, shop_id=archived.shop_id, total=archived.total,
+                  created_at=archived.created_at, updated_at=archived.updated_at)
+    order._state.adding = False
+    order._state.db = archived._state.db
+
+    line_items = [
+        LineItem(id=pk, order=order, product_id=product_id, quantity=quantity, price=price)
+        for pk, product_id, quantity, price in unpack_line_items(archived.line_items)
+    ]
+    # What prefetch_related('line_items') would have cached, so that order.line_items.all() doesn't query
+    order._prefetched_objects_cache = {'line_items': line_items}
+    return order
+
+
+def archived_order(shop, order_id):
+    """
+    Returns the archived order with id=order_id of shop as restored by restore(), None if it isn't archived
+    """
+    archived = ArchivedOrder.objects.using(shop.shard).filter(shop_id=shop.pk, pk=order_id).first()
+    return restore(archived) if archived is not None else None
+
+
+def iter_archived_orders(shop_id, since_id=0, chunk_size=500, using=None):
+    """
+    Yields (order, line_items) pairs of tuples for the archived orders of the shop read from the database `using`,
+    in id order, in the shape of shop_api.exports.iter_order_chunks()
+    """
+    last_id = since_id or 0
+
+    while True:
+        orders = list(
+            ArchivedOrder.objects.using(using).filter(shop_id=shop_id, pk__gt=last_id)
+            .order_by('pk')
+            .values_list('id', 'client_id', 'shop_id', 'total', 'line_items')[:chunk_size]
+        )
+
+        for pk, client_id, shop_id, total, packed in orders:
+            yield (pk, client_id, shop_id, total), [
+                (line_item_id, pk, product_id, quantity, price)
+                for line_item_id, product_id, quantity, price in unpack_line_items(packed)
+            ]
+
+        if len(orders) < chunk_size:
+            return
+        last_id = orders[-1][0]
+
+
+def archived_sales(using, shop_ids):
+    """
+    Sales of the archived orders of the shops read from the database `using`, as {(shop_id, day): Sales} and
+    {(product_id, shop_id, day): Sales} dicts
+    """
+    shops = {}
+    products = {}
+
+    for archived in ArchivedOrder.objects.using(using).filter(shop_id__in=shop_ids).iterator():
+        order = restore(archived)
+        line_items = order.line_items.all()
+        if not line_items:
+            continue
+
+        day = sales_day(order)
+        order_products = order_sales(line_items)
+        shop_key = (order.shop_id, day)
+        shops[shop_key] = shops.get(shop_key, NO_SALES) + sum(order_products.values(), NO_SALES)._replace(orders=1)
+
+        for product_id, sales in order_products.items():
+            product_key = (product_id, order.shop_id, day)
+            products[product_key] = products.get(product_key, NO_SALES) + sales
+
+    return shops, products
+
+
+class OrderArchiver:
+    """
+    Moves the orders of the shops of a shard placed before `before` to its archive, batch_size orders per
+    transaction. The archiver pauses `pause` seconds between two transactions so that the live writes never wait
+    long on it, and leaves the orders changed in the last `quiet` seconds and the shops being moved to another shard
+    for its next run.
+    """
+
+    def __init__(self, alias, before, batch_size=500, pause=0.1, quiet=60, log=None):
+        self.alias = alias
+        self.before = before
+        self.batch_size = batch_size
+        self.pause = pause
+        self.quiet = datetime.timedelta(seconds=quiet)
+        self.log = log or (lambda message: None)
+
+    def shops(self):
+        return Shop.objects.filter(shard=self.alias).order_by('pk').values_list('pk', flat=True)
+
+    def candidates(self, shop_id):
+        return Order.objects.using(self.alias).filter(
+            shop_id=shop_id, created_at__lt=self.before, updated_at__lt=timezone.now() - self.quiet
+        )
+
+    def run(self, shop_ids=None):
+        """
+        Archives the orders of the shops with ids shop_ids, or of every shop of the shard, returns how many were
+        archived
+        """
+        archived = 0
+        for shop_id in (shop_ids if shop_ids is not None else self.shops()):
+            count = self.archive_shop(shop_id)
+            if count:
+                self.log('Archived %d orders of shop %d' % (count, shop_id))
+            archived += count
+        return archived
+
+    def archive_shop(self, shop_id):
+        archived = 0
+        last_id = 0
+
+        while True:
+            # A move locks the shop before copying its last changes, the batch in flight finishes within its grace
+            if not Shop.objects.filter(pk=shop_id, shard=self.alias, shard_locked=False).exists():
+                return archived
+
+            batch = list(
+                self.candidates(shop_id).filter(pk__gt=last_id).order_by('pk')
+                .values_list('pk', flat=True)[:self.batch_size]
+            )
+            if not batch:
+                return archived
+
+            archived += self.archive(shop_id, batch)
+            last_id = batch[-1]
+            time.sleep(self.pause)
+
+    def archive(self, shop_id, order_ids):
+        with transaction.atomic(using=self.alias):
+            # Locks the orders before reading them: writes to the orders wait for the archival, and SQLite makes the
+            # transaction wait for the live writes rather than failing it as it would once it read.
+            # The orders changed since they were picked are skipped.
+            orders = self.candidates(shop_id).filter(pk__in=order_ids)
+            orders.update(updated_at=F('updated_at'))
+            orders = list(orders.values_list('id', 'client_id', 'total', 'created_at', 'updated_at'))
+            order_ids = [order[0] for order in orders]
+
+            line_items = {}
+            rows = (
+                LineItem.objects.using(self.alias).filter(order_id__in=order_ids)
+                .order_by('pk')
+                .values_list('order_id', 'id', 'product_id', 'quantity', 'price')
+            )
+            for row in rows:
+                line_items.setdefault(row[0], []).append(row[1:])
+
+            now = timezone.now()
+            ArchivedOrder.objects.using(self.alias).bulk_create(
+                ArchivedOrder(id=pk, client_id=client_id, shop_id=shop_id, total=total, created_at=created_at,
+                              updated_at=updated_at, archived_at=now,
+                              line_items=pack_line_items(line_items.get(pk, [])))
+                for pk, client_id, total, created_at, updated_at in orders
+            )
+            LineItem.objects.using(self.alias).filter(order_id__in=order_ids).delete()
+            Order.objects.using(self.alias).filter(pk__in=order_ids).delete()
+
+        return len(order_ids)
@@ -0,0 +1,191 @@
+import datetime
+import threading
+import time
+import uuid
+from collections import OrderedDict
+
+from django.conf import settings
+from django.contrib.auth.models import User
+from django.core import signing
+from django.utils import timezone
+from rest_framework import authentication, exceptions
+from shop_api.models import RevokedToken
+
+
+# Stateless authentication with signed tokens.
+#
+# A token holds the id of its user, an id of its own and its expiry, signed with the SECRET_KEY. Verifying it doesn't
+# read the database: users come from an in-process cache and revoked tokens from an in-process copy of the revocation
+# list, refreshed every few seconds. Requests authenticated with a token never read the session and user tables.
+
+SALT = 'shop_api.authentication'
+
+
+def token_ttl():
+    return getattr(settings, 'SHOP_API_TOKEN_TTL', 24 * 3600)
+
+
+def issue_token(user):
+    """
+    Returns a new token for user and its expiry as a UNIX timestamp
+    """
+    expires = int(time.time()) + token_ttl()
+    return signing.dumps({'user': user.pk, 'id': uuid.uuid4().hex, 'expires': expires}, salt=SALT), expires
+
+
+def read_token(token):
+    """
+    Payload of a token, None when it is malformed, forged or expired
+    """
+    try:
+        payload = signing.loads(token, salt=SALT)
+    except signing.BadSignature:
+        return None
+
+    if not isinstance(payload, dict) or payload.get('expires', 0) < time.time():
+        return None
+    return payload
+
+
+class UserCache:
+    """
+    In-process LRU of the active users by id. Entries expire after timeout seconds, which bounds how long the other
+    workers keep authenticating a user who was deactivated. Saving or deleting a user drops its entry in the worker
+    making the change.
+    """
+
+    def __init__(self, max_entries=1000, timeout=60):
+        self.max_entries = max_entries
+        self.timeout = timeout
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, user_id):
+        with self._lock:
+            entry = self._entries.get(user_id)
+            if entry is not None and entry[1] >= time.monotonic():
+                self._entries.move_to_end(user_id)
+                return entry[0]
+
+        # Deleted and inactive users are cached as None
+        user = User.objects.filter(pk=user_id, is_active=True).first()
+
+        with self._lock:
+            self._entries[user_id] = (user, time.monotonic() + self.timeout)
+            self._entries.move_to_end(user_id)
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+
+        return user
+
+    def discard(self, user_id):
+        with self._lock:
+            self._entries.pop(user_id, None)
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+
+
+class RevocationList:
+    """
+    In-process copy of the RevokedToken table. The unexpired rows are reloaded at most every `refresh` seconds, so
+    checking a token is a set lookup. The worker revoking a token sees it immediately.
+    """
+
+    def __init__(self, refresh=5):
+        self.refresh = refresh
+        self._tokens = {}
+        self._refreshed_at = None
+        self._lock = threading.Lock()
+
+    def sync(self):
+        with self._lock:
+            now = time.monotonic()
+            if self._refreshed_at is not None and now - self._refreshed_at < self.refresh:
+                return
+
+            # Every unexpired row rather than those after the last id seen: ids are allocated before the rows commit,
+            # a revocation committing after one with a higher id would be skipped for good
+            rows = RevokedToken.objects.filter(expires_at__gt=timezone.now()).values_list('token_id', 'expires_at')
+            for token_id, expires_at in rows:
+                self._tokens[token_id] = expires_at.timestamp()
+
+            # Expired tokens are rejected anyway
+            expired = time.time()
+            self._tokens = dict((token_id, expires) for token_id, expires in self._tokens.items() if expires > expired)
+            self._refreshed_at = now
+
+    def is_revoked(self, token_id):
+        self.sync()
+        return token_id in self._tokens
+
+    def revoke(self, payload):
+        expires_at = datetime.datetime.fromtimestamp(payload['expires'], timezone.utc)
+        RevokedToken.objects.filter(expires_at__lt=timezone.now()).delete()
+        RevokedToken.objects.get_or_create(token_id=payload['id'],
+                                           defaults={'user_id': payload['user'], 'expires_at': expires_at})
+
+        with self._lock:
+            self._tokens[payload['id']] = payload['expires']
+
+    def clear(self):
+        with self._lock:
+            self._tokens.clear()
+            self._refreshed_at = None
+
+
+_user_cache = None
+_revocation_list = None
+
+
+def get_user_cache():
+    global _user_cache
+
+    if _user_cache is None:
+        _user_cache = UserCache(**getattr(settings, 'SHOP_API_TOKEN_USER_CACHE', {}))
+
+    return _user_cache
+
+
+def get_revocation_list():
+    global _revocation_list
+
+    if _revocation_list is None:
+        _revocation_list = RevocationList(getattr(settings, 'SHOP_API_TOKEN_REVOCATION_REFRESH', 5))
+
+    return _revocation_list
+
+
+class SignedTokenAuthentication(authentication.BaseAuthentication):
+    """
+    Authenticates requests sending an `Authorization: Bearer <token>` header with a token issued by auth/token/.
+    request.auth is the payload of the token.
+    """
+
+    keyword = b'bearer'
+
+    def authenticate(self, request):
+        header = authentication.get_authorization_header(request).split()
+        if not header or header[0].lower() != self.keyword:
+            return None
+
+        if len(header) != 2:
+            raise exceptions.AuthenticationFailed('Invalid token header.')
+
+        try:
+            payload = read_token(header[1].decode('ascii'))
+        except UnicodeError:
+            payload = None
+
+        if payload is None:
+            raise exceptions.AuthenticationFailed('Invalid or expired token.')
+
+        if get_revocation_list().is_revoked(payload['id']):
+            raise exceptions.AuthenticationFailed('Revoked token.')
+
+        user = get_user_cache().get(payload['user'])
+        if user is None:
+            raise exceptions.AuthenticationFailed('User inactive or deleted.')
+
+        return user, payload
@@ -0,0 +1,505 @@
+import http.client
+import json
+import random
+import re
+import string
+import threading
+import time
+from collections import namedtuple, defaultdict
+from urllib.parse import urlsplit
+
+from django.conf import settings
+from django.contrib.auth import SESSION_KEY, BACKEND_SESSION_KEY, HASH_SESSION_KEY, get_user_model
+from django.contrib.sessions.backends.db import SessionStore
+from django.db import connection
+from django.db.models import Max, Min
+from django.test.client import RequestFactory
+from django.test.utils import CaptureQueriesContext
+from shop_api.authentication import issue_token
+from shop_api.models import Shop, Product, Order, LineItem
+
+
+# Load and latency benchmark of the API routes.
+#
+# Scenarios are generators yielding the Requests of one user journey (browsing the catalog, checking out...),
+# they are sent back the Result of each request so that later steps can use the ids created by earlier ones.
+# Between them they cover every route of the API but the catalog import, which takes CSV or NDJSON bodies,
+# auth/token, which takes passwords, and the Prometheus metrics.
+
+
+Request = namedtuple('Request', 'route method path data user')
+Result = namedtuple('Result', 'status data')
+Sample = namedtuple('Sample', 'route status latency queries')
+
+
+class BenchmarkData:
+    """
+    Ids sampled from the database that the scenarios pick their targets from
+    """
+
+    def __init__(self, rng, shops=200, products_per_shop=50, orders_per_shop=20):
+        self.rng = rng
+        self.shops = []
+        self.products = {}
+        self.orders = {}
+
+        bounds = Shop.objects.aggregate(low=Min('pk'), high=Max('pk'))
+        if bounds['low'] is None:
+            raise ValueError('The database has no shops, load the fixtures or run generate_shop_data first')
+
+        seen = set()
+        for _ in range(shops):
+            # Random probes rather than ORDER BY RANDOM() which scans the whole table
+            shop = Shop.objects.filter(pk__gte=rng.randint(bounds['low'], bounds['high'])).order_by('pk').first()
+            if shop is None or shop.pk in seen:
+                continue
+
+            products = list(Product.objects.filter(shop=shop).order_by('pk').values_list('pk', flat=True)[:products_per_shop])
+            if not products:
+                continue
+
+            seen.add(shop.pk)
+            self.shops.append((shop.pk, shop.owner_id))
+            self.products[shop.pk] = products
+            self.orders[shop.pk] = list(
+                Order.objects.filter(shop=shop, client__isnull=False).order_by('-pk')
+                .values_list('pk', 'client_id')[:orders_per_shop]
+            )
+
+        if not self.shops:
+            raise ValueError('None of the sampled shops have products')
+
+        self.buyer_ids = sorted(set(client for orders in self.orders.values() for _, client in orders)) or \
+            sorted(set(owner for _, owner in self.shops))
+        # The cache statistics are only served to staff, they aren't requested without a staff user
+        self.staff_ids = list(
+            get_user_model().objects.filter(is_staff=True).order_by('pk').values_list('pk', flat=True)[:1]
+        )
+
+    def shop(self):
+        return self.rng.choice(self.shops)
+
+    def product(self, shop_id):
+        return self.rng.choice(self.products[shop_id])
+
+    def order(self, shop_id):
+        orders = self.orders[shop_id]
+        return self.rng.choice(orders) if orders else None
+
+    def buyer(self):
+        return self.rng.choice(self.buyer_ids)
+
+    def name(self, prefix):
+        # Shop and product names are unique
+        return '%s %s' % (prefix, ''.join(self.rng.choice(string.ascii_lowercase) for _ in range(12)))
+
+
+def browse_catalog(data):
+    shop_id, _ = data.shop()
+    yield Request('shops-listcreate', 'GET', '/shops/?limit=20', None, None)
+    yield Request('shops-rud', 'GET', '/shops/%d/' % shop_id, None, None)
+    yield Request('products-listcreate', 'GET', '/shops/%d/products/' % shop_id, None, None)
+    yield Request('products-rud', 'GET', '/shops/%d/products/%d/' % (shop_id, data.product(shop_id)), None, None)
+    yield Request('products-search', 'GET', '/products/search/?q=%s' % data.rng.choice(string.ascii_lowercase),
+                  None, None)
+
+
+def checkout(data):
+    shop_id, _ = data.shop()
+    buyer = data.buyer()
+    orders_url = '/shops/%d/orders/' % shop_id
+
+    result = yield Request('orders-listcreate', 'POST', orders_url, {}, buyer)
+    if result.status != 201:
+        return
+
+    order_id = result.data['id']
+    line_items_url = '%s%d/lineitems/' % (orders_url, order_id)
+    line_item_id = None
+    for _ in range(data.rng.randint(1, 5)):
+        result = yield Request('lineitems-listcreate', 'POST', line_items_url,
+                               {'product': data.product(shop_id), 'quantity': data.rng.randint(1, 3)}, buyer)
+        if result.status == 201:
+            line_item_id = result.data['id']
+
+    if line_item_id is not None:
+        yield Request('lineitems-rud', 'PATCH', '%s%d/' % (line_items_url, line_item_id), {'quantity': 4}, buyer)
+        yield Request('lineitems-rud', 'DELETE', '%s%d/' % (line_items_url, line_item_id), None, buyer)
+
+    # Some carts are abandoned
+    if data.rng.random() < 0.2:
+        yield Request('orders-rud', 'DELETE', '%s%d/' % (orders_url, order_id), None, buyer)
+
+
+def bulk_checkout(data):
+    shop_id, _ = data.shop()
+    line_items = [
+        {'product': data.product(shop_id), 'quantity': data.rng.randint(1, 3)} for _ in range(data.rng.randint(1, 10))
+    ]
+    yield Request('orders-listcreate', 'POST', '/shops/%d/orders/' % shop_id, {'line_items': line_items}, data.buyer())
+
+
+def owner_dashboard(data):
+    shop_id, owner = data.shop()
+    yield Request('orders-listcreate', 'GET', '/shops/%d/orders/' % shop_id, None, owner)
+
+    order = data.order(shop_id)
+    if order is not None:
+        order_id, _ = order
+        yield Request('orders-rud', 'GET', '/shops/%d/orders/%d/' % (shop_id, order_id), None, owner)
+        yield Request('lineitems-listcreate', 'GET', '/shops/%d/orders/%d/lineitems/' % (shop_id, order_id), None, owner)
+
+        # Exports starting at one of the recent orders, rather than the whole history of the shop
+        since_id = min(pk for pk, _ in data.orders[shop_id]) - 1
+        yield Request('orders-export', 'GET', '/shops/%d/orders/export/?since_id=%d' % (shop_id, since_id), None, owner)
+        result = yield Request('orders-export', 'POST', '/shops/%d/orders/export/' % shop_id, {'since_id': since_id},
+                               owner)
+        if result.status == 202:
+            yield Request('orders-exports-detail', 'GET', '/shops/%d/orders/exports/%d/' % (shop_id, result.data['id']),
+                          None, owner)
+
+    yield Request('orders-changes', 'GET', '/shops/%d/orders/changes/' % shop_id, None, owner)
+    yield Request('shops-analytics', 'GET', '/shops/%d/analytics/' % shop_id, None, owner)
+
+    if data.staff_ids:
+        yield Request('cache-stats', 'GET', '/cache/stats/', None, data.staff_ids[0])
+
+
+def manage_catalog(data):
+    _, owner = data.shop()
+
+    result = yield Request('shops-listcreate', 'POST', '/shops/', {'name': data.name('Benchmark shop')}, owner)
+    if result.status != 201:
+        return
+
+    shop_url = '/shops/%d/' % result.data['id']
+    products_url = shop_url + 'products/'
+    for _ in range(data.rng.randint(1, 5)):
+        result = yield Request('products-listcreate', 'POST', products_url, {
+            'name': data.name('Benchmark product'), 'price': '%d.99' % data.rng.randint(1, 100),
+            'stock': data.rng.randint(0, 50),
+        }, owner)
+
+    # Editing a product also takes the change and delete product permissions, owners without them measure the 403
+    if result.status == 201:
+        product_url = '%s%d/' % (products_url, result.data['id'])
+        yield Request('products-rud', 'PATCH', product_url, {'stock': data.rng.randint(0, 50)}, owner)
+        yield Request('products-rud', 'DELETE', product_url, None, owner)
+
+    yield Request('shops-rud', 'PATCH', shop_url, {'name': data.name('Benchmark shop')}, owner)
+    yield Request('shops-rud', 'DELETE', shop_url, None, owner)
+
+
+SCENARIOS = {
+    'browse': browse_catalog,
+    'checkout': checkout,
+    'bulk_checkout': bulk_checkout,
+    'dashboard': owner_dashboard,
+    'manage': manage_catalog,
+}
+
+DEFAULT_MIX = 'browse=65,checkout=10,bulk_checkout=5,dashboard=15,manage=5'
+
+
+def parse_mix(mix):
+    """
+    Parses 'browse=70,checkout=30' into a list of (scenario, weight)
+    """
+    weights = []
+    for part in mix.split(','):
+        name, _, weight = part.partition('=')
+        if name.strip() not in SCENARIOS:
+            raise ValueError('Unknown scenario %r, choose from %s' % (name, ', '.join(sorted(SCENARIOS))))
+        weights.append((name.strip(), float(weight or 1)))
+    return weights
+
+
+def create_session(user_id):
+    """
+    Logs the user in by creating a session directly, returning the cookies and headers authenticating as them
+    """
+    user = get_user_model().objects.get(pk=user_id)
+    session = SessionStore()
+    session[SESSION_KEY] = str(user.pk)
+    session[BACKEND_SESSION_KEY] = settings.AUTHENTICATION_BACKENDS[0]
+    session[HASH_SESSION_KEY] = user.get_session_auth_hash()
+    session.create()
+
+    csrf_token = ''.join(random.choice(string.ascii_letters + string.digits) for _ in range(64))
+    cookie = '%s=%s; %s=%s' % (settings.SESSION_COOKIE_NAME, session.session_key, settings.CSRF_COOKIE_NAME, csrf_token)
+    return {'Cookie': cookie, 'X-CSRFToken': csrf_token}
+
+
+class InProcessClient:
+    """
+    Calls the WSGI application of shopify_challenge/wsgi.py directly, counting the SQL queries of every request
+    """
+
+    def __init__(self):
+        from shopify_challenge.wsgi import application
+        self.application = application
+        self.factory = RequestFactory()
+
+    def request(self, method, path, body, headers):
+        environ = self.factory.generic(
+            method, path, body or '', content_type='application/json', secure=False,
+            **dict(('HTTP_' + name.upper().replace('-', '_'), value) for name, value in headers.items())
+        ).environ
+
+        status = []
+
+        def start_response(status_line, response_headers, exc_info=None):
+            status.append(int(status_line.split(' ', 1)[0]))
+
+        with CaptureQueriesContext(connection) as queries:
+            response = self.application(environ, start_response)
+            try:
+                content = b''.join(response)
+            finally:
+                if hasattr(response, 'close'):
+                    response.close()
+
+        return status[0], content, len(queries.captured_queries)
+
+
+def server_timing_queries(header):
+    """
+    Extracts the query count reported by RequestInstrumentationMiddleware in the Server-Timing header
+    """
+    match = re.search(r'db;[^,]*desc="(\d+) queries"', header or '')
+    return int(match.group(1)) if match else None
+
+
+class HTTPClient:
+    """
+    Sends requests over keep-alive HTTP connections (one per thread) to a running server, e.g. gunicorn.
+    Query counts are read from the Server-Timing header.
+    """
+
+    def __init__(self, url):
+        parts = urlsplit(url)
+        self.host, self.port = parts.hostname, parts.port or 80
+        self.local = threading.local()
+
+    def connection(self):
+        if getattr(self.local, 'connection', None) is None:
+            self.local.connection = http.client.HTTPConnection(self.host, self.port, timeout=30)
+        return self.local.connection
+
+    def request(self, method, path, body, headers):
+        headers = dict(headers, **{'Content-Type': 'application/json', 'Accept': 'application/json'})
+        try:
+            conn = self.connection()
+            conn.request(method, path, body=body, headers=headers)
+            response = conn.getresponse()
+            return response.status, response.read(), server_timing_queries(response.getheader('Server-Timing'))
+        except (http.client.HTTPException, OSError):
+            self.local.connection = None
+            raise
+
+
+class Benchmark:
+
+    def __init__(self, client, data, mix, sessions, seed=0):
+        self.client = client
+        self.data = data
+        self.mix = mix
+        self.sessions = sessions
+        self.seed = seed
+        self.samples = []
+        self.lock = threading.Lock()
+
+    def run_scenario(self, rng, samples):
+        total_weight = sum(weight for _, weight in self.mix)
+
+        pick = rng.random() * total_weight
+        for name, weight in self.mix:
+            pick -= weight
+            if pick <= 0:
+                break
+
+        journey = SCENARIOS[name](self.data)
+        result = None
+        while True:
+            try:
+                request = journey.send(result) if result is not None else next(journey)
+            except StopIteration:
+                return
+
+            headers = {'Accept': 'application/json'}
+            if request.user is not None:
+                headers.update(self.sessions[request.user])
+            body = json.dumps(request.data) if request.data is not None else None
+
+            started = time.perf_counter()
+            try:
+                status, content, queries = self.client.request(request.method, request.path, body, headers)
+            except Exception:
+                status, content, queries = 599, b'', None
+            samples.append(Sample(request.route + ' ' + request.method, status, time.perf_counter() - started, queries))
+
+            try:
+                result = Result(status, json.loads(content.decode('utf-8')) if content else None)
+            except ValueError:
+                result = Result(status, None)
+
+    def worker(self, index, deadline):
+        # Each worker has its own generator so that runs are repeatable for a given seed and concurrency
+        rng = random.Random('%s-%s' % (self.seed, index))
+        samples = []
+        while time.perf_counter() < deadline:
+            self.run_scenario(rng, samples)
+
+        with self.lock:
+            self.samples.extend(samples)
+
+    def run(self, duration, concurrency=1):
+        deadline = time.perf_counter() + duration
+        threads = [threading.Thread(target=self.worker, args=(i, deadline)) for i in range(concurrency)]
+        started = time.perf_counter()
+
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+
+        return summarize(self.samples, time.perf_counter() - started)
+
+
+class FlashSale:
+    """
+    Concurrent buyers of a single product, each placing orders of `quantity` units until they are told it's out of
+    stock. Checks that exactly the stock put on sale was sold, no more, and reports the throughput of the checkouts.
+    """
+
+    def __init__(self, client, product_id, stock, quantity=1):
+        self.client = client
+        self.product = Product.objects.get(pk=product_id)
+        self.stock = stock
+        self.quantity = quantity
+        # No buyer can place more orders than that, even if every other one keeps failing
+        self.max_attempts = stock // quantity + 1
+        self.samples = []
+        self.lock = threading.Lock()
+
+    def buyer(self, headers):
+        path = '/shops/%d/orders/' % self.product.shop_id
+        body = json.dumps({'line_items': [{'product': self.product.pk, 'quantity': self.quantity}]})
+        samples = []
+
+        for _ in range(self.max_attempts):
+            started = time.perf_counter()
+            try:
+                status, _, queries = self.client.request('POST', path, body, headers)
+            except Exception:
+                status, queries = 599, None
+            samples.append(Sample('orders-listcreate POST', status, time.perf_counter() - started, queries))
+
+            if status == 409:
+                break
+
+        with self.lock:
+            self.samples.extend(samples)
+
+        # In-process requests opened a connection of their own in this thread
+        connection.close()
+
+    def run(self, buyer_ids):
+        Product.objects.filter(pk=self.product.pk).update(stock=self.stock)
+        line_items = LineItem.objects.using(Shop.objects.get(pk=self.product.shop_id).shard)
+        last_line_item = line_items.aggregate(last=Max('pk'))['last'] or 0
+
+        users = get_user_model().objects.in_bulk(buyer_ids)
+        headers = [
+            {'Accept': 'application/json', 'Authorization': 'Bearer ' + issue_token(users[pk])[0]} for pk in buyer_ids
+        ]
+        threads = [threading.Thread(target=self.buyer, args=(buyer_headers,)) for buyer_headers in headers]
+        started = time.perf_counter()
+
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+
+        elapsed = time.perf_counter() - started
+        remaining = Product.objects.get(pk=self.product.pk).stock
+        sold = line_items.filter(pk__gt=last_line_item, product=self.product).count() * self.quantity
+        orders = sum(1 for sample in self.samples if sample.status == 201)
+
+        results = summarize_samples(self.samples, elapsed)
+        results.update({
+            'elapsed': round(elapsed, 3),
+            'buyers': len(buyer_ids),
+            'stock': self.stock,
+            'sold': sold,
+            'remaining': remaining,
+            'orders': orders,
+            'sold_out': sum(1 for sample in self.samples if sample.status == 409),
+            'checkouts_per_second': round(orders / elapsed, 2) if elapsed else None,
+            # Every unit sold was taken from the stock exactly once. Judged from the database rather than the responses
+            # since a request failing after its commit (e.g. SQLite timing out on a lock) still sold its units.
+            'consistent': remaining >= 0 and sold == self.stock - remaining and sold >= orders * self.quantity,
+        })
+        return results
+
+
+def percentile(sorted_values, fraction):
+    if not sorted_values:
+        return None
+    index = min(len(sorted_values) - 1, int(round(fraction * (len(sorted_values) - 1))))
+    return sorted_values[index]
+
+
+def summarize_samples(samples, elapsed):
+    latencies = sorted(sample.latency * 1000 for sample in samples)
+    queries = [sample.queries for sample in samples if sample.queries is not None]
+
+    return {
+        'requests': len(samples),
+        'errors': sum(1 for sample in samples if sample.status >= 500),
+        'client_errors': sum(1 for sample in samples if 400 <= sample.status < 500),
+        'throughput': round(len(samples) / elapsed, 2) if elapsed else None,
+        'latency_ms': {
+            'mean': round(sum(latencies) / len(latencies), 3) if latencies else None,
+            'p50': percentile(latencies, 0.50),
+            'p95': percentile(latencies, 0.95),
+            'p99': percentile(latencies, 0.99),
+            'max': latencies[-1] if latencies else None,
+        },
+        'queries': {
+            'mean': round(sum(queries) / len(queries), 2) if queries else None,
+            'max': max(queries) if queries else None,
+        },
+    }
+
+
+def summarize(samples, elapsed):
+    routes = defaultdict(list)
+    for sample in samples:
+        routes[sample.route].append(sample)
+
+    return {
+        'elapsed': round(elapsed, 3),
+        'total': summarize_samples(samples, elapsed),
+        'routes': dict((route, summarize_samples(route_samples, elapsed)) for route, route_samples in sorted(routes.items())),
+    }
+
+
+def compare(baseline, current):
+    """
+    Yields (route, metric, baseline, current, relative change) for the headline metrics of two result files
+    """
+    for route in ['total'] + sorted(current['results']['routes']):
+        before = baseline['results']['total'] if route == 'total' else baseline['results']['routes'].get(route)
+        after = current['results']['total'] if route == 'total' else current['results']['routes'][route]
+        if before is None:
+            continue
+
+        for metric, old, new in [
+            ('throughput', before['throughput'], after['throughput']),
+            ('p50', before['latency_ms']['p50'], after['latency_ms']['p50']),
+            ('p99', before['latency_ms']['p99'], after['latency_ms']['p99']),
+            ('queries', before['queries']['mean'], after['queries']['mean']),
+        ]:
+            change = (new - old) / old if old and new is not None else None
+            yield route, metric, old, new, change
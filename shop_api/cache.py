@@ -0,0 +1,242 @@
+import threading
+import time
+import uuid
+from collections import OrderedDict
+
+from django.conf import settings
+from django.core.cache import caches
+from django.utils.module_loading import import_string
+from rest_framework.response import Response
+from shop_api import metrics
+
+
+# Read-through cache for the catalog endpoints (shops and products).
+#
+# Entries are grouped in namespaces (e.g. the product list of one shop). Every namespace has a generation
+# token which is part of the key of its entries, invalidating a namespace is done by replacing its token,
+# which makes every entry of the namespace unreachable in O(1) whatever query strings were cached.
+
+
+class LRUCache:
+    """
+    In-process least recently used cache with a time to live on every entry.
+    Only the worker invalidating a namespace sees the invalidation, TIMEOUT bounds the staleness of the others.
+    """
+
+    def __init__(self, max_entries=10000, timeout=60):
+        self.max_entries = max_entries
+        self.timeout = timeout
+        self._entries = OrderedDict()
+        self._generations = {}
+        self._lock = threading.Lock()
+        self.hits = self.misses = self.evictions = self.expirations = 0
+
+    def get(self, key):
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None:
+                self.misses += 1
+                return None
+
+            value, expires_at = entry
+            if expires_at < time.monotonic():
+                del self._entries[key]
+                self.expirations += 1
+                metrics.record(metrics.CATALOG_CACHE_EVICTIONS, ('expired',))
+                self.misses += 1
+                return None
+
+            self._entries.move_to_end(key)
+            self.hits += 1
+            return value
+
+    def set(self, key, value):
+        with self._lock:
+            self._entries[key] = (value, time.monotonic() + self.timeout)
+            self._entries.move_to_end(key)
+
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+                self.evictions += 1
+                metrics.record(metrics.CATALOG_CACHE_EVICTIONS, ('lru',))
+
+    def generation(self, namespace):
+        with self._lock:
+            return self._generations.setdefault(namespace, uuid.uuid4().hex)
+
+    def invalidate(self, namespace):
+        with self._lock:
+            # Nothing was cached under a namespace without a generation, bulk writes don't fill the dict
+            if namespace in self._generations:
+                self._generations[namespace] = uuid.uuid4().hex
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+            self._generations.clear()
+
+    def stats(self):
+        return {
+            'backend': 'lru',
+            'entries': len(self._entries),
+            'max_entries': self.max_entries,
+            'hits': self.hits,
+            'misses': self.misses,
+            'evictions': self.evictions,
+            'expirations': self.expirations,
+        }
+
+
+class SharedCache:
+    """
+    Cache shared by all the gunicorn workers through one of the Django CACHES (file based, memcached...).
+    Invalidations are visible to every worker. Evictions are handled by the Django backend and aren't counted.
+    """
+
+    def __init__(self, alias='catalog', timeout=300):
+        self.alias = alias
+        self.timeout = timeout
+        self.hits = self.misses = 0
+
+    @property
+    def backend(self):
+        return caches[self.alias]
+
+    def get(self, key):
+        value = self.backend.get(key)
+        if value is None:
+            self.misses += 1
+        else:
+            self.hits += 1
+        return value
+
+    def set(self, key, value):
+        self.backend.set(key, value, self.timeout)
+
+    def generation(self, namespace):
+        key = 'generation:' + namespace
+        token = self.backend.get(key)
+        if token is None:
+            # add() keeps the token of a worker which got there first
+            self.backend.add(key, uuid.uuid4().hex, None)
+            token = self.backend.get(key)
+        return token
+
+    def invalidate(self, namespace):
+        # The next generation() draws a new token, namespaces which were never cached don't leave a key behind
+        self.backend.delete('generation:' + namespace)
+
+    def clear(self):
+        self.backend.clear()
+
+    def stats(self):
+        return {
+            'backend': 'shared',
+            'alias': self.alias,
+            'hits': self.hits,
+            'misses': self.misses,
+        }
+
+
+class DummyCache:
+    """
+    Disables catalog caching
+    """
+
+    def get(self, key):
+        return None
+
+    def set(self, key, value):
+        pass
+
+    def generation(self, namespace):
+        return ''
+
+    def invalidate(self, namespace):
+        pass
+
+    def clear(self):
+        pass
+
+    def stats(self):
+        return {'backend': 'dummy'}
+
+
+_catalog_cache = None
+
+
+def get_catalog_cache():
+    """
+    Returns the catalog cache configured by the SHOP_API_CATALOG_CACHE setting
+    """
+    global _catalog_cache
+
+    if _catalog_cache is None:
+        config = getattr(settings, 'SHOP_API_CATALOG_CACHE', {})
+        backend = import_string(config.get('BACKEND', 'shop_api.cache.LRUCache'))
+        _catalog_cache = backend(**config.get('OPTIONS', {}))
+
+    return _catalog_cache
+
+
+# Namespaces of the cached catalog entries
+
+def shop_list_namespace():
+    return 'shops'
+
+
+def shop_namespace(shop_id):
+    return 'shop:%s' % shop_id
+
+
+def product_list_namespace(shop_id):
+    return 'shop:%s:products' % shop_id
+
+
+def product_namespace(product_id):
+    return 'product:%s' % product_id
+
+
+def invalidate_products(shop_id, product_ids=()):
+    """
+    Invalidates the entries showing the products with ids product_ids of the shop with id=shop_id: their detail,
+    the product list of the shop, and the shop detail and list, which embed full products with ?expand=products
+    """
+    cache = get_catalog_cache()
+    cache.invalidate(product_list_namespace(shop_id))
+    for product_id in product_ids:
+        cache.invalidate(product_namespace(product_id))
+    cache.invalidate(shop_namespace(shop_id))
+    cache.invalidate(shop_list_namespace())
+
+
+class CachedReadMixin:
+    """
+    Serves GET list and retrieve responses of a generic view from the catalog cache.
+    Views define get_cache_namespace() naming the namespace invalidated when their data changes.
+    """
+
+    def get_cache_namespace(self):
+        raise NotImplementedError('CachedReadMixin views must define get_cache_namespace()')
+
+    def cached_response(self, request, respond):
+        cache = get_catalog_cache()
+        namespace = self.get_cache_namespace()
+        key = '%s:%s:%s' % (namespace, cache.generation(namespace), request.build_absolute_uri())
+
+        data = cache.get(key)
+        metrics.record(metrics.CATALOG_CACHE_REQUESTS, (metrics.route_of(request), 'miss' if data is None else 'hit'))
+        if data is not None:
+            return Response(data)
+
+        response = respond()
+        if response.status_code == 200:
+            cache.set(key, response.data)
+
+        return response
+
+    def list(self, request, *args, **kwargs):
+        return self.cached_response(request, lambda: super(CachedReadMixin, self).list(request, *args, **kwargs))
+
+    def retrieve(self, request, *args, **kwargs):
+        return self.cached_response(request, lambda: super(CachedReadMixin, self).retrieve(request, *args, **kwargs))
@@ -0,0 +1,206 @@
+import json
+import time
+
+from django.core.serializers.json import DjangoJSONEncoder
+from django.db import IntegrityError, transaction
+from django.db.models import Exists, Max, OuterRef, Q, Value
+from django.db.models.functions import Greatest
+from django.utils import timezone
+from rest_framework import exceptions, status
+from shop_api.instrumentation import span
+from shop_api.models import Shop, OrderEvent, OrderEventLock
+
+
+# Change feed of the orders of each shop.
+#
+# The views append an event to the feed of the shop in the transaction of every order and line item they create,
+# update or delete. Events carry the order or line item as it is after the change, in the shape of the export, so
+# consumers read the feed in id order from the cursor of their last read and upsert what they receive. Deleting an
+# order is a single order.deleted event, its line items go with it.
+#
+# Events live on the shard of their shop and keep growing ids when it moves. An id is taken before the transaction
+# commits, and transactions don't commit in the order they took their ids: a reader which saw a higher id would skip
+# a lower one committed later. So a transaction locks the OrderEventLock row of the shop before appending, and holds it
+# until it commits: the events of a shop commit in id order. The lock is taken late in the transactions of the views,
+# right before their last writes.
+# compact_order_changes drops the events superseded by a later event of the same line item or order, and every
+# event past the retention. Cursors from before the dropped events expire.
+
+
+def line_item_data(line_item):
+    return {
+        'id': line_item.pk,
+        'order': line_item.order_id,
+        'product': line_item.product_id,
+        'quantity': line_item.quantity,
+        'price': line_item.price,
+    }
+
+
+def lock_feed(alias, shop_id):
+    """
+    Locks the feed of the shop with id=shop_id on the database alias until the transaction ends
+    """
+    locks = OrderEventLock.objects.using(alias).filter(shop_id=shop_id)
+    if locks.update(updated_at=timezone.now()):
+        return
+
+    try:
+        with transaction.atomic(using=alias):
+            OrderEventLock.objects.using(alias).create(shop_id=shop_id)
+    except IntegrityError:
+        # Another transaction appended the first event meanwhile
+        locks.update(updated_at=timezone.now())
+
+
+def record(order, kind, data, order_id=None, line_item_id=None):
+    lock_feed(order._state.db, order.shop_id)
+    OrderEvent.objects.using(order._state.db).create(
+        shop_id=order.shop_id, order_id=order_id or order.pk, line_item_id=line_item_id, kind=kind,
+        data=json.dumps(data, cls=DjangoJSONEncoder)
+    )
+
+
+def order_added(order, line_items):
+    record(order, OrderEvent.ORDER_CREATED, {
+        'id': order.pk,
+        'client': order.client_id,
+        'shop': order.shop_id,
+        'total': order.total,
+        'line_items': [line_item_data(line_item) for line_item in line_items],
+    })
+
+
+# Model.delete() clears the id of the deleted instances, the views pass it along
+
+def order_removed(order, order_id):
+    record(order, OrderEvent.ORDER_DELETED, {'id': order_id}, order_id=order_id)
+
+
+# The line item events carry the total of their order, which the change shifted
+
+def line_item_added(line_item, order):
+    record(order, OrderEvent.LINE_ITEM_CREATED, dict(line_item_data(line_item), order_total=order.total),
+           line_item_id=line_item.pk)
+
+
+def line_item_changed(line_item, order):
+    record(order, OrderEvent.LINE_ITEM_UPDATED, dict(line_item_data(line_item), order_total=order.total),
+           line_item_id=line_item.pk)
+
+
+def line_item_removed(line_item_id, order):
+    record(order, OrderEvent.LINE_ITEM_DELETED, {'id': line_item_id, 'order_total': order.total},
+           line_item_id=line_item_id)
+
+
+class CursorExpired(exceptions.APIException):
+    status_code = status.HTTP_410_GONE
+    default_detail = 'Events after this cursor were dropped, reload the orders then read the feed from `cursor`.'
+    default_code = 'cursor_expired'
+
+    def __init__(self, cursor):
+        super(CursorExpired, self).__init__()
+        # The cursor to resume from stays a number
+        self.detail = {'detail': self.detail, 'cursor': cursor}
+
+
+def head(shop):
+    """
+    Cursor after the last event of shop
+    """
+    last = shop.order_events.aggregate(last=Max('id'))['last']
+    return max(last or 0, shop.changes_purged_through)
+
+
+def read(shop, after, limit):
+    """
+    Returns the first limit events of shop after the cursor `after`
+    """
+    if after < shop.changes_purged_through:
+        raise CursorExpired(head(shop))
+
+    return list(shop.order_events.filter(pk__gt=after).order_by('pk')[:limit])
+
+
+def wait_for(shop, after, limit, timeout, interval=0.5):
+    """
+    Polls the feed of shop until it has events after the cursor `after` or timeout seconds passed
+    """
+    deadline = time.monotonic() + timeout
+    while True:
+        events = read(shop, after, limit)
+        if events or time.monotonic() >= deadline:
+            return events
+        with span('wait'):
+            time.sleep(min(interval, max(deadline - time.monotonic(), 0)))
+
+
+class ChangeFeedCompactor:
+    """
+    Drops the events of the shops of a shard which were superseded before `compact_before` and every event from
+    before `purge_before`, batch_size events per statement with a pause of `pause` seconds in between.
+    Shops being moved to another shard are left for the next run.
+    """
+
+    def __init__(self, alias, compact_before, purge_before, batch_size=1000, pause=0.1, log=None):
+        self.alias = alias
+        self.compact_before = compact_before
+        self.purge_before = purge_before
+        self.batch_size = batch_size
+        self.pause = pause
+        self.log = log or (lambda message: None)
+
+    def shops(self):
+        return Shop.objects.filter(shard=self.alias, shard_locked=False).order_by('pk').values_list('pk', flat=True)
+
+    def events(self, shop_id):
+        return OrderEvent.objects.using(self.alias).filter(shop_id=shop_id)
+
+    def superseded(self, shop_id):
+        """
+        Events followed by an event of the same line item, or by the deletion of their order
+        """
+        later = self.events(shop_id).filter(order_id=OuterRef('order_id'), pk__gt=OuterRef('pk'))
+        line_items = self.events(shop_id).filter(line_item_id__isnull=False, created_at__lt=self.compact_before) \
+            .annotate(superseded=Exists(
+                later.filter(Q(line_item_id=OuterRef('line_item_id')) | Q(kind=OrderEvent.ORDER_DELETED))
+            ))
+        orders = self.events(shop_id).filter(kind=OrderEvent.ORDER_CREATED, created_at__lt=self.compact_before) \
+            .annotate(superseded=Exists(later.filter(kind=OrderEvent.ORDER_DELETED)))
+        return line_items.filter(superseded=True), orders.filter(superseded=True)
+
+    def delete(self, events):
+        deleted = 0
+        while True:
+            batch = list(events.values_list('pk', flat=True)[:self.batch_size])
+            if not batch:
+                return deleted
+
+            deleted += OrderEvent.objects.using(self.alias).filter(pk__in=batch).delete()[0]
+            time.sleep(self.pause)
+
+    def purge(self, shop_id):
+        last = self.events(shop_id).filter(created_at__lt=self.purge_before).aggregate(last=Max('id'))['last']
+        if last is None:
+            return 0
+
+        # The cursors expire before their events disappear
+        Shop.objects.filter(pk=shop_id).update(
+            changes_purged_through=Greatest('changes_purged_through', Value(last))
+        )
+        return self.delete(self.events(shop_id).filter(pk__lte=last))
+
+    def run(self, shop_ids=None):
+        """
+        Compacts the feeds of the shops with ids shop_ids, or of every shop of the shard, returns how many events
+        were dropped
+        """
+        dropped = 0
+        for shop_id in (shop_ids if shop_ids is not None else self.shops()):
+            purged = self.purge(shop_id)
+            compacted = sum(self.delete(events) for events in self.superseded(shop_id))
+            if purged or compacted:
+                self.log('Dropped %d expired and %d superseded events of shop %d' % (purged, compacted, shop_id))
+            dropped += purged + compacted
+        return dropped
@@ -0,0 +1,62 @@
+import hashlib
+import calendar
+
+from django.conf import settings
+from django.utils.cache import get_conditional_response, patch_cache_control, patch_vary_headers
+from django.utils.http import http_date, quote_etag
+
+
+def timestamp_validators(updated_at):
+    """
+    Validators for a single row versioned by its microsecond precision updated_at column
+    """
+    if updated_at is None:
+        return None
+    return updated_at.isoformat(), updated_at
+
+
+class ConditionalGetMixin:
+    """
+    Adds strong ETag and Last-Modified validators to the GET responses of a generic view.
+
+    Views define get_validators() returning a (version, last_modified) pair read from cheap version columns,
+    or None to skip conditional handling. The version identifies the state of every row the response is built
+    from, so requests with a matching If-None-Match get a 304 without running the list query or the serializer.
+    """
+
+    def get_validators(self):
+        raise NotImplementedError('ConditionalGetMixin views must define get_validators()')
+
+    def get_etag(self, request, version):
+        # The same data is rendered differently for every page and every renderer
+        representation = '%s|%s|%s' % (version, request.get_full_path(), request.accepted_media_type)
+        return quote_etag(hashlib.md5(representation.encode('utf-8')).hexdigest())
+
+    def get(self, request, *args, **kwargs):
+        validators = self.get_validators()
+        if validators is None:
+            return super(ConditionalGetMixin, self).get(request, *args, **kwargs)
+
+        version, last_modified = validators
+        etag = self.get_etag(request, version)
+        timestamp = calendar.timegm(last_modified.utctimetuple()) if last_modified else None
+
+        response = get_conditional_response(request._request, etag=etag, last_modified=timestamp)
+        if response is None:
+            response = super(ConditionalGetMixin, self).get(request, *args, **kwargs)
+
+        response['ETag'] = etag
+        if timestamp is not None:
+            response['Last-Modified'] = http_date(timestamp)
+
+        self.patch_cache_headers(request, response)
+        return response
+
+    def patch_cache_headers(self, request, response):
+        patch_vary_headers(response, ('Accept', 'Authorization', 'Cookie'))
+
+        # Anonymous reads may be microcached by the front proxy, clients always revalidate with the ETag
+        if request.user.is_authenticated:
+            patch_cache_control(response, private=True, no_cache=True)
+        else:
+            patch_cache_control(response, public=True, max_age=getattr(settings, 'SHOP_API_MICROCACHE_SECONDS', 1))
@@ -0,0 +1,163 @@
+import csv
+import datetime
+import heapq
+import json
+import os
+
+from django.conf import settings
+from django.db import DEFAULT_DB_ALIAS
+from django.utils import timezone
+from rest_framework.utils.encoders import JSONEncoder
+from shop_api.archive import iter_archived_orders
+from shop_api.models import Order, LineItem, OrderExport
+
+
+ORDER_FIELDS = ('id', 'client', 'shop', 'total')
+LINE_ITEM_FIELDS = ('id', 'order', 'product', 'quantity', 'price')
+
+CSV_HEADER = ['order_id', 'client', 'shop', 'total', 'line_item_id', 'product', 'quantity', 'price']
+
+
+def iter_live_orders(shop_id, since_id=0, chunk_size=500, using=DEFAULT_DB_ALIAS):
+    """
+    Yields (order, line_items) pairs of tuples for the orders of the shop read from the database `using`, in id order.
+
+    Orders are read chunk_size at a time with one keyset range query on the orders and one IN query on their
+    line items, rows are fetched as plain tuples so memory only ever holds a single chunk.
+    """
+    last_id = since_id or 0
+
+    while True:
+        orders = list(
+            Order.objects.using(using).filter(shop_id=shop_id, pk__gt=last_id)
+            .order_by('pk')
+            .values_list('id', 'client_id', 'shop_id', 'total')[:chunk_size]
+        )
+        if not orders:
+            return
+
+        line_items = {}
+        rows = (
+            LineItem.objects.using(using).filter(order_id__in=[order[0] for order in orders])
+            .order_by('order_id', 'pk')
+            .values_list('id', 'order_id', 'product_id', 'quantity', 'price')
+        )
+        for row in rows:
+            line_items.setdefault(row[1], []).append(row)
+
+        for order in orders:
+            yield order, line_items.get(order[0], [])
+
+        # A short chunk is the last one
+        if len(orders) < chunk_size:
+            return
+        last_id = orders[-1][0]
+
+
+def iter_order_chunks(shop_id, since_id=0, chunk_size=500, using=DEFAULT_DB_ALIAS):
+    """
+    Yields lists of (order, line_items) pairs for the live and archived orders of the shop read from the database
+    `using`, merged in id order, chunk_size orders at a time
+    """
+    orders = heapq.merge(
+        iter_live_orders(shop_id, since_id, chunk_size, using),
+        iter_archived_orders(shop_id, since_id, chunk_size, using),
+        key=lambda pair: pair[0][0]
+    )
+
+    chunk = []
+    for pair in orders:
+        chunk.append(pair)
+        if len(chunk) == chunk_size:
+            yield chunk
+            chunk = []
+
+    if chunk:
+        yield chunk
+
+
+def ndjson_rows(chunks):
+    """
+    One JSON document per order with its line items nested, using the same shape as OrderSerializer. The totals and
+    prices are encoded like the API encodes them, as numbers.
+    """
+    for chunk in chunks:
+        lines = []
+        for order, line_items in chunk:
+            document = dict(zip(ORDER_FIELDS, order))
+            document['line_items'] = [dict(zip(LINE_ITEM_FIELDS, item)) for item in line_items]
+            lines.append(json.dumps(document, cls=JSONEncoder) + '\n')
+        yield ''.join(lines)
+
+
+class _Echo:
+    """
+    File-like object handing back whatever csv.writer writes to it
+    """
+
+    def write(self, value):
+        return value
+
+
+def csv_rows(chunks):
+    """
+    One CSV row per line item with its order columns repeated, orders without items get a single row
+    """
+    writer = csv.writer(_Echo())
+    yield writer.writerow(CSV_HEADER)
+
+    for chunk in chunks:
+        lines = []
+        for order, line_items in chunk:
+            if not line_items:
+                lines.append(writer.writerow(list(order) + [''] * 4))
+            for line_item_id, _, product_id, quantity, price in line_items:
+                lines.append(writer.writerow(list(order) + [line_item_id, product_id, quantity, price]))
+        yield ''.join(lines)
+
+
+EXPORT_FORMATS = {
+    'ndjson': (ndjson_rows, 'application/x-ndjson'),
+    'csv': (csv_rows, 'text/csv'),
+}
+
+
+def export_path(export):
+    directory = getattr(settings, 'SHOP_API_EXPORT_DIR', os.path.join(settings.BASE_DIR, 'exports'))
+    return os.path.join(directory, 'shop-%d-orders-%d.%s' % (export.shop_id, export.pk, export.output))
+
+
+def write_export(export_id, chunk_size=500):
+    """
+    Task writing the file of an OrderExport, then deleting the exports of its shop past their retention
+    """
+    export = OrderExport.objects.select_related('shop').filter(pk=export_id).first()
+    if export is None:
+        # Its shop was deleted
+        return
+
+    render_rows, _ = EXPORT_FORMATS[export.output]
+    path = export_path(export)
+    try:
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        chunks = iter_order_chunks(export.shop_id, since_id=export.since_id, chunk_size=chunk_size,
+                                   using=export.shop.shard)
+        # Downloads never see a partial file
+        with open(path + '.part', 'w', encoding='utf-8', newline='') as file:
+            for text in render_rows(chunks):
+                file.write(text)
+        os.replace(path + '.part', path)
+    except Exception as e:
+        OrderExport.objects.filter(pk=export.pk).update(
+            status=OrderExport.FAILED, error=str(e) or e.__class__.__name__, finished_at=timezone.now()
+        )
+        raise
+
+    OrderExport.objects.filter(pk=export.pk).update(
+        status=OrderExport.READY, error='', size=os.path.getsize(path), finished_at=timezone.now()
+    )
+
+    retention = datetime.timedelta(hours=getattr(settings, 'SHOP_API_EXPORT_RETENTION_HOURS', 24))
+    # The files go with their rows, see shop_api.signals
+    for expired in OrderExport.objects.filter(shop_id=export.shop_id, created_at__lt=timezone.now() - retention):
+        expired.delete()
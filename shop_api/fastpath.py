@@ -0,0 +1,153 @@
+from collections import OrderedDict
+from decimal import Decimal
+
+from django.conf import settings
+from rest_framework.response import Response
+from shop_api.instrumentation import span
+from shop_api.models import Product, Order, LineItem
+from shop_api.sparse import FIELDS_PARAM, query_list
+
+
+# Read-only serialization of the hot list endpoints straight from values() rows.
+#
+# Every ValuesSerializer mirrors one of the DRF serializers of shop_api.serializers field for field and produces
+# exactly the same representation, without instantiating models or dispatching through the DRF fields. The rows only
+# hold native types, so the JSON renderer never calls back into Python either.
+
+CENT = Decimal('0.01')
+
+
+def decimal_string(value):
+    # serializers.DecimalField(decimal_places=2)
+    return '{:f}'.format(value.quantize(CENT))
+
+
+def decimal_number(value):
+    # serializers.ReadOnlyField rendered by the JSON encoder of DRF
+    return float(value)
+
+
+class ValuesSerializer:
+    """
+    Declares fields as (name, column, to_value) tuples in the order of the DRF serializer it mirrors.
+    to_value is None for values represented as they are, column is None for fields filled in by serialize().
+
+    Rows are values_list() tuples starting with the primary key, which keyset pagination positions itself with.
+    """
+
+    model = None
+    fields = ()
+
+    def __init__(self, fields=None):
+        self.fields = [field for field in self.fields if fields is None or field[0] in fields]
+
+        columns = [column for _, column, _ in self.fields if column is not None]
+        self.names = [name for name, column, _ in self.fields if column is not None]
+        self.offset = 0 if columns[:1] == ['id'] else 1
+        self.columns = columns if self.offset == 0 else ['id'] + columns
+        self.converters = [
+            (name, self.columns.index(column), to_value) for name, column, to_value in self.fields
+            if column is not None and to_value is not None
+        ]
+
+    @classmethod
+    def supports(cls, fields):
+        return fields is None or set(fields) <= set(field[0] for field in cls.fields)
+
+    def wants(self, name):
+        return any(field[0] == name for field in self.fields)
+
+    def values(self, queryset):
+        return queryset.prefetch_related(None).values_list(*self.columns)
+
+    def to_representation(self, row):
+        data = OrderedDict(zip(self.names, row[self.offset:] if self.offset else row))
+        for name, index, to_value in self.converters:
+            if row[index] is not None:
+                data[name] = to_value(row[index])
+        return data
+
+    def serialize(self, rows):
+        with span('serialize'):
+            return [self.to_representation(row) for row in rows]
+
+
+class ProductValuesSerializer(ValuesSerializer):
+    model = Product
+    fields = (
+        ('id', 'id', None),
+        ('shop', 'shop_id', None),
+        ('name', 'name', None),
+        ('description', 'description', None),
+        ('price', 'price', decimal_string),
+        ('stock', 'stock', None),
+    )
+
+
+class LineItemValuesSerializer(ValuesSerializer):
+    model = LineItem
+    fields = (
+        ('id', 'id', None),
+        ('order', 'order_id', None),
+        ('product', 'product_id', None),
+        ('quantity', 'quantity', None),
+        ('price', 'price', decimal_number),
+    )
+
+
+class OrderValuesSerializer(ValuesSerializer):
+    model = Order
+    fields = (
+        ('id', 'id', None),
+        ('client', 'client_id', None),
+        ('shop', 'shop_id', None),
+        ('total', 'total', decimal_number),
+        ('line_items', None, None),
+    )
+
+    def serialize(self, rows):
+        if not self.wants('line_items'):
+            return super(OrderValuesSerializer, self).serialize(rows)
+
+        with span('serialize'):
+            rows = list(rows)
+
+            # One query for the line items of the page, like prefetch_related('line_items')
+            line_items = {}
+            if rows:
+                items = LineItemValuesSerializer()
+                order_index = items.columns.index('order_id')
+                queryset = LineItem.objects.filter(order_id__in=[row[0] for row in rows]).order_by('id')
+                for row in items.values(queryset):
+                    line_items.setdefault(row[order_index], []).append(items.to_representation(row))
+
+            orders = []
+            for row in rows:
+                order = self.to_representation(row)
+                order['line_items'] = line_items.get(row[0], [])
+                orders.append(order)
+            return orders
+
+
+class FastListMixin:
+    """
+    Serves the GET list of a generic view with its values_serializer_class rather than its DRF serializer,
+    unless SHOP_API_FAST_SERIALIZERS is off or the requested fields are unknown to it
+    """
+
+    values_serializer_class = None
+
+    def list(self, request, *args, **kwargs):
+        fields = query_list(request, FIELDS_PARAM)
+        enabled = getattr(settings, 'SHOP_API_FAST_SERIALIZERS', True)
+        if not enabled or not self.values_serializer_class.supports(fields):
+            return super(FastListMixin, self).list(request, *args, **kwargs)
+
+        serializer = self.values_serializer_class(fields)
+        rows = serializer.values(self.filter_queryset(self.get_queryset()))
+
+        page = self.paginate_queryset(rows)
+        if page is not None:
+            return self.get_paginated_response(serializer.serialize(page))
+
+        return Response(serializer.serialize(rows))
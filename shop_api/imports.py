@@ -0,0 +1,303 @@
+import csv
+import json
+
+from django.core.exceptions import ValidationError
+from django.db import IntegrityError, connections, router, transaction
+from django.utils import timezone
+from shop_api.cache import invalidate_products
+from shop_api.models import Shop, Product
+from shop_api.search import get_search_backend
+
+
+# Bulk import of a shop's catalog.
+#
+# The upload is read line by line from the request stream and applied in batches: each batch is validated with the
+# model fields, checked against the names of every shop with one query, then written with a bulk INSERT and batched
+# UPDATEs in a transaction of its own. Only one batch and a bounded error report are ever held in memory.
+# Products are upserted by name, later rows win over earlier ones and the rows they supersede are counted as such.
+# Rows are matched to each other and to the products the database finds by the key of NameCollation, which equates
+# the names the collation of the name column (and so its unique constraint) does.
+
+IMPORT_FIELDS = ('name', 'description', 'price', 'stock')
+REQUIRED_FIELDS = ('name', 'price')
+
+
+class InvalidUpload(Exception):
+    """
+    The upload can't be read at all, e.g. its CSV header is missing columns
+    """
+
+
+def decoded_lines(stream):
+    for number, line in enumerate(stream):
+        line = line.decode('utf-8')
+        yield line.lstrip('\ufeff') if number == 0 else line
+
+
+def csv_rows(stream):
+    """
+    Yields a dict per CSV record, keyed by the columns of its header
+    """
+    reader = csv.reader(decoded_lines(stream))
+    try:
+        header = [column.strip() for column in next(reader)]
+    except StopIteration:
+        return
+
+    unknown = sorted(set(header) - set(IMPORT_FIELDS))
+    missing = [name for name in REQUIRED_FIELDS if name not in header]
+    if unknown or missing:
+        raise InvalidUpload('The CSV header must have the columns %s and may have %s' % (
+            ', '.join(REQUIRED_FIELDS), ', '.join(name for name in IMPORT_FIELDS if name not in REQUIRED_FIELDS)
+        ))
+
+    for record in reader:
+        if len(record) != len(header):
+            yield {None: 'Expected %d columns, got %d.' % (len(header), len(record))}
+        else:
+            # Empty cells of optional columns clear them
+            yield dict(zip(header, record))
+
+
+def ndjson_rows(stream):
+    """
+    Yields a dict per JSON document, blank lines are skipped
+    """
+    for line in decoded_lines(stream):
+        if not line.strip():
+            continue
+
+        try:
+            document = json.loads(line)
+        except ValueError:
+            yield {None: 'Invalid JSON.'}
+            continue
+
+        if not isinstance(document, dict):
+            yield {None: 'Expected a JSON object.'}
+            continue
+
+        # repr() is the shortest string reading back as the same float, e.g. 12.99 rather than 12.9900000000000002
+        yield dict((name, repr(value) if isinstance(value, float) else value) for name, value in document.items())
+
+
+IMPORT_FORMATS = {
+    'text/csv': csv_rows,
+    'application/x-ndjson': ndjson_rows,
+}
+
+
+class NameCollation:
+    """
+    Compares names like the collation of the product name column: SQLite's BINARY tells every spelling apart, MySQL's
+    _ci collations ignore the case and all but its _0900 collations (MySQL 8) ignore the trailing spaces
+    """
+
+    def __init__(self, case_insensitive=False, pad_space=False):
+        self.case_insensitive = case_insensitive
+        self.pad_space = pad_space
+
+    @classmethod
+    def of(cls, connection):
+        if connection.vendor != 'mysql':
+            return cls()
+
+        with connection.cursor() as cursor:
+            cursor.execute(
+                'SELECT COLLATION_NAME FROM information_schema.COLUMNS '
+                'WHERE TABLE_SCHEMA = DATABASE() AND TABLE_NAME = %s AND COLUMN_NAME = %s',
+                [Product._meta.db_table, Product._meta.get_field('name').column]
+            )
+            collation = cursor.fetchone()[0]
+        return cls(case_insensitive=collation.endswith('_ci'), pad_space='_0900_' not in collation)
+
+    def key(self, name):
+        """
+        Key under which the names the collation treats as equal are matched
+        """
+        if self.pad_space:
+            name = name.rstrip(' ')
+        return name.casefold() if self.case_insensitive else name
+
+
+def clean_row(row):
+    """
+    Validates a row with the model fields, returns its values and a {field: [message, ...]} dict of errors
+    """
+    values = {}
+    errors = {}
+
+    if None in row:
+        return values, {'non_field_errors': [row[None]]}
+
+    for name, value in row.items():
+        if name not in IMPORT_FIELDS:
+            errors[name] = ['Unknown field.']
+            continue
+
+        field = Product._meta.get_field(name)
+        if value == '' and field.null:
+            value = None
+
+        try:
+            values[name] = field.clean(value, None)
+        except ValidationError as e:
+            errors[name] = e.messages
+
+    for name in REQUIRED_FIELDS:
+        if name not in row:
+            errors[name] = ['This field is required.']
+
+    return values, errors
+
+
+class CatalogImport:
+    """
+    Upserts the rows of an upload into the products of a shop. The first max_errors row errors are reported.
+    collation defaults to the NameCollation of the database the products are written to.
+    """
+
+    def __init__(self, shop_id, batch_size=500, max_errors=1000, collation=None):
+        self.shop_id = int(shop_id)
+        self.batch_size = batch_size
+        self.max_errors = max_errors
+        self.collation = collation
+        self.rows = self.created = self.updated = self.superseded = self.failed = 0
+        self.errors = []
+
+    def error(self, row, errors):
+        self.failed += 1
+        if len(self.errors) < self.max_errors:
+            self.errors.append({'row': row, 'errors': errors})
+
+    def run(self, rows):
+        if self.collation is None:
+            self.collation = NameCollation.of(connections[router.db_for_write(Product)])
+
+        batch = []
+        for row in rows:
+            self.rows += 1
+            batch.append((self.rows, row))
+
+            if len(batch) == self.batch_size:
+                self.import_batch(batch)
+                batch = []
+
+        if batch:
+            self.import_batch(batch)
+
+        return self.report()
+
+    def import_batch(self, batch):
+        # {name key: (row number, values)}, a name repeated in the batch keeps the values of its last row
+        products = {}
+        errors = []
+        for number, row in batch:
+            values, row_errors = clean_row(row)
+            if row_errors:
+                errors.append((number, row_errors))
+            else:
+                key = self.collation.key(values['name'])
+                if key in products:
+                    self.superseded += 1
+                products[key] = (number, values)
+
+        if products:
+            try:
+                with transaction.atomic():
+                    created, updated, write_errors = self.write(products)
+            except IntegrityError:
+                # A concurrent writer took one of the names since they were checked, the batch is checked again
+                with transaction.atomic():
+                    created, updated, write_errors = self.write(products)
+
+            self.created += created
+            self.updated += updated
+            errors.extend(write_errors)
+
+        for number, row_errors in sorted(errors, key=lambda error: error[0]):
+            self.error(number, row_errors)
+
+    def existing(self, names):
+        """
+        Returns the (name, pk, shop_id) of the products the database finds under names, in the collation of the column
+        """
+        return Product.objects.filter(name__in=names).values_list('name', 'pk', 'shop_id')
+
+    def write(self, products):
+        new = dict(products)
+        updates = {}
+        errors = []
+        for name, pk, shop_id in self.existing([values['name'] for _, values in products.values()]):
+            # The collation may have matched a name spelled differently, names the key doesn't equate (e.g. accents)
+            # are left to the unique constraint
+            number, values = new.pop(self.collation.key(name), (None, None))
+            if values is None:
+                continue
+
+            if shop_id != self.shop_id:
+                errors.append((number, {'name': ['Product with this name already exists.']}))
+            else:
+                updates[pk] = values
+
+        Product.objects.bulk_create([
+            Product(shop_id=self.shop_id, name=values['name'], description=values.get('description') or '',
+                    price=values['price'], stock=values.get('stock'))
+            for _, values in new.values()
+        ])
+        self.update(updates)
+
+        # SQLite doesn't return the ids of the inserted rows
+        columns = ('pk', 'name', 'description', 'shop_id')
+        created = list(Product.objects.filter(name__in=[values['name'] for _, values in new.values()]).only(*columns))
+        updated = list(Product.objects.filter(pk__in=list(updates)).only(*columns))
+        self.changed(created, updated)
+
+        return len(created), len(updated), errors
+
+    def update(self, updates):
+        """
+        Writes the columns set by the rows of updates ({product_id: values}) with one executemany() per set of
+        columns, the stock isn't touched unless the row sets it
+        """
+        connection = connections[router.db_for_write(Product)]
+        quote = connection.ops.quote_name
+        fields = dict((name, Product._meta.get_field(name)) for name in IMPORT_FIELDS + ('updated_at',))
+        now = fields['updated_at'].get_db_prep_save(timezone.now(), connection)
+
+        statements = {}
+        for pk, values in updates.items():
+            columns = tuple(name for name in IMPORT_FIELDS if name != 'name' and name in values)
+            statements.setdefault(columns, []).append(
+                [fields[name].get_db_prep_save(values[name], connection) for name in columns] + [now, pk]
+            )
+
+        with connection.cursor() as cursor:
+            for columns, params in statements.items():
+                cursor.executemany('UPDATE %s SET %s WHERE %s = %%s' % (
+                    quote(Product._meta.db_table),
+                    ', '.join('%s = %%s' % quote(fields[name].column) for name in columns + ('updated_at',)),
+                    quote(Product._meta.pk.column),
+                ), params)
+
+    def changed(self, created, updated):
+        """
+        Does what the Product signals do for every saved product, once per batch
+        """
+        invalidate_products(self.shop_id, [product.pk for product in updated])
+        Shop.touch(self.shop_id)
+
+        search = get_search_backend()
+        search.index(created, new=True)
+        search.index(updated)
+
+    def report(self):
+        return {
+            'rows': self.rows,
+            'created': self.created,
+            'updated': self.updated,
+            'superseded': self.superseded,
+            'failed': self.failed,
+            'errors': self.errors,
+            'errors_truncated': self.failed > len(self.errors),
+        }
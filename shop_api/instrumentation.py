@@ -0,0 +1,150 @@
+import threading
+import time
+from contextlib import contextmanager
+
+from rest_framework import serializers
+from shop_api.profiling import start_requested_profile
+
+
+# Per-request timing of the phases of the API views.
+#
+# RequestInstrumentationMiddleware creates a RequestTimings for every request and makes it current for the
+# thread handling it. The views, serializers and renderers add their spans to it, the database wrapper
+# records every query. Everything is a no-op outside of an instrumented request.
+
+
+_local = threading.local()
+
+# Only the first statements of a request are kept for the slow request log
+MAX_RECORDED_QUERIES = 100
+
+
+class RequestTimings:
+
+    def __init__(self):
+        self.spans = {}
+        self.query_count = 0
+        self.sql_time = 0.0
+        self.queries = []
+
+    def add(self, name, duration):
+        self.spans[name] = self.spans.get(name, 0.0) + duration
+
+    def record_query(self, execute, sql, params, many, context):
+        """
+        Database execute wrapper, see https://docs.djangoproject.com/en/2.1/topics/db/instrumentation/
+        """
+        started = time.perf_counter()
+        try:
+            return execute(sql, params, many, context)
+        finally:
+            duration = time.perf_counter() - started
+            self.query_count += 1
+            self.sql_time += duration
+            if len(self.queries) < MAX_RECORDED_QUERIES:
+                self.queries.append((sql, duration))
+
+    def server_timing(self, total):
+        """
+        Value of the Server-Timing header, durations are in milliseconds
+        """
+        metrics = ['db;dur=%.2f;desc="%d queries"' % (self.sql_time * 1000, self.query_count)]
+        metrics.extend('%s;dur=%.2f' % (name, duration * 1000) for name, duration in sorted(self.spans.items()))
+        metrics.append('total;dur=%.2f' % (total * 1000))
+        return ', '.join(metrics)
+
+    def slowest_queries(self, limit=20):
+        return [
+            {'sql': sql, 'duration_ms': round(duration * 1000, 3)}
+            for sql, duration in sorted(self.queries, key=lambda query: query[1], reverse=True)[:limit]
+        ]
+
+
+def current_timings():
+    return getattr(_local, 'timings', None)
+
+
+def set_current_timings(timings):
+    _local.timings = timings
+
+
+@contextmanager
+def span(name):
+    """
+    Adds the time spent in the block to the named span of the current request
+    """
+    timings = current_timings()
+    if timings is None:
+        yield
+        return
+
+    started = time.perf_counter()
+    try:
+        yield
+    finally:
+        timings.add(name, time.perf_counter() - started)
+
+
+class TimedRenderer:
+    """
+    Proxy of a DRF renderer timing its render() calls
+    """
+
+    def __init__(self, renderer):
+        self.renderer = renderer
+
+    def __getattr__(self, name):
+        return getattr(self.renderer, name)
+
+    def render(self, *args, **kwargs):
+        with span('render'):
+            return self.renderer.render(*args, **kwargs)
+
+
+class InstrumentedViewMixin:
+    """
+    Times the permission checks and the rendering of a DRF view, and starts the profiles requested by staff users
+    """
+
+    def initial(self, request, *args, **kwargs):
+        super(InstrumentedViewMixin, self).initial(request, *args, **kwargs)
+        # The user is known once DRF authenticated the request
+        start_requested_profile(request)
+
+    def check_permissions(self, request):
+        with span('perm'):
+            super(InstrumentedViewMixin, self).check_permissions(request)
+
+    def check_object_permissions(self, request, obj):
+        with span('perm'):
+            super(InstrumentedViewMixin, self).check_object_permissions(request, obj)
+
+    def finalize_response(self, request, response, *args, **kwargs):
+        response = super(InstrumentedViewMixin, self).finalize_response(request, response, *args, **kwargs)
+
+        # DRF responses are rendered by Django once the view returns, time it through the renderer
+        renderer = getattr(response, 'accepted_renderer', None)
+        if renderer is not None and current_timings() is not None:
+            response.accepted_renderer = TimedRenderer(renderer)
+
+        return response
+
+
+class InstrumentedListSerializer(serializers.ListSerializer):
+
+    @property
+    def data(self):
+        with span('serialize'):
+            return super(InstrumentedListSerializer, self).data
+
+
+class InstrumentedSerializerMixin:
+    """
+    Times the serialization of the representation. Serializers used with many=True should also set
+    list_serializer_class = InstrumentedListSerializer in their Meta.
+    """
+
+    @property
+    def data(self):
+        with span('serialize'):
+            return super(InstrumentedSerializerMixin, self).data
@@ -0,0 +1,106 @@
+from django.db import transaction
+from django.db.models import Case, F, IntegerField, Q, Value, When
+from django.utils import timezone
+from rest_framework import exceptions, status
+from shop_api.cache import invalidate_products
+from shop_api.models import Shop, Product
+
+
+# Stock reservations.
+#
+# Stock is taken with conditional decrements (UPDATE ... SET stock = stock - n WHERE stock >= n) applied atomically
+# by the database. Stock is never read first, so two buyers can't both take the last units, and no lock is held
+# between a read and a write. Callers reserve as the last write of their transaction, which keeps the row lock of a
+# hot product for as little time as possible. Products whose stock is NULL aren't tracked and never run out.
+#
+# The UPDATEs bump the updated_at of the products, which versions their detail. Once the transaction commits, the shop
+# is touched and the cached catalog entries showing the products are invalidated, as the Product signals would.
+
+
+class OutOfStock(exceptions.APIException):
+    status_code = status.HTTP_409_CONFLICT
+    default_detail = 'Not enough stock.'
+    default_code = 'out_of_stock'
+
+
+class _Shortage(Exception):
+    pass
+
+
+def stock_delta(quantities):
+    # Expression of the quantity of each product in quantities ({product_id: quantity})
+    if len(quantities) == 1:
+        return Value(next(iter(quantities.values())))
+
+    return Case(*[When(pk=pk, then=Value(quantity)) for pk, quantity in quantities.items()],
+                default=Value(0), output_field=IntegerField())
+
+
+def stock_changed(shop_id, product_ids):
+    def changed():
+        invalidate_products(shop_id, product_ids)
+        Shop.touch(shop_id)
+
+    transaction.on_commit(changed)
+
+
+def reserve(quantities, shop_id):
+    """
+    Takes quantities ({product_id: quantity}) out of the stock of the products of the shop with id=shop_id with one
+    UPDATE, all or nothing. Raises OutOfStock naming the products without enough stock.
+    """
+    quantities = dict((pk, quantity) for pk, quantity in quantities.items() if quantity > 0)
+    if not quantities:
+        return
+
+    enough = Q()
+    for pk, quantity in quantities.items():
+        enough |= Q(pk=pk) & (Q(stock__isnull=True) | Q(stock__gte=quantity))
+
+    def take():
+        taken = Product.objects.filter(enough).update(
+            stock=F('stock') - stock_delta(quantities), updated_at=timezone.now()
+        )
+        return taken == len(quantities)
+
+    if len(quantities) == 1:
+        taken = take()
+    else:
+        # The rows which had enough stock are put back by rolling back to a savepoint
+        try:
+            with transaction.atomic():
+                if not take():
+                    raise _Shortage()
+            taken = True
+        except _Shortage:
+            taken = False
+
+    if not taken:
+        stock = dict(Product.objects.filter(pk__in=list(quantities)).values_list('pk', 'stock'))
+        short = sorted(pk for pk, quantity in quantities.items()
+                       if pk not in stock or (stock[pk] is not None and stock[pk] < quantity))
+        raise OutOfStock('Not enough stock for products: %s' % ', '.join(str(pk) for pk in short))
+
+    stock_changed(shop_id, list(quantities))
+
+
+def release(quantities, shop_id):
+    """
+    Puts quantities ({product_id: quantity}) back in the stock of the products of the shop with id=shop_id
+    """
+    quantities = dict((pk, quantity) for pk, quantity in quantities.items() if quantity > 0)
+    if quantities:
+        released = Product.objects.filter(pk__in=list(quantities), stock__isnull=False) \
+            .update(stock=F('stock') + stock_delta(quantities), updated_at=timezone.now())
+        if released:
+            stock_changed(shop_id, list(quantities))
+
+
+def quantities(line_items):
+    """
+    Total quantity of each product of a list of line items
+    """
+    totals = {}
+    for item in line_items:
+        totals[item.product_id] = totals.get(item.product_id, 0) + item.quantity
+    return totals
@@ -0,0 +1,40 @@
+import datetime
+
+from django.core.management.base import BaseCommand, CommandError
+from django.utils import timezone
+from shop_api.archive import OrderArchiver, archive_after
+from shop_api.sharding import shards
+
+
+class Command(BaseCommand):
+    help = 'Moves the orders placed more than SHOP_API_ARCHIVE_AFTER_DAYS days ago to the archive of their shard, ' \
+           'in small transactions so that the shops keep taking orders'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--days', type=int, default=None,
+                            help='Archive the orders placed this many days ago or earlier, '
+                                 'defaults to SHOP_API_ARCHIVE_AFTER_DAYS')
+        parser.add_argument('--shop', type=int, action='append', default=None,
+                            help='Only archive the orders of this shop, may be repeated')
+        parser.add_argument('--batch-size', type=int, default=500, help='Number of orders archived per transaction')
+        parser.add_argument('--pause', type=float, default=0.1, help='Seconds to wait between two transactions')
+        parser.add_argument('--quiet', type=float, default=60,
+                            help='Orders changed in the last --quiet seconds are left for the next run')
+
+    def handle(self, *args, **options):
+        if options['days'] is not None and options['days'] < 0:
+            raise CommandError('--days must not be negative')
+
+        age = archive_after() if options['days'] is None else datetime.timedelta(days=options['days'])
+        before = timezone.now() - age
+
+        archived = 0
+        for shard in shards():
+            archiver = OrderArchiver(shard, before, batch_size=options['batch_size'], pause=options['pause'],
+                                     quiet=options['quiet'], log=self.stdout.write)
+            shop_ids = archiver.shops()
+            if options['shop']:
+                shop_ids = shop_ids.filter(pk__in=options['shop'])
+            archived += archiver.run(shop_ids)
+
+        self.stdout.write(self.style.SUCCESS('Archived %d orders placed before %s' % (archived, before.isoformat())))
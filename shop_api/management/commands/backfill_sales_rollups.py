@@ -0,0 +1,94 @@
+from django.core.management.base import BaseCommand
+from django.db import transaction
+from django.db.models import Count, Sum
+from django.db.models.functions import TruncDate
+from shop_api.analytics import NO_SALES, Sales
+from shop_api.archive import archived_sales
+from shop_api.models import Shop, LineItem, ShopDailySales, ProductDailySales, line_items_total
+
+
+def add_sales(rollups, key, sales):
+    rollups[key] = rollups.get(key, NO_SALES) + sales
+
+
+class Command(BaseCommand):
+    help = 'Rebuilds the daily sales rollups of the shops and their products from the line items ' \
+           'and the archived orders'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--shop', type=int, action='append', default=None,
+                            help='Only rebuild the rollups of this shop, may be repeated')
+        parser.add_argument('--batch-size', type=int, default=100,
+                            help='Number of shops rebuilt per transaction')
+
+    def handle(self, *args, **options):
+        shops = Shop.objects.all()
+        if options['shop']:
+            shops = shops.filter(pk__in=options['shop'])
+
+        rebuilt = shop_rows = product_rows = 0
+        last_pk = 0
+
+        while True:
+            batch = list(shops.filter(pk__gt=last_pk).order_by('pk').values_list('pk', 'shard')[:options['batch_size']])
+            if not batch:
+                break
+
+            last_pk = batch[-1][0]
+            shop_ids = [pk for pk, _ in batch]
+
+            # The rollups of a shop are replaced in one transaction, readers never see them half rebuilt
+            with transaction.atomic():
+                ShopDailySales.objects.filter(shop_id__in=shop_ids).delete()
+                ProductDailySales.objects.filter(shop_id__in=shop_ids).delete()
+
+                # {(shop_id, day): Sales} and {(product_id, shop_id, day): Sales}
+                shop_sales = {}
+                product_sales = {}
+                # The line items of each shop are on its shard
+                for shard in sorted(set(shard for _, shard in batch)):
+                    shard_shop_ids = [pk for pk, shop_shard in batch if shop_shard == shard]
+                    line_items = (
+                        LineItem.objects.using(shard)
+                        .filter(order__shop_id__in=shard_shop_ids)
+                        .annotate(day=TruncDate('order__created_at'))
+                        .order_by()
+                    )
+
+                    for row in line_items.values('order__shop_id', 'day').annotate(
+                            sold_revenue=line_items_total(), sold_units=Sum('quantity'),
+                            sold_orders=Count('order', distinct=True)):
+                        add_sales(shop_sales, (row['order__shop_id'], row['day']),
+                                  Sales(row['sold_revenue'], row['sold_units'], row['sold_orders']))
+
+                    for row in line_items.values('order__shop_id', 'product', 'day').annotate(
+                            sold_revenue=line_items_total(), sold_units=Sum('quantity'),
+                            sold_orders=Count('order', distinct=True)):
+                        add_sales(product_sales, (row['product'], row['order__shop_id'], row['day']),
+                                  Sales(row['sold_revenue'], row['sold_units'], row['sold_orders']))
+
+                    # The archived orders are unpacked, a day may have both live and archived orders
+                    archived_shop_sales, archived_product_sales = archived_sales(shard, shard_shop_ids)
+                    for key, sales in archived_shop_sales.items():
+                        add_sales(shop_sales, key, sales)
+                    for key, sales in archived_product_sales.items():
+                        add_sales(product_sales, key, sales)
+
+                ShopDailySales.objects.bulk_create(
+                    ShopDailySales(shop_id=shop_id, day=day, revenue=sales.revenue, units=sales.units,
+                                   orders=sales.orders)
+                    for (shop_id, day), sales in shop_sales.items()
+                )
+                ProductDailySales.objects.bulk_create(
+                    ProductDailySales(product_id=product_id, shop_id=shop_id, day=day, revenue=sales.revenue,
+                                      units=sales.units, orders=sales.orders)
+                    for (product_id, shop_id, day), sales in product_sales.items()
+                )
+
+            rebuilt += len(batch)
+            shop_rows += len(shop_sales)
+            product_rows += len(product_sales)
+
+        self.stdout.write('Rebuilt the sales of %d shops: %d shop days, %d product days' % (
+            rebuilt, shop_rows, product_rows
+        ))
@@ -0,0 +1,146 @@
+import json
+import os
+import random
+import socket
+import subprocess
+import sys
+import time
+
+from django.conf import settings
+from django.core.management.base import BaseCommand, CommandError
+from shop_api import benchmarks
+
+
+class Command(BaseCommand):
+    help = 'Replays a mix of read and write scenarios against the API routes and reports throughput, ' \
+           'p50/p95/p99 latency and SQL queries per request. Writes to the database, use a disposable one.'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--mode', choices=['inprocess', 'gunicorn', 'url'], default='inprocess',
+                            help='Call the WSGI application in-process, boot it under gunicorn with gunicorn.conf.py, '
+                                 'or target an already running server with --url')
+        parser.add_argument('--url', default='http://127.0.0.1:8888')
+        parser.add_argument('--port', type=int, default=8899, help='Port gunicorn binds in gunicorn mode')
+        parser.add_argument('--mix', default=benchmarks.DEFAULT_MIX,
+                            help='Scenario weights, from: %s' % ', '.join(sorted(benchmarks.SCENARIOS)))
+        parser.add_argument('--duration', type=float, default=30, help='Seconds of measured load')
+        parser.add_argument('--warmup', type=float, default=3, help='Seconds of unmeasured load before measuring')
+        parser.add_argument('--concurrency', type=int, default=1, help='Number of concurrent clients')
+        parser.add_argument('--seed', type=int, default=0)
+        parser.add_argument('--output', default=None,
+                            help='Result file, defaults to benchmark_results/<timestamp>-<commit>.json')
+        parser.add_argument('--compare', default=None, help='Previous result file to compare this run against')
+
+    def handle(self, *args, **options):
+        try:
+            mix = benchmarks.parse_mix(options['mix'])
+            data = benchmarks.BenchmarkData(random.Random(options['seed']))
+        except ValueError as e:
+            raise CommandError(str(e))
+
+        users = set(owner for _, owner in data.shops) | set(data.buyer_ids) | set(data.staff_ids)
+        sessions = dict((user_id, benchmarks.create_session(user_id)) for user_id in users)
+
+        server = None
+        if options['mode'] == 'inprocess':
+            client = benchmarks.InProcessClient()
+        elif options['mode'] == 'gunicorn':
+            server = self.start_gunicorn(options['port'])
+            client = benchmarks.HTTPClient('http://127.0.0.1:%d' % options['port'])
+        else:
+            client = benchmarks.HTTPClient(options['url'])
+
+        try:
+            if options['warmup'] > 0:
+                benchmarks.Benchmark(client, data, mix, sessions, seed=options['seed']).run(
+                    options['warmup'], options['concurrency']
+                )
+
+            results = benchmarks.Benchmark(client, data, mix, sessions, seed=options['seed']).run(
+                options['duration'], options['concurrency']
+            )
+        finally:
+            if server is not None:
+                server.terminate()
+                server.wait()
+
+        report = {
+            'meta': {
+                'commit': git_commit(),
+                'timestamp': time.strftime('%Y-%m-%dT%H:%M:%SZ', time.gmtime()),
+                'mode': options['mode'],
+                'mix': options['mix'],
+                'duration': options['duration'],
+                'concurrency': options['concurrency'],
+                'seed': options['seed'],
+                'database': settings.DATABASES['default']['ENGINE'],
+                'python': sys.version.split()[0],
+            },
+            'results': results,
+        }
+
+        self.print_results(results)
+
+        output = options['output'] or os.path.join(
+            'benchmark_results', '%s-%s.json' % (time.strftime('%Y%m%d-%H%M%S'), report['meta']['commit'] or 'unknown')
+        )
+        if os.path.dirname(output):
+            os.makedirs(os.path.dirname(output), exist_ok=True)
+        with open(output, 'w') as f:
+            json.dump(report, f, indent=2, sort_keys=True)
+        self.stdout.write('Results saved to %s' % output)
+
+        if options['compare']:
+            with open(options['compare']) as f:
+                self.print_comparison(json.load(f), report)
+
+    def start_gunicorn(self, port):
+        command = [
+            sys.executable, '-m', 'gunicorn', '-c', os.path.join(settings.BASE_DIR, 'gunicorn.conf.py'),
+            '--bind', '127.0.0.1:%d' % port, 'shopify_challenge.wsgi:application',
+        ]
+        server = subprocess.Popen(command, cwd=settings.BASE_DIR)
+
+        deadline = time.time() + 30
+        while time.time() < deadline:
+            if server.poll() is not None:
+                raise CommandError('gunicorn exited with status %s' % server.returncode)
+            try:
+                socket.create_connection(('127.0.0.1', port), timeout=1).close()
+                return server
+            except OSError:
+                time.sleep(0.2)
+
+        server.terminate()
+        raise CommandError('gunicorn did not start listening on port %d' % port)
+
+    def print_results(self, results):
+        row = '%-36s %8s %7s %10s %9s %9s %9s %8s'
+        self.stdout.write(row % ('route', 'requests', 'errors', 'req/s', 'p50 ms', 'p95 ms', 'p99 ms', 'queries'))
+
+        for route, stats in sorted(results['routes'].items()) + [('total', results['total'])]:
+            latency = stats['latency_ms']
+            self.stdout.write(row % (
+                route, stats['requests'], stats['errors'], stats['throughput'],
+                fmt(latency['p50']), fmt(latency['p95']), fmt(latency['p99']), fmt(stats['queries']['mean'])
+            ))
+
+    def print_comparison(self, baseline, report):
+        self.stdout.write('\nCompared to %s (%s)' % (baseline['meta']['commit'], baseline['meta']['timestamp']))
+        for route, metric, old, new, change in benchmarks.compare(baseline, report):
+            self.stdout.write('%-36s %-10s %10s -> %-10s %s' % (
+                route, metric, fmt(old), fmt(new), '%+.1f%%' % (change * 100) if change is not None else ''
+            ))
+
+
+def fmt(value):
+    return '-' if value is None else '%.2f' % value
+
+
+def git_commit():
+    try:
+        return subprocess.check_output(
+            ['git', 'rev-parse', '--short', 'HEAD'], cwd=settings.BASE_DIR, stderr=subprocess.DEVNULL
+        ).decode().strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
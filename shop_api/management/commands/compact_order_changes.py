@@ -0,0 +1,40 @@
+import datetime
+
+from django.conf import settings
+from django.core.management.base import BaseCommand
+from django.utils import timezone
+from shop_api.changes import ChangeFeedCompactor
+from shop_api.sharding import shards
+
+
+class Command(BaseCommand):
+    help = 'Drops the events of the order change feeds superseded by a later event of the same order or line item, ' \
+           'and the events past the retention'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--retention-days', type=float,
+                            default=getattr(settings, 'SHOP_API_CHANGE_FEED_RETENTION_DAYS', 7),
+                            help='Days the events are kept, the cursors from before expire')
+        parser.add_argument('--compact-after', type=float,
+                            default=getattr(settings, 'SHOP_API_CHANGE_FEED_COMPACT_AFTER', 3600),
+                            help='Seconds the superseded events are kept for the consumers keeping up with the feed')
+        parser.add_argument('--shop', type=int, action='append', default=None,
+                            help='Only compact the feed of this shop, may be repeated')
+        parser.add_argument('--batch-size', type=int, default=1000, help='Number of events dropped per statement')
+        parser.add_argument('--pause', type=float, default=0.1, help='Seconds to wait between two statements')
+
+    def handle(self, *args, **options):
+        now = timezone.now()
+        compact_before = now - datetime.timedelta(seconds=options['compact_after'])
+        purge_before = now - datetime.timedelta(days=options['retention_days'])
+
+        dropped = 0
+        for shard in shards():
+            compactor = ChangeFeedCompactor(shard, compact_before, purge_before, batch_size=options['batch_size'],
+                                            pause=options['pause'], log=self.stdout.write)
+            shop_ids = compactor.shops()
+            if options['shop']:
+                shop_ids = shop_ids.filter(pk__in=options['shop'])
+            dropped += compactor.run(shop_ids)
+
+        self.stdout.write(self.style.SUCCESS('Dropped %d events' % dropped))
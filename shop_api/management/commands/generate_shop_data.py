@@ -0,0 +1,204 @@
+import bisect
+import datetime
+import math
+import random
+from array import array
+from decimal import Decimal
+
+from django.contrib.auth.hashers import make_password
+from django.contrib.auth.models import User
+from django.core.management import call_command
+from django.core.management.base import BaseCommand, CommandError
+from django.core.management.color import no_style
+from django.db import connection, transaction
+from django.db.models import Max
+from django.utils import timezone
+from shop_api.models import Shop, Product, Order, LineItem
+
+
+class Command(BaseCommand):
+    help = 'Generates a large, deterministic synthetic data set of users, shops, products, orders and line items'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--users', type=int, default=100)
+        parser.add_argument('--shops', type=int, default=100)
+        parser.add_argument('--products', type=int, default=1000,
+                            help='Total number of products, spread evenly over the shops')
+        parser.add_argument('--orders', type=int, default=1000)
+        parser.add_argument('--items-per-order', type=float, default=5,
+                            help='Mean number of line items per order')
+        parser.add_argument('--order-skew', type=float, default=1.1,
+                            help='Zipf exponent of the number of orders per shop, 0 spreads them evenly')
+        parser.add_argument('--item-skew', type=float, default=1.0,
+                            help='Log-normal sigma of the number of items per order, 0 gives every order the mean')
+        parser.add_argument('--days', type=int, default=90,
+                            help='Orders are placed uniformly over this many days up to now')
+        parser.add_argument('--seed', type=int, default=0)
+        parser.add_argument('--batch-size', type=int, default=None,
+                            help='Rows per INSERT statement, defaults to the largest batch the database accepts')
+        parser.add_argument('--transaction-size', type=int, default=50000,
+                            help='Rows committed per transaction')
+
+    def handle(self, *args, **options):
+        if options['users'] < 1 or options['shops'] < 1 or options['products'] < options['shops']:
+            raise CommandError('At least one user, one shop and one product per shop are required')
+
+        self.options = options
+        self.rng = random.Random(options['seed'])
+
+        # Ids are assigned here rather than by the database so that rows can reference each other
+        # without reading back the primary keys of the bulk inserts
+        self.user_ids = self.generate_users()
+        self.shop_ids = self.generate_shops()
+        self.generate_products()
+        self.generate_orders()
+
+        with connection.cursor() as cursor:
+            for sql in connection.ops.sequence_reset_sql(no_style(), [User, Shop, Product, Order, LineItem]):
+                cursor.execute(sql)
+
+        # The bulk inserts bypass the incremental maintenance of the sales rollups and of the search index
+        call_command('backfill_sales_rollups', shop=list(self.shop_ids), stdout=self.stdout)
+        call_command('rebuild_search_index', stdout=self.stdout)
+
+    def first_id(self, model):
+        return (model.objects.aggregate(last=Max('pk'))['last'] or 0) + 1
+
+    def insert(self, model, objects):
+        """
+        Bulk inserts objects, committing every transaction-size rows
+        """
+        count = 0
+        chunk = []
+
+        for obj in objects:
+            chunk.append(obj)
+            if len(chunk) >= self.options['transaction_size']:
+                count += self.commit(model, chunk)
+                chunk = []
+
+        count += self.commit(model, chunk)
+        self.stdout.write('Created %d %s' % (count, model._meta.verbose_name_plural))
+
+    def commit(self, model, objects):
+        with transaction.atomic():
+            model.objects.bulk_create(objects, batch_size=self.options['batch_size'])
+        return len(objects)
+
+    def generate_users(self):
+        first = self.first_id(User)
+        ids = range(first, first + self.options['users'])
+
+        # Hashing is deliberately slow, every generated user shares the fixtures' password
+        password = make_password('ShopifyChallenge')
+        self.insert(User, (User(pk=pk, username='generated_user_%d' % pk, password=password) for pk in ids))
+        return ids
+
+    def generate_shops(self):
+        first = self.first_id(Shop)
+        ids = range(first, first + self.options['shops'])
+
+        self.insert(Shop, (
+            Shop(pk=pk, name='Generated Shop %d' % pk, owner_id=self.rng.choice(self.user_ids)) for pk in ids
+        ))
+        return ids
+
+    def generate_products(self):
+        shops = len(self.shop_ids)
+        per_shop, remainder = divmod(self.options['products'], shops)
+
+        # Shop i owns the contiguous product ids [product_starts[i], product_starts[i + 1])
+        first = self.first_id(Product)
+        self.product_starts = array('q', [first])
+        for i in range(shops):
+            self.product_starts.append(self.product_starts[-1] + per_shop + (1 if i < remainder else 0))
+
+        # Prices in cents, kept around to snapshot them in the line items
+        self.product_prices = array('q', (self.rng.randint(100, 50000) for _ in range(self.options['products'])))
+
+        def products():
+            for i, shop_id in enumerate(self.shop_ids):
+                for pk in range(self.product_starts[i], self.product_starts[i + 1]):
+                    yield Product(
+                        pk=pk, shop_id=shop_id, name='Generated Product %d' % pk,
+                        description='Synthetic product %d of shop %d' % (pk, shop_id),
+                        price=cents(self.product_prices[pk - first])
+                    )
+
+        self.insert(Product, products())
+
+    def order_shop_weights(self):
+        """
+        Cumulative Zipf weights of the shops, shop of rank r receives orders in proportion to 1 / r^skew
+        """
+        skew = self.options['order_skew']
+        ranks = list(range(1, len(self.shop_ids) + 1))
+        self.rng.shuffle(ranks)
+
+        cumulative = []
+        total = 0.0
+        for rank in ranks:
+            total += 1.0 / rank ** skew
+            cumulative.append(total)
+        return cumulative
+
+    def items_in_order(self):
+        mean = self.options['items_per_order']
+        sigma = self.options['item_skew']
+        if sigma <= 0:
+            return max(1, int(round(mean)))
+
+        # Log-normal with the requested mean, a few orders get very large
+        mu = math.log(mean) - sigma ** 2 / 2
+        return max(1, int(round(self.rng.lognormvariate(mu, sigma))))
+
+    def generate_orders(self):
+        cumulative = self.order_shop_weights()
+        first_order = self.first_id(Order)
+        first_product = self.product_starts[0]
+        next_line_item = self.first_id(LineItem)
+
+        orders_left = self.options['orders']
+        order_count = item_count = 0
+        now = timezone.now()
+        period = self.options['days'] * 86400
+        pk = first_order
+
+        while orders_left:
+            # Orders and their line items are committed together, bounding memory by the transaction size
+            orders = []
+            line_items = []
+
+            while orders_left and len(orders) + len(line_items) < self.options['transaction_size']:
+                shop = bisect.bisect_left(cumulative, self.rng.random() * cumulative[-1])
+                start, end = self.product_starts[shop], self.product_starts[shop + 1]
+
+                total = 0
+                for _ in range(self.items_in_order()):
+                    product_id = self.rng.randrange(start, end)
+                    quantity = self.rng.randint(1, 10)
+                    price = self.product_prices[product_id - first_product]
+                    total += price * quantity
+
+                    line_items.append(LineItem(
+                        pk=next_line_item, order_id=pk, product_id=product_id, quantity=quantity, price=cents(price)
+                    ))
+                    next_line_item += 1
+
+                created_at = now - datetime.timedelta(seconds=self.rng.randrange(period) if period > 0 else 0)
+                orders.append(Order(pk=pk, shop_id=self.shop_ids[shop], client_id=self.rng.choice(self.user_ids),
+                                    total=cents(total), created_at=created_at))
+                pk += 1
+                orders_left -= 1
+
+            with transaction.atomic():
+                Order.objects.bulk_create(orders, batch_size=self.options['batch_size'])
+                LineItem.objects.bulk_create(line_items, batch_size=self.options['batch_size'])
+
+            order_count += len(orders)
+            item_count += len(line_items)
+            self.stdout.write('Created %d orders, %d line items' % (order_count, item_count))
+
+
+def cents(amount):
+    return Decimal(amount) / 100
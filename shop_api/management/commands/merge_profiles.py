@@ -0,0 +1,48 @@
+import glob
+import os
+from collections import Counter
+
+from django.core.management.base import BaseCommand, CommandError
+from shop_api.profiling import route_dir, read_collapsed, write_collapsed
+
+
+class Command(BaseCommand):
+    help = 'Merges the request profiles of one route into a single collapsed stack file, ready for flamegraph.pl'
+
+    def add_arguments(self, parser):
+        parser.add_argument('route', help='View name of the route, e.g. shop_api:lineitems-listcreate')
+        parser.add_argument('--output', default=None,
+                            help='File to write the merged stacks to, defaults to stdout')
+        parser.add_argument('--latest', type=int, default=None,
+                            help='Only merge the most recent profiles')
+        parser.add_argument('--top', type=int, default=0,
+                            help='Also print the functions with the most samples on top of the stack')
+
+    def handle(self, *args, **options):
+        # Profile names start with their timestamp
+        paths = sorted(glob.glob(os.path.join(route_dir(options['route']), '*.collapsed')))
+        if options['latest']:
+            paths = paths[-options['latest']:]
+        if not paths:
+            raise CommandError('No profiles of %s' % options['route'])
+
+        stacks = Counter()
+        for path in paths:
+            with open(path) as stream:
+                read_collapsed(stream, stacks)
+
+        if options['output']:
+            with open(options['output'], 'w') as stream:
+                write_collapsed(stacks, stream)
+        else:
+            write_collapsed(stacks, self.stdout)
+
+        samples = sum(stacks.values())
+        self.stderr.write('Merged %d profiles, %d samples' % (len(paths), samples))
+
+        if options['top']:
+            leaves = Counter()
+            for stack, count in stacks.items():
+                leaves[stack.rpartition(';')[2]] += count
+            for frame, count in leaves.most_common(options['top']):
+                self.stderr.write('%6.2f%%  %s' % (100.0 * count / samples, frame))
@@ -0,0 +1,38 @@
+from django.core.management.base import BaseCommand, CommandError
+from shop_api.models import Shop
+from shop_api.sharding import MoveFailed, ShopMove, shards
+
+
+class Command(BaseCommand):
+    help = 'Moves the orders and line items of a shop to another shard while it keeps taking orders, ' \
+           'writes to its orders are refused for about --grace seconds'
+
+    def add_arguments(self, parser):
+        parser.add_argument('shop', type=int, help='Id of the shop to move')
+        parser.add_argument('shard', help='Database alias of the shard to move it to')
+        parser.add_argument('--batch-size', type=int, default=1000, help='Number of orders copied per transaction')
+        parser.add_argument('--grace', type=float, default=10,
+                            help='Seconds the requests in flight are given to finish before the copy is completed '
+                                 'and before the source rows are deleted')
+
+    def handle(self, *args, **options):
+        if options['shard'] not in shards():
+            raise CommandError('Unknown shard %s, the shards are %s' % (options['shard'], ', '.join(shards())))
+
+        try:
+            shop = Shop.objects.get(pk=options['shop'])
+        except Shop.DoesNotExist:
+            raise CommandError('Shop %d doesn\'t exist' % options['shop'])
+
+        move = ShopMove(shop, options['shard'], batch_size=options['batch_size'], grace=options['grace'],
+                        log=self.stdout.write)
+        try:
+            orders, _, line_items, _, archived_orders, _ = move.run()
+        except MoveFailed as e:
+            raise CommandError(str(e))
+
+        self.stdout.write(self.style.SUCCESS(
+            'Moved %d orders, %d line items and %d archived orders of shop %d to %s' % (
+                orders, line_items, archived_orders, shop.pk, options['shard']
+            )
+        ))
@@ -0,0 +1,10 @@
+from django.core.management.base import BaseCommand
+from shop_api.search import get_search_backend
+
+
+class Command(BaseCommand):
+    help = 'Rebuilds the product search index from the product table'
+
+    def handle(self, *args, **options):
+        get_search_backend().rebuild()
+        self.stdout.write('Rebuilt the product search index')
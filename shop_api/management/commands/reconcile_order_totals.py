@@ -0,0 +1,69 @@
+from django.core.management.base import BaseCommand
+from django.db import transaction
+from django.db.models import F, OuterRef, Subquery, DecimalField
+from django.db.models.functions import Coalesce
+from shop_api.models import Order, LineItem, line_items_total
+from shop_api.sharding import shards
+
+
+class Command(BaseCommand):
+    help = 'Recomputes Order.total from the line items and fixes the orders whose stored total has drifted'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--batch-size', type=int, default=1000,
+                            help='Number of orders checked per transaction')
+        parser.add_argument('--shop', type=int, default=None,
+                            help='Only reconcile the orders of this shop')
+        parser.add_argument('--dry-run', action='store_true',
+                            help='Report drifted orders without fixing them')
+
+    def handle(self, *args, **options):
+        batch_size = options['batch_size']
+
+        # Correlated subquery computing the real total of each order in SQL
+        computed_total = Coalesce(Subquery(
+            LineItem.objects.filter(order=OuterRef('pk'))
+            .order_by()
+            .values('order')
+            .annotate(total=line_items_total())
+            .values('total'),
+            output_field=DecimalField(max_digits=19, decimal_places=2)
+        ), 0)
+
+        checked = drifted = 0
+
+        for shard in shards():
+            orders = Order.objects.using(shard)
+            if options['shop'] is not None:
+                orders = orders.filter(shop_id=options['shop'])
+            last_pk = 0
+
+            while True:
+                batch = list(orders.filter(pk__gt=last_pk).order_by('pk').values_list('pk', flat=True)[:batch_size])
+                if not batch:
+                    break
+
+                last_pk = batch[-1]
+                checked += len(batch)
+
+                with transaction.atomic(using=shard):
+                    stale = (
+                        Order.objects.using(shard).filter(pk__in=batch)
+                        .annotate(computed_total=computed_total)
+                        .exclude(total=F('computed_total'))
+                    )
+
+                    if options['dry_run']:
+                        rows = list(stale.values_list('pk', 'total', 'computed_total'))
+                        for order_id, total, real_total in rows:
+                            self.stdout.write('Order %s: stored %s, computed %s' % (order_id, total, real_total))
+                        drifted += len(rows)
+                    else:
+                        stale_ids = list(stale.values_list('pk', flat=True))
+                        if stale_ids:
+                            drifted += Order.objects.using(shard).filter(pk__in=stale_ids).update(
+                                total=computed_total
+                            )
+
+        action = 'Found' if options['dry_run'] else 'Fixed'
+        self.stdout.write(self.style.SUCCESS('Checked %d orders. %s %d drifted totals.' % (checked, action, drifted)))
@@ -0,0 +1,78 @@
+import multiprocessing
+import signal
+import time
+
+from django.conf import settings
+from django.core.management.base import BaseCommand
+from django.db import connections
+from prometheus_client import multiprocess
+from shop_api.metrics import multiprocess_mode
+from shop_api.tasks import Worker
+
+
+class Command(BaseCommand):
+    help = 'Runs the background tasks in a pool of worker processes, restarting the processes which die. ' \
+           'SIGTERM and SIGINT stop the workers once their task in progress finished.'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--processes', type=int, default=getattr(settings, 'SHOP_API_TASK_WORKERS', 2),
+                            help='Number of worker processes, 1 runs the tasks in this process')
+        parser.add_argument('--poll', type=float, default=1, help='Seconds between two polls of an empty queue')
+        parser.add_argument('--burst', action='store_true', help='Stop once no task is due')
+
+    def handle(self, *args, **options):
+        if options['processes'] <= 1:
+            attempts = self.work(options)
+            self.stdout.write(self.style.SUCCESS('Ran %d task attempts' % attempts))
+            return
+
+        # The children would share the connections of the parent
+        connections.close_all()
+
+        processes = {}
+        stopping = []
+
+        def stop(signum, frame):
+            stopping.append(signum)
+            for process in processes.values():
+                if process.is_alive():
+                    process.terminate()
+
+        signal.signal(signal.SIGTERM, stop)
+        signal.signal(signal.SIGINT, stop)
+
+        for index in range(options['processes']):
+            processes[index] = self.start(options)
+
+        while processes:
+            time.sleep(0.5)
+            for index, process in list(processes.items()):
+                if process.is_alive():
+                    continue
+
+                if multiprocess_mode():
+                    multiprocess.mark_process_dead(process.pid)
+                del processes[index]
+
+                # Burst workers exit once the queue is drained
+                if not stopping and process.exitcode != 0:
+                    self.stderr.write('Worker %d exited with %s, restarting it' % (process.pid, process.exitcode))
+                    processes[index] = self.start(options)
+
+        self.stdout.write(self.style.SUCCESS('Stopped %d workers' % options['processes']))
+
+    def start(self, options):
+        process = multiprocessing.Process(target=self.work, args=(options,), daemon=True)
+        process.start()
+        self.stdout.write('Started worker %d' % process.pid)
+        return process
+
+    def work(self, options):
+        worker = Worker(poll=options['poll'], burst=options['burst'], log=self.stderr.write)
+
+        def stop(signum, frame):
+            worker.stop()
+
+        signal.signal(signal.SIGTERM, stop)
+        signal.signal(signal.SIGINT, stop)
+        return worker.run()
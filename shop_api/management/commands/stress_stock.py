@@ -0,0 +1,51 @@
+import json
+
+from django.contrib.auth import get_user_model
+from django.core.management.base import BaseCommand, CommandError
+from shop_api import benchmarks
+from shop_api.models import Product
+
+
+class Command(BaseCommand):
+    help = 'Puts the stock of one product on sale to many concurrent buyers, checks that it is never oversold and ' \
+           'reports the checkout throughput. Writes to the database, use a disposable one.'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--product', type=int, default=None, help='Product on sale, defaults to the first one')
+        parser.add_argument('--stock', type=int, default=1000, help='Units put on sale')
+        parser.add_argument('--quantity', type=int, default=1, help='Units bought by every order')
+        parser.add_argument('--buyers', type=int, default=50, help='Number of concurrent buyers')
+        parser.add_argument('--url', default=None,
+                            help='Send the requests to a running server (e.g. gunicorn) rather than in-process')
+        parser.add_argument('--json', action='store_true', help='Print the results as JSON')
+
+    def handle(self, *args, **options):
+        product_id = options['product'] or Product.objects.order_by('pk').values_list('pk', flat=True).first()
+        if product_id is None or not Product.objects.filter(pk=product_id).exists():
+            raise CommandError('No product to put on sale, load the fixtures or run generate_shop_data first')
+
+        buyer_ids = list(
+            get_user_model().objects.filter(is_active=True).order_by('pk').values_list('pk', flat=True)[:options['buyers']]
+        )
+        if not buyer_ids:
+            raise CommandError('The database has no users')
+        # Buyers may share accounts, each still places its own orders
+        buyer_ids = [buyer_ids[i % len(buyer_ids)] for i in range(options['buyers'])]
+
+        client = benchmarks.HTTPClient(options['url']) if options['url'] else benchmarks.InProcessClient()
+        results = benchmarks.FlashSale(client, product_id, options['stock'], options['quantity']).run(buyer_ids)
+
+        if options['json']:
+            self.stdout.write(json.dumps(results, indent=2, sort_keys=True))
+        else:
+            self.stdout.write(
+                '%(buyers)d buyers sold %(sold)d of %(stock)d units in %(orders)d orders, %(remaining)d left, '
+                '%(sold_out)d sold out responses' % results
+            )
+            self.stdout.write('%.2f checkouts/s, %.2f requests/s, latency p50 %.2f ms p99 %.2f ms, %d errors' % (
+                results['checkouts_per_second'] or 0, results['throughput'] or 0,
+                results['latency_ms']['p50'], results['latency_ms']['p99'], results['errors']
+            ))
+
+        if not results['consistent']:
+            raise CommandError('The stock and the units sold disagree')
@@ -0,0 +1,51 @@
+import sqlite3
+import time
+
+from django.conf import settings
+from django.core.management.base import BaseCommand, CommandError
+from django.db import DEFAULT_DB_ALIAS, connections
+
+
+class Command(BaseCommand):
+    help = 'Copies the SQLite primary database to the SQLite files standing in for the read replicas, ' \
+           'once or every --interval seconds to simulate the replication lag'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--interval', type=float, default=0,
+                            help='Seconds between two copies, the primary is copied once when 0')
+
+    def handle(self, *args, **options):
+        replicas = getattr(settings, 'SHOP_API_READ_REPLICAS', [])
+        if not replicas:
+            raise CommandError('No replica is configured, list their files in API_DATABASE_REPLICAS')
+
+        for alias in [DEFAULT_DB_ALIAS] + replicas:
+            if connections[alias].vendor != 'sqlite':
+                raise CommandError('%s isn\'t an SQLite database' % alias)
+
+        if not hasattr(sqlite3.Connection, 'backup'):
+            raise CommandError('Copying SQLite databases needs Python 3.7 or later')
+
+        while True:
+            started = time.perf_counter()
+            self.sync(replicas)
+            self.stdout.write('Copied the primary to %d replicas in %.2fs' % (
+                len(replicas), time.perf_counter() - started
+            ))
+
+            if not options['interval']:
+                break
+            time.sleep(options['interval'])
+
+    def sync(self, replicas):
+        primary = sqlite3.connect(settings.DATABASES[DEFAULT_DB_ALIAS]['NAME'])
+        try:
+            for alias in replicas:
+                # The backup API writes in place, the connections the server keeps open see the new copy
+                replica = sqlite3.connect(settings.DATABASES[alias]['NAME'])
+                try:
+                    primary.backup(replica)
+                finally:
+                    replica.close()
+        finally:
+            primary.close()
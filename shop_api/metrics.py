@@ -0,0 +1,141 @@
+import os
+import threading
+from collections import deque
+
+from prometheus_client import CollectorRegistry, Counter, Histogram, REGISTRY, generate_latest
+from prometheus_client import multiprocess
+
+
+# Prometheus metrics of the API.
+#
+# Under gunicorn every worker records its metrics in its own memory mapped files of the prometheus_multiproc_dir
+# directory (see gunicorn.conf.py). Recording a sample only writes to the files of the worker, workers never wait
+# on each other, and a scrape of any worker merges the files of all of them. Without the directory (runserver,
+# tests) the metrics live in the memory of the process. The run_workers processes write their task metrics to the
+# same directory when it is set.
+#
+# In multiprocess mode prometheus_client guards the values of the whole process with a single lock, which the threads
+# of a threaded worker would contend for. The samples of a request are queued instead, appending to a deque takes no
+# lock, and written by flush() once the response was sent (request_finished) or before a scrape.
+
+
+def multiprocess_mode():
+    return 'prometheus_multiproc_dir' in os.environ
+
+
+REQUESTS = Counter(
+    'shop_api_requests_total', 'Requests handled, by route, method and status',
+    ['route', 'method', 'status']
+)
+
+REQUEST_DURATION = Histogram(
+    'shop_api_request_duration_seconds', 'Time to produce the response, by route and method',
+    ['route', 'method'],
+    buckets=(.005, .01, .025, .05, .075, .1, .25, .5, .75, 1.0, 2.5, 5.0, 10.0)
+)
+
+DB_QUERIES = Histogram(
+    'shop_api_db_queries', 'SQL statements executed per request, by route',
+    ['route'],
+    buckets=(0, 1, 2, 3, 4, 5, 7, 10, 15, 20, 30, 50, 100)
+)
+
+DB_DURATION = Histogram(
+    'shop_api_db_duration_seconds', 'Time spent in SQL per request, by route',
+    ['route'],
+    buckets=(.001, .0025, .005, .01, .025, .05, .1, .25, .5, 1.0, 2.5)
+)
+
+CATALOG_CACHE_REQUESTS = Counter(
+    'shop_api_catalog_cache_requests_total', 'Catalog cache lookups, by route and result (hit or miss)',
+    ['route', 'result']
+)
+
+CATALOG_CACHE_EVICTIONS = Counter(
+    'shop_api_catalog_cache_evictions_total', 'Entries dropped from the in-process catalog caches, by reason',
+    ['reason']
+)
+
+TASKS = Counter(
+    'shop_api_tasks_total', 'Task attempts run by the workers, by task and outcome (done, retried or failed)',
+    ['task', 'outcome']
+)
+
+TASK_LATENCY = Histogram(
+    'shop_api_task_latency_seconds', 'Time a task waited between being due and a worker starting it, by task',
+    ['task'],
+    buckets=(.01, .05, .1, .25, .5, 1.0, 2.5, 5.0, 10.0, 30.0, 60.0, 300.0, 900.0)
+)
+
+TASK_DURATION = Histogram(
+    'shop_api_task_duration_seconds', 'Time to run a task attempt, by task',
+    ['task'],
+    buckets=(.01, .05, .1, .25, .5, 1.0, 2.5, 5.0, 10.0, 30.0, 60.0, 300.0)
+)
+
+
+# Queued (metric, label values, method, value) samples
+_pending = deque()
+_flushing = threading.Lock()
+
+# Processes which don't send request_finished, e.g. run_workers, write the queue once it grows that long
+MAX_PENDING = 10000
+
+
+def record(metric, labels, method='inc', value=1):
+    """
+    Queues metric.labels(*labels).method(value), e.g. the inc() of a Counter or the observe() of a Histogram
+    """
+    _pending.append((metric, labels, method, value))
+    if len(_pending) >= MAX_PENDING:
+        flush()
+
+
+def flush():
+    """
+    Writes the queued samples, unless another thread of the process is already writing them
+    """
+    if not _flushing.acquire(blocking=False):
+        return
+
+    try:
+        while True:
+            try:
+                metric, labels, method, value = _pending.popleft()
+            except IndexError:
+                return
+            getattr(metric.labels(*labels), method)(value)
+    finally:
+        _flushing.release()
+
+
+def route_of(request):
+    match = getattr(request, 'resolver_match', None)
+    return match.view_name if match else 'unmatched'
+
+
+def observe_request(request, response, timings, total):
+    """
+    Records a request instrumented by RequestInstrumentationMiddleware
+    """
+    route = route_of(request)
+
+    record(REQUESTS, (route, request.method, str(response.status_code)))
+    record(REQUEST_DURATION, (route, request.method), 'observe', total)
+    record(DB_QUERIES, (route,), 'observe', timings.query_count)
+    record(DB_DURATION, (route,), 'observe', timings.sql_time)
+
+
+def exposition():
+    """
+    Metrics of every worker of the pool in the Prometheus text format
+    """
+    flush()
+
+    if multiprocess_mode():
+        registry = CollectorRegistry()
+        multiprocess.MultiProcessCollector(registry)
+    else:
+        registry = REGISTRY
+
+    return generate_latest(registry)
@@ -0,0 +1,65 @@
+import json
+import logging
+import time
+from contextlib import ExitStack
+
+from django.conf import settings
+from django.db import connections
+from shop_api import metrics
+from shop_api.instrumentation import RequestTimings, set_current_timings
+
+
+slow_request_logger = logging.getLogger('shop_api.slow_requests')
+
+
+class RequestInstrumentationMiddleware:
+    """
+    Records the query count, SQL time and the time spent in the permissions, serializers and renderers
+    of every request, reports them in the Server-Timing response header and records them in the Prometheus metrics.
+
+    Requests slower than SHOP_API_SLOW_REQUEST_MS are logged to the shop_api.slow_requests logger
+    as a JSON document including their slowest SQL statements. The time long polls spend waiting doesn't count.
+    """
+
+    def __init__(self, get_response):
+        self.get_response = get_response
+        self.slow_request_ms = getattr(settings, 'SHOP_API_SLOW_REQUEST_MS', 500)
+
+    def __call__(self, request):
+        timings = RequestTimings()
+        set_current_timings(timings)
+        started = time.perf_counter()
+
+        try:
+            with ExitStack() as stack:
+                for connection in connections.all():
+                    stack.enter_context(connection.execute_wrapper(timings.record_query))
+                response = self.get_response(request)
+        finally:
+            set_current_timings(None)
+
+        total = time.perf_counter() - started
+        response['Server-Timing'] = timings.server_timing(total)
+        metrics.observe_request(request, response, timings, total)
+
+        if (total - timings.spans.get('wait', 0)) * 1000 >= self.slow_request_ms:
+            self.log_slow_request(request, response, timings, total)
+
+        return response
+
+    def log_slow_request(self, request, response, timings, total):
+        match = getattr(request, 'resolver_match', None)
+        user = getattr(request, 'user', None)
+
+        slow_request_logger.warning(json.dumps({
+            'method': request.method,
+            'path': request.get_full_path(),
+            'route': match.view_name if match else None,
+            'status': response.status_code,
+            'user': user.pk if user is not None and user.is_authenticated else None,
+            'duration_ms': round(total * 1000, 3),
+            'query_count': timings.query_count,
+            'sql_ms': round(timings.sql_time * 1000, 3),
+            'spans_ms': dict((name, round(duration * 1000, 3)) for name, duration in timings.spans.items()),
+            'slowest_queries': timings.slowest_queries(),
+        }, sort_keys=True))
@@ -0,0 +1,25 @@
+# Generated by Django 2.1.1 on 2026-10-18 09:17
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('shop_api', '0005_order_total'),
+    ]
+
+    operations = [
+        migrations.AddIndex(
+            model_name='lineitem',
+            index=models.Index(fields=['order', 'id'], name='shop_api_li_order_i_3fdb37_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='order',
+            index=models.Index(fields=['shop', 'id'], name='shop_api_or_shop_id_84c0d1_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='product',
+            index=models.Index(fields=['shop', 'id'], name='shop_api_pr_shop_id_fa0d43_idx'),
+        ),
+    ]
@@ -0,0 +1,34 @@
+# Generated by Django 2.1.1 on 2026-10-18 12:05
+
+from django.db import migrations
+
+
+def create_search_index(apps, schema_editor):
+    # The FTS5 index only exists on SQLite, other databases use another search backend
+    if schema_editor.connection.vendor != 'sqlite':
+        return
+
+    schema_editor.execute(
+        "CREATE VIRTUAL TABLE shop_api_product_fts USING fts5("
+        "name, description, shop, prefix='2 3 4', tokenize='unicode61 remove_diacritics 1')"
+    )
+    schema_editor.execute(
+        "INSERT INTO shop_api_product_fts (rowid, name, description, shop) "
+        "SELECT id, name, description, 'shop' || shop_id FROM shop_api_product"
+    )
+
+
+def drop_search_index(apps, schema_editor):
+    if schema_editor.connection.vendor == 'sqlite':
+        schema_editor.execute("DROP TABLE shop_api_product_fts")
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('shop_api', '0008_sales_rollups'),
+    ]
+
+    operations = [
+        migrations.RunPython(create_search_index, drop_search_index),
+    ]
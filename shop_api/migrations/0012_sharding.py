@@ -0,0 +1,57 @@
+# Generated by Django 2.1.1 on 2026-10-18 16:40
+
+from django.conf import settings
+from django.db import migrations, models
+import django.db.models.deletion
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('shop_api', '0011_product_stock'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='ShardSequence',
+            fields=[
+                ('alias', models.CharField(max_length=32, primary_key=True, serialize=False)),
+                ('id_range', models.PositiveIntegerField(unique=True)),
+            ],
+        ),
+        migrations.AddField(
+            model_name='shop',
+            name='shard',
+            field=models.CharField(default='default', max_length=32),
+        ),
+        migrations.AddField(
+            model_name='shop',
+            name='shard_locked',
+            field=models.BooleanField(default=False),
+        ),
+        migrations.AlterField(
+            model_name='lineitem',
+            name='id',
+            field=models.BigAutoField(primary_key=True, serialize=False),
+        ),
+        migrations.AlterField(
+            model_name='lineitem',
+            name='product',
+            field=models.ForeignKey(db_constraint=False, on_delete=django.db.models.deletion.CASCADE, related_name='line_items', to='shop_api.Product'),
+        ),
+        migrations.AlterField(
+            model_name='order',
+            name='client',
+            field=models.ForeignKey(db_constraint=False, null=True, on_delete=django.db.models.deletion.SET_NULL, related_name='orders', to=settings.AUTH_USER_MODEL),
+        ),
+        migrations.AlterField(
+            model_name='order',
+            name='id',
+            field=models.BigAutoField(primary_key=True, serialize=False),
+        ),
+        migrations.AlterField(
+            model_name='order',
+            name='shop',
+            field=models.ForeignKey(db_constraint=False, on_delete=django.db.models.deletion.CASCADE, related_name='orders', to='shop_api.Shop'),
+        ),
+    ]
@@ -0,0 +1,40 @@
+# Generated by Django 2.1.1 on 2026-10-18 18:20
+
+from django.db import migrations, models
+import django.db.models.deletion
+import django.utils.timezone
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('shop_api', '0013_order_archive'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='shop',
+            name='changes_purged_through',
+            field=models.BigIntegerField(default=0),
+        ),
+        migrations.CreateModel(
+            name='OrderEvent',
+            fields=[
+                ('id', models.BigAutoField(primary_key=True, serialize=False)),
+                ('order_id', models.BigIntegerField()),
+                ('line_item_id', models.BigIntegerField(null=True)),
+                ('kind', models.CharField(choices=[('order.created', 'Order created'), ('order.deleted', 'Order deleted'), ('line_item.created', 'Line item created'), ('line_item.updated', 'Line item updated'), ('line_item.deleted', 'Line item deleted')], max_length=20)),
+                ('data', models.TextField()),
+                ('created_at', models.DateTimeField(db_index=True, default=django.utils.timezone.now)),
+                ('shop', models.ForeignKey(db_constraint=False, on_delete=django.db.models.deletion.CASCADE, related_name='order_events', to='shop_api.Shop')),
+            ],
+        ),
+        migrations.AddIndex(
+            model_name='orderevent',
+            index=models.Index(fields=['shop', 'id'], name='shop_api_or_shop_id_065c3c_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='orderevent',
+            index=models.Index(fields=['order_id', 'id'], name='shop_api_or_order_i_544c7b_idx'),
+        ),
+    ]
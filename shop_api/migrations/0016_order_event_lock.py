@@ -0,0 +1,22 @@
+# Generated by Django 2.1.1 on 2026-10-18 21:10
+
+from django.db import migrations, models
+import django.db.models.deletion
+import django.utils.timezone
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('shop_api', '0015_task_queue'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='OrderEventLock',
+            fields=[
+                ('shop', models.OneToOneField(db_constraint=False, on_delete=django.db.models.deletion.CASCADE, primary_key=True, related_name='+', serialize=False, to='shop_api.Shop')),
+                ('updated_at', models.DateTimeField(default=django.utils.timezone.now)),
+            ],
+        ),
+    ]
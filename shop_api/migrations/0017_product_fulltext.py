@@ -0,0 +1,31 @@
+# Generated by Django 2.1.1 on 2026-10-18 21:40
+
+from django.db import migrations
+
+
+def create_fulltext_indexes(apps, schema_editor):
+    # The FULLTEXT indexes only exist on MySQL, SQLite has the FTS5 table of 0009_product_search
+    if schema_editor.connection.vendor != 'mysql':
+        return
+
+    schema_editor.execute("CREATE FULLTEXT INDEX shop_api_product_name_fulltext ON shop_api_product (name)")
+    schema_editor.execute(
+        "CREATE FULLTEXT INDEX shop_api_product_text_fulltext ON shop_api_product (name, description)"
+    )
+
+
+def drop_fulltext_indexes(apps, schema_editor):
+    if schema_editor.connection.vendor == 'mysql':
+        schema_editor.execute("DROP INDEX shop_api_product_text_fulltext ON shop_api_product")
+        schema_editor.execute("DROP INDEX shop_api_product_name_fulltext ON shop_api_product")
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('shop_api', '0016_order_event_lock'),
+    ]
+
+    operations = [
+        migrations.RunPython(create_fulltext_indexes, drop_fulltext_indexes),
+    ]
@@ -1,17 +1,51 @@
 from django.db import models
+from django.db.models import F, Func, Sum, Value, ExpressionWrapper
+from django.db.models.functions import Coalesce
 from django.contrib.auth.models import User
+from django.utils import timezone
 
 
 # Shopify Challenge Models
 
 
+def line_items_total(prefix=''):
+    """
+    Aggregate expression for SUM(price * quantity) over a set of line items, 0 when the set is empty.
+    prefix allows aggregating through a relation, e.g. line_items_total('line_items__')
+
+    The sum is rounded to cents in SQL since some backends (SQLite) add decimals as floats,
+    which would make the result unequal to the stored totals when compared in the database.
+    """
+    output_field = models.DecimalField(max_digits=19, decimal_places=2)
+    subtotal = ExpressionWrapper(F(prefix + 'price') * F(prefix + 'quantity'), output_field=output_field)
+    return Func(Coalesce(Sum(subtotal), 0), Value(2), function='ROUND', output_field=output_field)
+
+
 class Shop(models.Model):
     name = models.CharField(max_length=100, unique=True)
     owner = models.ForeignKey(User, on_delete=models.CASCADE, related_name='shops')
 
+    # Bumped whenever the shop or one of its products changes, used as the catalog's ETag
+    version = models.PositiveIntegerField(default=0)
+    updated_at = models.DateTimeField(auto_now=True)
+
+    # Database alias holding the orders and line items of the shop, see shop_api.sharding
+    shard = models.CharField(max_length=32, default='default')
+    # Writes to the orders of the shop are refused while they move to another shard
+    shard_locked = models.BooleanField(default=False)
+    # Id of the last event of the shop's change feed dropped by the retention, the cursors before it expired
+    changes_purged_through = models.BigIntegerField(default=0)
+
     def __str__(self):
         return self.name
 
+    @classmethod
+    def touch(cls, shop_id):
+        """
+        Atomically bumps the catalog version of the shop with id=shop_id
+        """
+        cls.objects.filter(pk=shop_id).update(version=F('version') + 1, updated_at=timezone.now())
+
 
 class Product(models.Model):
     """
@@ -21,6 +55,13 @@ class Product(models.Model):
     name = models.CharField(max_length=100, unique=True)
     description = models.TextField(blank=True)
     price = models.DecimalField(max_digits=19, decimal_places=2)
+    # Units left to sell, NULL when the shop doesn't track the product's inventory. See shop_api.inventory
+    stock = models.PositiveIntegerField(null=True, blank=True)
+    updated_at = models.DateTimeField(auto_now=True)
+
+    class Meta:
+        # Keyset pagination walks a shop's products in id order
+        indexes = [models.Index(fields=['shop', 'id'])]
 
     def __str__(self):
         return self.name
@@ -29,38 +70,272 @@ class Product(models.Model):
     def owner(self):
         return self.shop.owner
 
+    @property
+    def owner_id(self):
+        return self.shop.owner_id
+
 
 class Order(models.Model):
+    # Orders and line items live on the shard of their shop, which may not be the database of the users,
+    # shops and products they refer to, so those foreign keys have no constraint. Their ids are unique across shards.
+    id = models.BigAutoField(primary_key=True)
+
     # Don't delete the order if the user deletes their account for accounting purposes
-    client = models.ForeignKey(User, on_delete=models.SET_NULL, related_name='orders', null=True)
+    client = models.ForeignKey(User, on_delete=models.SET_NULL, related_name='orders', null=True, db_constraint=False)
 
     # One to one relation with a shop
-    shop = models.ForeignKey('Shop', on_delete=models.CASCADE, related_name='orders')
+    shop = models.ForeignKey('Shop', on_delete=models.CASCADE, related_name='orders', db_constraint=False)
     total = models.DecimalField(max_digits=19, decimal_places=2, default=0)
+    created_at = models.DateTimeField(default=timezone.now)
+    updated_at = models.DateTimeField(auto_now=True)
+
+    class Meta:
+        # Keyset pagination walks a shop's orders in id order
+        indexes = [models.Index(fields=['shop', 'id'])]
 
     def __str__(self):
         return 'Order: ' + str(self.id)
 
     def update_total(self):
-        self.total = sum(item.price * item.quantity for item in self.line_items.all())
+        """
+        Recomputes the total from scratch with a single SQL aggregate over the line items.
+        The caller is responsible for persisting the result.
+        """
+        self.total = self.line_items.aggregate(total=line_items_total())['total']
+
+    def adjust_total(self, delta):
+        """
+        Atomically shifts the stored total by delta in the database, without reading the line items.
+        Concurrent writers to the same order never lose each other's updates since the
+        addition is performed by the database (UPDATE ... SET total = total + delta).
+        Also marks the order as modified since one of its line items changed.
+        """
+        Order.objects.using(self._state.db).filter(pk=self.pk).update(total=F('total') + delta,
+                                                                       updated_at=timezone.now())
+        self.refresh_from_db(fields=['total', 'updated_at'])
 
     @property
     def owner(self):
         return self.client
 
+    @property
+    def owner_id(self):
+        return self.client_id
+
 
 class LineItem(models.Model):
     """
     Association class between Product and Order
     """
-    product = models.ForeignKey('Product', on_delete=models.CASCADE, related_name='line_items')
+    id = models.BigAutoField(primary_key=True)
+    product = models.ForeignKey('Product', on_delete=models.CASCADE, related_name='line_items', db_constraint=False)
     order = models.ForeignKey('Order', on_delete=models.CASCADE, related_name='line_items')
     quantity = models.IntegerField(default=1)
     price = models.DecimalField(max_digits=19, decimal_places=2)
 
+    class Meta:
+        # Keyset pagination walks an order's line items in id order
+        indexes = [models.Index(fields=['order', 'id'])]
+
     def __str__(self):
         return self.product.name + ' x' + str(self.quantity)
 
+    @property
+    def subtotal(self):
+        return self.price * self.quantity
+
     @property
     def owner(self):
         return self.order.owner
+
+    @property
+    def owner_id(self):
+        return self.order.owner_id
+
+
+class ArchivedOrder(models.Model):
+    """
+    Order moved out of the order and line item tables once it got old, see shop_api.archive.
+    Lives on the shard of its shop next to the orders, keeping their id.
+    """
+    id = models.BigIntegerField(primary_key=True)
+    client = models.ForeignKey(User, on_delete=models.SET_NULL, related_name='archived_orders', null=True,
+                               db_constraint=False)
+    shop = models.ForeignKey('Shop', on_delete=models.CASCADE, related_name='archived_orders', db_constraint=False)
+    total = models.DecimalField(max_digits=19, decimal_places=2)
+    created_at = models.DateTimeField()
+    updated_at = models.DateTimeField()
+    archived_at = models.DateTimeField(default=timezone.now, db_index=True)
+    # The line items packed by shop_api.archive.pack_line_items()
+    line_items = models.BinaryField()
+
+    class Meta:
+        indexes = [models.Index(fields=['shop', 'id'])]
+
+    def __str__(self):
+        return 'Archived order: ' + str(self.id)
+
+
+class OrderEvent(models.Model):
+    """
+    Entry of the change feed of a shop's orders, see shop_api.changes.
+    Lives on the shard of its shop, its id is the cursor of the feed.
+    """
+    ORDER_CREATED = 'order.created'
+    ORDER_DELETED = 'order.deleted'
+    LINE_ITEM_CREATED = 'line_item.created'
+    LINE_ITEM_UPDATED = 'line_item.updated'
+    LINE_ITEM_DELETED = 'line_item.deleted'
+    KINDS = (
+        (ORDER_CREATED, 'Order created'),
+        (ORDER_DELETED, 'Order deleted'),
+        (LINE_ITEM_CREATED, 'Line item created'),
+        (LINE_ITEM_UPDATED, 'Line item updated'),
+        (LINE_ITEM_DELETED, 'Line item deleted'),
+    )
+
+    id = models.BigAutoField(primary_key=True)
+    shop = models.ForeignKey('Shop', on_delete=models.CASCADE, related_name='order_events', db_constraint=False)
+    order_id = models.BigIntegerField()
+    # NULL for the events of the order itself
+    line_item_id = models.BigIntegerField(null=True)
+    kind = models.CharField(max_length=20, choices=KINDS)
+    # JSON of the order or line item after the change
+    data = models.TextField()
+    created_at = models.DateTimeField(default=timezone.now, db_index=True)
+
+    class Meta:
+        # Consumers read the events of a shop in id order, the compaction looks for the later events of an order
+        indexes = [models.Index(fields=['shop', 'id']), models.Index(fields=['order_id', 'id'])]
+
+    def __str__(self):
+        return '%s %s' % (self.kind, self.line_item_id or self.order_id)
+
+
+class OrderEventLock(models.Model):
+    """
+    Row of a shop on its shard, locked by the transactions appending to its change feed, see shop_api.changes
+    """
+    shop = models.OneToOneField('Shop', on_delete=models.CASCADE, primary_key=True, related_name='+',
+                                db_constraint=False)
+    # Time of the last event appended
+    updated_at = models.DateTimeField(default=timezone.now)
+
+
+class ShopDailySales(models.Model):
+    """
+    Sales of a shop on the day its orders were placed, maintained by shop_api.analytics
+    """
+    shop = models.ForeignKey('Shop', on_delete=models.CASCADE, related_name='daily_sales')
+    day = models.DateField()
+    revenue = models.DecimalField(max_digits=19, decimal_places=2, default=0)
+    units = models.IntegerField(default=0)
+    # Orders placed that day with at least one line item
+    orders = models.IntegerField(default=0)
+
+    class Meta:
+        unique_together = ('shop', 'day')
+
+
+class ProductDailySales(models.Model):
+    """
+    Sales of a product on the day its orders were placed, maintained by shop_api.analytics
+    """
+    product = models.ForeignKey('Product', on_delete=models.CASCADE, related_name='daily_sales')
+    # Denormalized so that the sales of a shop's products are read without joining the products
+    shop = models.ForeignKey('Shop', on_delete=models.CASCADE, related_name='product_daily_sales')
+    day = models.DateField()
+    revenue = models.DecimalField(max_digits=19, decimal_places=2, default=0)
+    units = models.IntegerField(default=0)
+    # Orders placed that day with at least one line item of the product
+    orders = models.IntegerField(default=0)
+
+    class Meta:
+        unique_together = ('product', 'day')
+        indexes = [models.Index(fields=['shop', 'day'])]
+
+
+class RevokedToken(models.Model):
+    """
+    Signed tokens revoked before their expiry, see shop_api.authentication
+    """
+    token_id = models.CharField(max_length=32, unique=True)
+    user = models.ForeignKey(User, on_delete=models.CASCADE, related_name='revoked_tokens')
+    # Rows are purged once the token would have expired anyway
+    expires_at = models.DateTimeField(db_index=True)
+
+
+class ShardSequence(models.Model):
+    """
+    Range of ids the orders and line items created on a shard are numbered in, see shop_api.sharding
+    """
+    alias = models.CharField(max_length=32, primary_key=True)
+    id_range = models.PositiveIntegerField(unique=True)
+
+
+class Task(models.Model):
+    """
+    Deferred call of a function, run by the run_workers processes, see shop_api.tasks
+    """
+    PENDING = 'pending'
+    RUNNING = 'running'
+    DONE = 'done'
+    FAILED = 'failed'
+    STATUSES = (
+        (PENDING, 'Pending'),
+        (RUNNING, 'Running'),
+        (DONE, 'Done'),
+        (FAILED, 'Failed'),
+    )
+
+    id = models.BigAutoField(primary_key=True)
+    # Dotted path of the function
+    name = models.CharField(max_length=200)
+    # JSON of its keyword arguments
+    kwargs = models.TextField(default='{}')
+    # At most one task waiting to run per key, the key is released once a worker starts the task
+    dedup_key = models.CharField(max_length=200, unique=True, null=True)
+    status = models.CharField(max_length=10, choices=STATUSES, default=PENDING)
+    attempts = models.PositiveIntegerField(default=0)
+    max_attempts = models.PositiveIntegerField(default=5)
+    enqueued_at = models.DateTimeField(default=timezone.now)
+    # Earliest time of the next attempt
+    run_at = models.DateTimeField(default=timezone.now)
+    # A running task whose lease expired belongs to a worker which died, another worker takes it over
+    locked_until = models.DateTimeField(null=True)
+    finished_at = models.DateTimeField(null=True, db_index=True)
+    last_error = models.TextField(blank=True)
+
+    class Meta:
+        # Workers look for the due tasks of a status
+        indexes = [models.Index(fields=['status', 'run_at'])]
+
+    def __str__(self):
+        return '%s #%d' % (self.name, self.id)
+
+
+class OrderExport(models.Model):
+    """
+    Export of the orders of a shop written to a file by a worker, see shop_api.exports
+    """
+    PENDING = 'pending'
+    READY = 'ready'
+    FAILED = 'failed'
+    STATUSES = (
+        (PENDING, 'Pending'),
+        (READY, 'Ready'),
+        (FAILED, 'Failed'),
+    )
+
+    shop = models.ForeignKey('Shop', on_delete=models.CASCADE, related_name='order_exports')
+    output = models.CharField(max_length=10)
+    since_id = models.BigIntegerField(default=0)
+    # Outcome of the last attempt, failed exports are retried
+    status = models.CharField(max_length=10, choices=STATUSES, default=PENDING)
+    error = models.TextField(blank=True)
+    size = models.BigIntegerField(null=True)
+    created_at = models.DateTimeField(auto_now_add=True)
+    finished_at = models.DateTimeField(null=True)
+
+    def __str__(self):
+        return 'Order export: ' + str(self.id)
@@ -0,0 +1,71 @@
+from rest_framework import pagination
+
+
+class KeysetPagination(pagination.CursorPagination):
+    """
+    Cursor pagination over the primary key.
+
+    The views using it always scope their queryset to a single shop (or order), so the
+    effective key is (shop_id, id) which is served by the composite indexes on the models.
+    Each page is a `WHERE shop_id = ? AND id > ? ORDER BY id LIMIT ?` range scan,
+    so page 10,000 costs the same as page 1. The next/previous links carry opaque cursor tokens.
+    """
+
+    ordering = 'id'
+    page_size = 100
+    page_size_query_param = 'page_size'
+    max_page_size = 1000
+
+    def _get_position_from_instance(self, instance, ordering):
+        # values_list() rows of the fast list serializers start with the id
+        if isinstance(instance, tuple):
+            return str(instance[0])
+        return super(KeysetPagination, self)._get_position_from_instance(instance, ordering)
+
+
+class KeysetOrLimitOffsetPagination(pagination.BasePagination):
+    """
+    Uses keyset pagination by default, while clients passing `limit` or `offset`
+    keep getting the legacy limit/offset pagination.
+    """
+
+    keyset_class = KeysetPagination
+    limit_offset_class = pagination.LimitOffsetPagination
+
+    def __init__(self):
+        self.keyset = self.keyset_class()
+        self.limit_offset = self.limit_offset_class()
+        self.active = self.keyset
+
+    def uses_limit_offset(self, request):
+        params = request.query_params
+        return self.limit_offset.limit_query_param in params or self.limit_offset.offset_query_param in params
+
+    def paginate_queryset(self, queryset, request, view=None):
+        self.active = self.limit_offset if self.uses_limit_offset(request) else self.keyset
+        return self.active.paginate_queryset(queryset, request, view)
+
+    def get_paginated_response(self, data):
+        return self.active.get_paginated_response(data)
+
+    @property
+    def display_page_controls(self):
+        return getattr(self.active, 'display_page_controls', False)
+
+    def to_html(self):
+        return self.active.to_html()
+
+    def get_results(self, data):
+        return self.active.get_results(data)
+
+    def get_schema_fields(self, view):
+        return self.keyset.get_schema_fields(view) + self.limit_offset.get_schema_fields(view)
+
+
+class SearchPagination(pagination.LimitOffsetPagination):
+    """
+    Limit/offset pagination of ranked search results
+    """
+
+    default_limit = 100
+    max_limit = 1000
@@ -1,5 +1,12 @@
 from rest_framework import permissions
-from shop_api.models import Shop, Order
+from shop_api.resolvers import resolve_shop, resolve_order
+
+
+def is_user(request, user_id):
+    """
+    Compares ids rather than instances so that owner checks never load the owner's row
+    """
+    return request.user.is_authenticated and user_id == request.user.pk
 
 
 class IsResourceOwnerOrReadOnly(permissions.BasePermission):
@@ -15,7 +22,7 @@ class IsResourceOwnerOrReadOnly(permissions.BasePermission):
         if request.method in permissions.SAFE_METHODS:
             return True
 
-        return obj.owner == request.user
+        return is_user(request, obj.owner_id)
 
 
 class IsShopOwnerOrReadOnly(permissions.BasePermission):
@@ -30,7 +37,7 @@ class IsShopOwnerOrReadOnly(permissions.BasePermission):
         if shop_id is None:
             return True
 
-        return Shop.objects.get(pk=shop_id).owner == request.user
+        return is_user(request, resolve_shop(request, shop_id).owner_id)
 
 
 class IsOrderOwnerOrShopOwnerReadOnly(permissions.BasePermission):
@@ -42,10 +49,26 @@ class IsOrderOwnerOrShopOwnerReadOnly(permissions.BasePermission):
         if shop_id is None or order_id is None:
             return True
 
-        is_order_owner = Order.objects.get(pk=order_id).owner == request.user
-        is_shop_owner = Shop.objects.get(pk=shop_id).owner == request.user
+        order = resolve_order(request, shop_id, order_id)
+        is_order_owner = is_user(request, order.owner_id)
+        is_shop_owner = is_user(request, order.shop.owner_id)
 
         if request.method in permissions.SAFE_METHODS:
             return is_order_owner or is_shop_owner
         else:
             return is_order_owner
+
+
+class IsShopOwner(permissions.BasePermission):
+
+    """
+    Only the owner of the shop with id=shop_id may access the view, even for reads.
+    """
+
+    def has_permission(self, request, view):
+        shop_id = view.kwargs.get('shop_id')
+
+        if shop_id is None:
+            return True
+
+        return is_user(request, resolve_shop(request, shop_id).owner_id)
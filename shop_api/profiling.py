@@ -0,0 +1,144 @@
+import os
+import random
+import sys
+import threading
+import time
+import uuid
+from collections import Counter
+
+from django.conf import settings
+
+
+# On-demand profiling of live requests.
+#
+# A profiled request is watched by a sampler thread which records the call stack of the thread handling it at a
+# fixed interval. The stacks are saved in the collapsed format of flamegraph.pl / speedscope ("frame;frame;frame count"
+# per line), in one directory per route, and merged with the merge_profiles management command.
+
+
+PROFILE_HEADER = 'HTTP_X_PROFILE'
+
+
+def profile_dir():
+    return getattr(settings, 'SHOP_API_PROFILE_DIR', os.path.join(settings.BASE_DIR, 'profiles'))
+
+
+def route_dir(route):
+    # View names contain the URL namespace separator
+    return os.path.join(profile_dir(), route.replace(':', '.'))
+
+
+def frame_name(code):
+    return '%s (%s:%d)' % (code.co_name, code.co_filename, code.co_firstlineno)
+
+
+class StackSampler:
+    """
+    Samples the stack of one thread from a background thread. The sampled thread runs untouched, the cost is the
+    time the sampler holds the GIL, bounded by the interval and by the interpreter's switch interval.
+    """
+
+    def __init__(self, thread_id, interval=0.001):
+        self.thread_id = thread_id
+        self.interval = interval
+        self.stacks = Counter()
+        self._stopped = threading.Event()
+        self._thread = threading.Thread(target=self.run, name='shop_api-profiler', daemon=True)
+
+    def start(self):
+        self._thread.start()
+
+    def stop(self):
+        self._stopped.set()
+        self._thread.join()
+
+    def sample(self):
+        frame = sys._current_frames().get(self.thread_id)
+        stack = []
+        while frame is not None:
+            stack.append(frame_name(frame.f_code))
+            frame = frame.f_back
+
+        if stack:
+            self.stacks[';'.join(reversed(stack))] += 1
+
+    def run(self):
+        while True:
+            self.sample()
+            if self._stopped.wait(self.interval):
+                return
+
+
+def write_collapsed(stacks, stream):
+    for stack, count in sorted(stacks.items()):
+        stream.write('%s %d\n' % (stack, count))
+
+
+def read_collapsed(stream, stacks):
+    for line in stream:
+        stack, _, count = line.rstrip('\n').rpartition(' ')
+        if stack:
+            stacks[stack] += int(count)
+
+
+def save_profile(route, stacks):
+    directory = route_dir(route)
+    os.makedirs(directory, exist_ok=True)
+
+    path = os.path.join(directory, '%d-%d-%s.collapsed' % (time.time(), os.getpid(), uuid.uuid4().hex[:8]))
+    with open(path, 'w') as stream:
+        write_collapsed(stacks, stream)
+    return path
+
+
+def start_profile(request):
+    """
+    Starts sampling the thread handling the Django request, ProfilingMiddleware saves the profile
+    """
+    if getattr(request, 'profile_sampler', None) is None:
+        request.profile_sampler = StackSampler(
+            threading.get_ident(), getattr(settings, 'SHOP_API_PROFILE_INTERVAL', 0.001)
+        )
+        request.profile_sampler.start()
+
+
+def start_requested_profile(request):
+    """
+    Starts profiling a DRF request which asked for it with an "X-Profile: 1" header, once its user was authenticated
+    as staff
+    """
+    if request.META.get(PROFILE_HEADER) == '1' and request.user.is_staff:
+        start_profile(request._request)
+
+
+class ProfilingMiddleware:
+    """
+    Profiles a random sample of SHOP_API_PROFILE_SAMPLE_RATE of all the requests, and the requests of staff users
+    sending an "X-Profile: 1" header.
+
+    DRF authenticates in the view, the views of InstrumentedViewMixin start the profile of a request with the header
+    once its user turned out to be staff. The header costs nothing to the other clients.
+    """
+
+    def __init__(self, get_response):
+        self.get_response = get_response
+        self.sample_rate = getattr(settings, 'SHOP_API_PROFILE_SAMPLE_RATE', 0)
+
+    def __call__(self, request):
+        if self.sample_rate > 0 and random.random() < self.sample_rate:
+            start_profile(request)
+
+        try:
+            response = self.get_response(request)
+        finally:
+            sampler = getattr(request, 'profile_sampler', None)
+            if sampler is not None:
+                sampler.stop()
+
+        if sampler is not None:
+            match = getattr(request, 'resolver_match', None)
+            path = save_profile(match.view_name if match else 'unmatched', sampler.stacks)
+            if request.META.get(PROFILE_HEADER) == '1':
+                response['X-Profile'] = os.path.basename(path)
+
+        return response
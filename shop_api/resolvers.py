@@ -0,0 +1,74 @@
+from django.db import DEFAULT_DB_ALIAS
+from django.http import Http404
+from shop_api.models import Shop, Order
+from shop_api.routers import set_current_shop
+
+
+# Request scoped resolution of the shop and order named in the URL.
+# Permissions, serializers and views all need them, resolving them through these helpers
+# loads each row at most once per request and shares the instances between the layers.
+# The resolved shop becomes the current shop of the request, which routes its orders and line items to its shard.
+
+
+def _resolved(request):
+    cache = getattr(request, '_resolved_objects', None)
+    if cache is None:
+        cache = request._resolved_objects = {}
+    return cache
+
+
+def resolve_shop(request, shop_id):
+    """
+    Returns the shop with id=shop_id, raising Http404 if it doesn't exist
+    """
+    cache = _resolved(request)
+    key = (Shop, int(shop_id))
+
+    if key not in cache:
+        try:
+            cache[key] = Shop.objects.get(pk=shop_id)
+        except Shop.DoesNotExist:
+            raise Http404('No shop matches the given query.')
+
+    set_current_shop(cache[key])
+    return cache[key]
+
+
+def resolve_order(request, shop_id, order_id):
+    """
+    Returns the order with id=order_id belonging to the shop with id=shop_id, raising Http404 if it doesn't exist.
+    The order's shop is loaded along with it (or reused if already resolved) so that owner checks are free.
+    """
+    cache = _resolved(request)
+    key = (Order, int(order_id))
+
+    if key not in cache:
+        shop = cache.get((Shop, int(shop_id)))
+        orders = Order.objects.filter(pk=order_id, shop_id=shop_id)
+        order = None
+
+        if shop is None:
+            # Most shops keep their orders on the default shard, next to the shops, where one query loads both
+            order = orders.select_related('shop').first()
+            if order is not None:
+                shop = cache[(Shop, order.shop_id)] = order.shop
+                set_current_shop(shop)
+                if shop.shard != DEFAULT_DB_ALIAS:
+                    # Left behind by a move to another shard
+                    order = None
+
+        if shop is None:
+            shop = resolve_shop(request, shop_id)
+
+        if order is None:
+            order = orders.first()
+            if order is None:
+                raise Http404('No order matches the given query.')
+
+        order.shop = shop
+        cache[key] = order
+
+    elif cache[key].shop_id != int(shop_id):
+        raise Http404('No order matches the given query.')
+
+    return cache[key]
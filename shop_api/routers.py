@@ -0,0 +1,261 @@
+import os
+import random
+import threading
+import time
+
+from django.conf import settings
+from django.core.cache import caches
+from django.db import DEFAULT_DB_ALIAS, DatabaseError, connections
+from rest_framework import authentication, exceptions, permissions, status
+from shop_api.authentication import SignedTokenAuthentication, read_token
+from shop_api.models import Shop, Order, LineItem, ArchivedOrder, OrderEvent, OrderEventLock
+
+
+# Primary and read replica routing.
+#
+# Every write goes to the primary. The reads of GET, HEAD and OPTIONS requests go to one of the healthy replicas of
+# SHOP_API_READ_REPLICAS, picked once per request, the reads of any other request or of management commands go to
+# the primary. A client which wrote is pinned to the primary with a cookie for SHOP_API_REPLICA_PIN_SECONDS,
+# long enough for the replicas to catch up, so that it reads its own writes. Clients authenticated with a token
+# usually drop cookies, the users of those which wrote are pinned in the SHOP_API_REPLICA_PIN_CACHE cache instead.
+#
+# The orders and line items of a shop live on its shard (Shop.shard). Views resolving the shop of their URL make it
+# the current shop of the request, whose shard then serves the queries on those models which don't name an instance.
+
+PIN_COOKIE = 'shop_api_primary'
+PIN_KEY = 'replica-pin:%d'
+
+_state = threading.local()
+
+
+def current_replica():
+    return getattr(_state, 'replica', None)
+
+
+def set_current_replica(alias):
+    _state.replica = alias
+
+
+def current_shop():
+    return getattr(_state, 'shop', None)
+
+
+def set_current_shop(shop):
+    _state.shop = shop
+
+
+def health_check_interval():
+    return getattr(settings, 'SHOP_API_DATABASE_HEALTH_CHECK', 30)
+
+
+def check_connection(alias, connect=False):
+    """
+    Pings the persistent connection of alias when it has been idle for longer than SHOP_API_DATABASE_HEALTH_CHECK
+    seconds and closes it if the database doesn't answer, so that the request opens a new one instead of failing.
+    connect opens the connection if there is none. Returns False when the database can't be reached.
+    """
+    connection = connections[alias]
+    now = time.monotonic()
+
+    # An SQLite file standing in for a replica which was never synced would be created empty
+    name = connection.settings_dict['NAME']
+    if connection.vendor == 'sqlite' and os.path.isabs(name) and not os.path.exists(name):
+        return False
+
+    try:
+        if connection.connection is not None and now - getattr(connection, 'checked_at', 0) > health_check_interval():
+            if not connection.is_usable():
+                connection.close()
+        if connect:
+            connection.ensure_connection()
+    except DatabaseError:
+        connection.close()
+        return False
+
+    if connection.connection is not None:
+        connection.checked_at = now
+    return True
+
+
+class ReplicaPool:
+    """
+    Picks a random healthy replica, replicas which can't be reached are skipped for retry_after seconds
+    """
+
+    def __init__(self, aliases, retry_after=30):
+        self.aliases = list(aliases)
+        self.retry_after = retry_after
+        self.down = {}
+
+    def healthy(self, alias):
+        return check_connection(alias, connect=True)
+
+    def choose(self):
+        now = time.monotonic()
+        candidates = [alias for alias in self.aliases if self.down.get(alias, 0) <= now]
+        random.shuffle(candidates)
+
+        for alias in candidates:
+            if self.healthy(alias):
+                return alias
+            self.down[alias] = now + self.retry_after
+
+        return None
+
+
+_replica_pool = None
+
+
+def get_replica_pool():
+    """
+    Returns the pool of the replicas listed in the SHOP_API_READ_REPLICAS setting
+    """
+    global _replica_pool
+
+    if _replica_pool is None:
+        _replica_pool = ReplicaPool(
+            getattr(settings, 'SHOP_API_READ_REPLICAS', []), getattr(settings, 'SHOP_API_REPLICA_RETRY', 30)
+        )
+
+    return _replica_pool
+
+
+class PrimaryReplicaRouter:
+    """
+    Sends the reads to the replica picked for the current request, and everything else to the primary.
+    Once a request writes, its later reads go to the primary too.
+    """
+
+    def db_for_read(self, model, **hints):
+        return current_replica() or DEFAULT_DB_ALIAS
+
+    def db_for_write(self, model, **hints):
+        set_current_replica(None)
+        return DEFAULT_DB_ALIAS
+
+    def allow_relation(self, obj1, obj2, **hints):
+        # The replicas hold the same rows as the primary
+        return True
+
+    def allow_migrate(self, db, app_label, model_name=None, **hints):
+        return db == DEFAULT_DB_ALIAS
+
+
+class ShardLocked(exceptions.APIException):
+    status_code = status.HTTP_503_SERVICE_UNAVAILABLE
+    default_detail = 'The orders of this shop are being moved, try again in a few seconds.'
+    default_code = 'shard_locked'
+
+
+class ShardRouter:
+    """
+    Sends the queries on orders, line items, archived orders and order events to the shard of their shop.
+    The shard is read from the instance the query is about when there is one, from the current shop otherwise.
+    Shops on the default shard and every other model are left to the next router.
+    """
+
+    def sharded(self, model):
+        return model in (Order, LineItem, ArchivedOrder, OrderEvent, OrderEventLock)
+
+    def shard_for(self, hints):
+        instance = hints.get('instance')
+        if isinstance(instance, Shop):
+            return instance.shard
+        if isinstance(instance, Order) and Order.shop.is_cached(instance):
+            return instance.shop.shard
+        if isinstance(instance, LineItem) and instance._state.db is None and LineItem.order.is_cached(instance):
+            return self.shard_for({'instance': instance.order})
+        if isinstance(instance, (Order, LineItem, ArchivedOrder)) and instance._state.db is not None:
+            return instance._state.db
+
+        shop = current_shop()
+        return shop.shard if shop is not None else None
+
+    def db_for_read(self, model, **hints):
+        if self.sharded(model):
+            alias = self.shard_for(hints)
+            if alias != DEFAULT_DB_ALIAS:
+                return alias
+        return None
+
+    def db_for_write(self, model, **hints):
+        if not self.sharded(model):
+            return None
+
+        shop = current_shop()
+        if shop is not None and shop.shard_locked:
+            raise ShardLocked()
+
+        alias = self.shard_for(hints)
+        if alias is not None and alias != DEFAULT_DB_ALIAS:
+            set_current_replica(None)
+            return alias
+        return None
+
+    def allow_migrate(self, db, app_label, model_name=None, **hints):
+        # Shards only hold the tables of the orders, line items, archived orders and order events
+        if db in getattr(settings, 'SHOP_API_SHARDS', []) and db != DEFAULT_DB_ALIAS:
+            return app_label == 'shop_api' and model_name in (
+                'order', 'lineitem', 'archivedorder', 'orderevent', 'ordereventlock'
+            )
+        return None
+
+
+def token_user(request):
+    """
+    Id of the user of the signed token sent by the request, None without a valid one. The token isn't checked against
+    the revocation list, which only matters to authentication.
+    """
+    header = authentication.get_authorization_header(request).split()
+    if len(header) != 2 or header[0].lower() != SignedTokenAuthentication.keyword:
+        return None
+
+    try:
+        payload = read_token(header[1].decode('ascii'))
+    except UnicodeError:
+        return None
+    return payload['user'] if payload is not None else None
+
+
+class ReplicaRoutingMiddleware:
+    """
+    Picks the replica serving the reads of safe requests from clients which aren't pinned to the primary,
+    pins the clients making any other request to the primary, and health checks the persistent connection
+    of the primary. Forgets the current shop once the response is ready.
+    """
+
+    def __init__(self, get_response):
+        self.get_response = get_response
+        self.pin_seconds = getattr(settings, 'SHOP_API_REPLICA_PIN_SECONDS', 5)
+        self.pin_cache = getattr(settings, 'SHOP_API_REPLICA_PIN_CACHE', None)
+
+    def __call__(self, request):
+        check_connection(DEFAULT_DB_ALIAS)
+
+        safe = request.method in permissions.SAFE_METHODS
+        if safe and PIN_COOKIE not in request.COOKIES:
+            replica = get_replica_pool().choose()
+            if replica is not None and not self.token_pinned(request):
+                set_current_replica(replica)
+
+        try:
+            response = self.get_response(request)
+        finally:
+            set_current_replica(None)
+            set_current_shop(None)
+
+        if not safe and self.pin_seconds:
+            response.set_cookie(PIN_COOKIE, '1', max_age=self.pin_seconds, httponly=True)
+
+            user_id = token_user(request) if self.pin_cache else None
+            if user_id is not None:
+                caches[self.pin_cache].set(PIN_KEY % user_id, True, self.pin_seconds)
+
+        return response
+
+    def token_pinned(self, request):
+        if not self.pin_cache:
+            return False
+
+        user_id = token_user(request)
+        return user_id is not None and caches[self.pin_cache].get(PIN_KEY % user_id, False)
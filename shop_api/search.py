@@ -0,0 +1,255 @@
+import re
+
+from django.conf import settings
+from django.core import checks
+from django.db import connections, router
+from django.db.models import Case, IntegerField, Q, Value, When
+from django.utils.module_loading import import_string
+from rest_framework.exceptions import ValidationError
+from shop_api.models import Product
+from shop_api.pagination import SearchPagination
+
+
+# Full-text search over the names and descriptions of the products.
+#
+# Backends keep an index of the products in sync through the Product signals and return the ids of the products
+# matching a query, best match first.
+
+TERM = re.compile(r'(\w+)(\*?)', re.UNICODE)
+
+
+def parse_query(query):
+    """
+    Splits a query in (term, prefix) pairs, every term must match. Terms ending with * match as prefixes.
+    """
+    return [(term.lower(), bool(star)) for term, star in TERM.findall(query)]
+
+
+class SQLiteFTSBackend:
+    """
+    Inverted index in an SQLite FTS5 table, created by the 0009_product_search migration.
+
+    The shop of every product is indexed as a token of its own, so that searching one shop intersects
+    the posting lists of the terms with the shop's instead of filtering every match. Results are ranked with BM25,
+    matches in the name weigh name_weight times more than matches in the description.
+    """
+
+    vendor = 'sqlite'
+    table = 'shop_api_product_fts'
+
+    def __init__(self, max_results=1000, name_weight=10.0, description_weight=1.0):
+        self.max_results = max_results
+        self.name_weight = name_weight
+        self.description_weight = description_weight
+
+    def connection(self, write=False):
+        alias = router.db_for_write(Product) if write else router.db_for_read(Product)
+        return connections[alias]
+
+    def index(self, products, new=False):
+        rows = [(product.pk, product.name, product.description, 'shop%d' % product.shop_id) for product in products]
+        if not new:
+            self.remove([row[0] for row in rows])
+
+        with self.connection(write=True).cursor() as cursor:
+            cursor.executemany(
+                'INSERT INTO %s (rowid, name, description, shop) VALUES (%%s, %%s, %%s, %%s)' % self.table, rows
+            )
+
+    def remove(self, product_ids):
+        with self.connection(write=True).cursor() as cursor:
+            cursor.executemany('DELETE FROM %s WHERE rowid = %%s' % self.table, [(pk,) for pk in product_ids])
+
+    def rebuild(self):
+        with self.connection(write=True).cursor() as cursor:
+            cursor.execute('DELETE FROM %s' % self.table)
+            cursor.execute(
+                "INSERT INTO %s (rowid, name, description, shop) "
+                "SELECT id, name, description, 'shop' || shop_id FROM %s" % (self.table, Product._meta.db_table)
+            )
+
+    def match_expression(self, terms, shop_id=None):
+        # Terms are quoted so that words like AND or NEAR aren't read as operators
+        expression = '{name description} : (%s)' % ' AND '.join(
+            '"%s"%s' % (term, '*' if prefix else '') for term, prefix in terms
+        )
+        if shop_id is not None:
+            expression = 'shop : "shop%d" AND %s' % (int(shop_id), expression)
+        return expression
+
+    def search(self, query, shop_id=None):
+        terms = parse_query(query)
+        if not terms:
+            return []
+
+        with self.connection().cursor() as cursor:
+            cursor.execute(
+                'SELECT rowid FROM {table} WHERE {table} MATCH %s '
+                'ORDER BY bm25({table}, %s, %s, 0.0) LIMIT %s'.format(table=self.table),
+                [self.match_expression(terms, shop_id), self.name_weight, self.description_weight, self.max_results]
+            )
+            return [row[0] for row in cursor.fetchall()]
+
+
+class MySQLFullTextBackend:
+    """
+    InnoDB FULLTEXT indexes on the product table, created by the 0017_product_fulltext migration. MySQL keeps them in
+    sync with the rows, there is nothing to index or remove.
+
+    The products matching every term in their name or description are ranked by the relevance of the name, weighing
+    name_weight, plus that of both columns, weighing description_weight. Words shorter than innodb_ft_min_token_size
+    and stopwords aren't indexed and match nothing, the MySQL deployment turns both off (kubernetes/services).
+    """
+
+    vendor = 'mysql'
+
+    def __init__(self, max_results=1000, name_weight=10.0, description_weight=1.0):
+        self.max_results = max_results
+        self.name_weight = name_weight
+        self.description_weight = description_weight
+
+    def index(self, products, new=False):
+        pass
+
+    def remove(self, product_ids):
+        pass
+
+    def rebuild(self):
+        # Rebuilds the table along with its FULLTEXT indexes
+        with connections[router.db_for_write(Product)].cursor() as cursor:
+            cursor.execute('OPTIMIZE TABLE %s' % Product._meta.db_table)
+
+    def against_expression(self, terms):
+        # Boolean mode, every term is required. The terms are words, they contain no operators.
+        return ' '.join('+%s%s' % (term, '*' if prefix else '') for term, prefix in terms)
+
+    def search(self, query, shop_id=None):
+        terms = parse_query(query)
+        if not terms:
+            return []
+
+        expression = self.against_expression(terms)
+        where, params = 'MATCH (name, description) AGAINST (%s IN BOOLEAN MODE)', [expression]
+        if shop_id is not None:
+            where += ' AND shop_id = %s'
+            params.append(int(shop_id))
+
+        with connections[router.db_for_read(Product)].cursor() as cursor:
+            cursor.execute(
+                'SELECT id FROM {table} WHERE {where} ORDER BY '
+                'MATCH (name) AGAINST (%s IN BOOLEAN MODE) * %s '
+                '+ MATCH (name, description) AGAINST (%s IN BOOLEAN MODE) * %s DESC, id '
+                'LIMIT %s'.format(table=Product._meta.db_table, where=where),
+                params + [expression, self.name_weight, expression, self.description_weight, self.max_results]
+            )
+            return [row[0] for row in cursor.fetchall()]
+
+
+class DatabaseBackend:
+    """
+    Portable fallback scanning the product table with LIKE, products matching in their name come first.
+    Only suitable for small catalogs, it must be configured explicitly.
+    """
+
+    vendor = None
+
+    def __init__(self, max_results=1000):
+        self.max_results = max_results
+
+    def index(self, products, new=False):
+        pass
+
+    def remove(self, product_ids):
+        pass
+
+    def rebuild(self):
+        pass
+
+    def search(self, query, shop_id=None):
+        terms = parse_query(query)
+        if not terms:
+            return []
+
+        products = Product.objects.all()
+        if shop_id is not None:
+            products = products.filter(shop_id=shop_id)
+
+        in_name = Q()
+        # LIKE matches substrings, prefixes included
+        for term, _ in terms:
+            products = products.filter(Q(name__icontains=term) | Q(description__icontains=term))
+            in_name &= Q(name__icontains=term)
+
+        ranked = products.annotate(
+            in_name=Case(When(in_name, then=Value(0)), default=Value(1), output_field=IntegerField())
+        )
+        return list(ranked.order_by('in_name', 'pk').values_list('pk', flat=True)[:self.max_results])
+
+
+_search_backend = None
+
+
+def search_backend_class():
+    return import_string(getattr(settings, 'SHOP_API_SEARCH', {}).get('BACKEND', 'shop_api.search.SQLiteFTSBackend'))
+
+
+def get_search_backend():
+    """
+    Returns the search backend configured by the SHOP_API_SEARCH setting
+    """
+    global _search_backend
+
+    if _search_backend is None:
+        _search_backend = search_backend_class()(**getattr(settings, 'SHOP_API_SEARCH', {}).get('OPTIONS', {}))
+
+    return _search_backend
+
+
+@checks.register()
+def check_search_backend(app_configs, **kwargs):
+    """
+    The index of a backend only exists on the database it was written for, searching another one would fail
+    """
+    backend = search_backend_class()
+    connection = connections[router.db_for_read(Product)]
+    if backend.vendor is not None and backend.vendor != connection.vendor:
+        return [checks.Error(
+            'SHOP_API_SEARCH uses %s, whose index only exists on %s, but the products are stored on %s.'
+            % (backend.__name__, backend.vendor, connection.vendor),
+            hint='Use shop_api.search.SQLiteFTSBackend on SQLite and shop_api.search.MySQLFullTextBackend on MySQL.',
+            id='shop_api.E001',
+        )]
+    return []
+
+
+class SearchMixin:
+    """
+    Lists the results of the search in the `q` query parameter of a generic list view, best match first.
+    The backend returns the ranked ids, only the products of the requested page are read from the database.
+    """
+
+    search_query_param = 'q'
+    search_required = False
+
+    def get_search_query(self):
+        return self.request.query_params.get(self.search_query_param)
+
+    def get_search_shop_id(self):
+        return self.kwargs.get('shop_id')
+
+    def list(self, request, *args, **kwargs):
+        query = self.get_search_query()
+        if query is None:
+            if self.search_required:
+                raise ValidationError({self.search_query_param: 'This query parameter is required.'})
+            return super(SearchMixin, self).list(request, *args, **kwargs)
+
+        product_ids = get_search_backend().search(query, shop_id=self.get_search_shop_id())
+
+        # Ranked results have no key to page through, they are paged by offset
+        paginator = SearchPagination()
+        page = paginator.paginate_queryset(product_ids, request, view=self)
+
+        products = Product.objects.in_bulk(page)
+        serializer = self.get_serializer([products[pk] for pk in page if pk in products], many=True)
+        return paginator.get_paginated_response(serializer.data)
@@ -1,25 +1,84 @@
+import json
+
+from django.contrib.auth import authenticate
+from django.db.models import prefetch_related_objects
 from rest_framework import serializers
-from shop_api.models import Shop, Product, Order, LineItem
+from rest_framework.reverse import reverse
+from shop_api import analytics, changes, inventory
+from shop_api.instrumentation import InstrumentedSerializerMixin, InstrumentedListSerializer
+from shop_api.models import Shop, Product, Order, LineItem, OrderEvent, OrderExport
+from shop_api.resolvers import resolve_order
+from shop_api.sparse import SparseFieldsetMixin, related_ids, relation_limit
+
+
+class ProductSerializer(InstrumentedSerializerMixin, SparseFieldsetMixin, serializers.ModelSerializer):
+    shop = serializers.PrimaryKeyRelatedField(read_only=True)
+
+    class Meta:
+        model = Product
+        fields = ('id', 'shop', 'name', 'description', 'price', 'stock')
+        list_serializer_class = InstrumentedListSerializer
+
+    def update(self, instance, validated_data):
+        # Reservations decrement the stock concurrently, it is only written when the request sets it
+        for attr, value in validated_data.items():
+            setattr(instance, attr, value)
 
+        instance.save(update_fields=list(validated_data) + ['updated_at'])
+        return instance
 
-class ShopSerializer(serializers.ModelSerializer):
-    products = serializers.PrimaryKeyRelatedField(read_only=True, many=True)
+
+class ShopListSerializer(InstrumentedListSerializer):
+    """
+    Loads the capped product lists of a page of shops with one query, and the expanded products with another
+    """
+
+    def to_representation(self, data):
+        shops = list(data)
+
+        if 'products' in self.child.fields:
+            product_ids = related_ids(Product, 'shop', [shop.pk for shop in shops], relation_limit())
+            for shop in shops:
+                shop.capped_product_ids = product_ids.get(shop.pk, [])
+
+            if self.child.is_expanded('products'):
+                products = Product.objects.in_bulk([pk for ids in product_ids.values() for pk in ids])
+                for shop in shops:
+                    shop.expanded_products = [products[pk] for pk in shop.capped_product_ids]
+
+        return super(ShopListSerializer, self).to_representation(shops)
+
+
+class ShopSerializer(InstrumentedSerializerMixin, SparseFieldsetMixin, serializers.ModelSerializer):
+    """
+    Shops list the ids of their first SHOP_API_RELATION_LIMIT products, or the products themselves with
+    expand=products. The complete list is paginated by the products endpoint of the shop.
+    """
+    products = serializers.SerializerMethodField()
     owner = serializers.PrimaryKeyRelatedField(read_only=True)
 
+    expandable_fields = ('products',)
+
     class Meta:
         model = Shop
         fields = ('id', 'name', 'owner', 'products')
+        list_serializer_class = ShopListSerializer
 
+    def get_products(self, shop):
+        product_ids = getattr(shop, 'capped_product_ids', None)
+        if product_ids is None:
+            product_ids = list(shop.products.order_by('pk').values_list('pk', flat=True)[:relation_limit()])
 
-class ProductSerializer(serializers.ModelSerializer):
-    shop = serializers.PrimaryKeyRelatedField(read_only=True)
+        if not self.is_expanded('products'):
+            return product_ids
 
-    class Meta:
-        model = Product
-        fields = ('id', 'shop', 'name', 'description', 'price')
+        products = getattr(shop, 'expanded_products', None)
+        if products is None:
+            products = sorted(Product.objects.filter(pk__in=product_ids), key=lambda product: product.pk)
+        return ProductSerializer(products, many=True, sparse=False, context=self.context).data
 
 
-class LineItemSerializer(serializers.ModelSerializer):
+class LineItemSerializer(InstrumentedSerializerMixin, SparseFieldsetMixin, serializers.ModelSerializer):
     product = serializers.PrimaryKeyRelatedField(queryset=Product.objects.all())
     price = serializers.ReadOnlyField()
     order = serializers.PrimaryKeyRelatedField(read_only=True)
@@ -27,32 +86,176 @@ class LineItemSerializer(serializers.ModelSerializer):
     class Meta:
         model = LineItem
         fields = ('id', 'order', 'product', 'quantity', 'price')
+        list_serializer_class = InstrumentedListSerializer
+        extra_kwargs = {'quantity': {'min_value': 1}}
 
     def validate_product(self, product):
-        order_id = self.context['request'].parser_context['kwargs'].get('order_id')
-        order = Order.objects.get(pk=order_id)
+        kwargs = self.context['request'].parser_context['kwargs']
+        order = resolve_order(self.context['request'], kwargs.get('shop_id'), kwargs.get('order_id'))
 
-        if order.shop != product.shop:
+        if order.shop_id != product.shop_id:
             raise serializers.ValidationError("This shop does not sell this product: %s" % product)
 
         return product
 
 
-class LineItemUpdateSerializer(serializers.ModelSerializer):
+class LineItemUpdateSerializer(InstrumentedSerializerMixin, SparseFieldsetMixin, serializers.ModelSerializer):
     product = serializers.PrimaryKeyRelatedField(read_only=True)
     price = serializers.ReadOnlyField()
 
     class Meta:
         model = LineItem
         fields = ('id', 'product', 'quantity', 'price')
+        extra_kwargs = {'quantity': {'min_value': 1}}
+
+
+class OrderLineItemSerializer(serializers.ModelSerializer):
+    """
+    Line item nested in an order. Products are submitted by id and resolved in bulk by OrderSerializer
+    """
+    product = serializers.IntegerField(source='product_id')
+    price = serializers.ReadOnlyField()
+    order = serializers.PrimaryKeyRelatedField(read_only=True)
+
+    class Meta:
+        model = LineItem
+        fields = ('id', 'order', 'product', 'quantity', 'price')
+        extra_kwargs = {'quantity': {'min_value': 1}}
 
 
-class OrderSerializer(serializers.ModelSerializer):
+class OrderSerializer(InstrumentedSerializerMixin, SparseFieldsetMixin, serializers.ModelSerializer):
     shop = serializers.PrimaryKeyRelatedField(read_only=True)
     client = serializers.PrimaryKeyRelatedField(read_only=True)
-    line_items = LineItemSerializer(read_only=True, many=True)
+    line_items = OrderLineItemSerializer(many=True, required=False)
     total = serializers.ReadOnlyField()
 
     class Meta:
         model = Order
         fields = ('id', 'client', 'shop', 'total', 'line_items')
+        list_serializer_class = InstrumentedListSerializer
+
+    def validate_line_items(self, line_items):
+        shop_id = self.context['request'].parser_context['kwargs'].get('shop_id')
+
+        # Every product is checked against the shop with a single IN query
+        product_ids = set(item['product_id'] for item in line_items)
+        products = Product.objects.filter(shop_id=shop_id).in_bulk(product_ids)
+
+        missing = sorted(product_ids - set(products))
+        if missing:
+            raise serializers.ValidationError(
+                "This shop does not sell these products: %s" % ', '.join(str(pk) for pk in missing)
+            )
+
+        for item in line_items:
+            item['product'] = products[item.pop('product_id')]
+
+        return line_items
+
+    def create(self, validated_data):
+        # Called in the transaction of the view
+        line_items = [
+            LineItem(product=item['product'], quantity=item.get('quantity', 1), price=item['product'].price)
+            for item in validated_data.pop('line_items', [])
+        ]
+
+        if not line_items:
+            order = Order.objects.create(**validated_data)
+            changes.order_added(order, [])
+            return order
+
+        order = Order.objects.create(total=sum(item.subtotal for item in line_items), **validated_data)
+
+        for item in line_items:
+            item.order = order
+        LineItem.objects.using(order._state.db).bulk_create(line_items)
+        analytics.order_added(order, line_items)
+
+        # SQLite doesn't return the ids of the inserted rows, the event and the response read them back
+        prefetch_related_objects([order], 'line_items')
+        changes.order_added(order, order.line_items.all())
+        inventory.reserve(inventory.quantities(line_items), order.shop_id)
+
+        return order
+
+
+class SalesSerializer(serializers.Serializer):
+    revenue = serializers.DecimalField(max_digits=19, decimal_places=2)
+    units = serializers.IntegerField()
+    orders = serializers.IntegerField()
+
+
+class DailySalesSerializer(SalesSerializer):
+    day = serializers.DateField()
+
+
+class ProductSalesSerializer(serializers.Serializer):
+    product = serializers.IntegerField(source='product_id')
+    name = serializers.CharField()
+    revenue = serializers.DecimalField(max_digits=19, decimal_places=2, source='total_revenue')
+    units = serializers.IntegerField(source='total_units')
+    orders = serializers.IntegerField(source='total_orders')
+
+
+class SalesReportSerializer(InstrumentedSerializerMixin, serializers.Serializer):
+    """
+    Read only representation of shop_api.analytics.sales_report()
+    """
+    shop = serializers.IntegerField()
+    start = serializers.DateField()
+    end = serializers.DateField()
+    totals = SalesSerializer()
+    days = DailySalesSerializer(many=True)
+    top_products = ProductSalesSerializer(many=True)
+
+
+class OrderEventSerializer(serializers.ModelSerializer):
+    type = serializers.CharField(source='kind')
+    order = serializers.IntegerField(source='order_id')
+    line_item = serializers.IntegerField(source='line_item_id')
+    data = serializers.SerializerMethodField()
+
+    class Meta:
+        model = OrderEvent
+        fields = ('id', 'type', 'order', 'line_item', 'created_at', 'data')
+
+    def get_data(self, event):
+        return json.loads(event.data)
+
+
+class ChangeFeedSerializer(InstrumentedSerializerMixin, serializers.Serializer):
+    """
+    Read only representation of a page of shop_api.changes events
+    """
+    events = OrderEventSerializer(many=True)
+    cursor = serializers.IntegerField()
+
+
+class OrderExportSerializer(serializers.ModelSerializer):
+    url = serializers.SerializerMethodField()
+
+    class Meta:
+        model = OrderExport
+        fields = ('id', 'url', 'output', 'since_id', 'status', 'error', 'size', 'created_at', 'finished_at')
+
+    def get_url(self, export):
+        return reverse('shop_api:orders-exports-detail', kwargs={'shop_id': export.shop_id, 'pk': export.pk},
+                       request=self.context.get('request'))
+
+
+class TokenRequestSerializer(serializers.Serializer):
+    username = serializers.CharField()
+    password = serializers.CharField(style={'input_type': 'password'}, trim_whitespace=False)
+
+    def validate(self, attrs):
+        user = authenticate(self.context.get('request'), username=attrs['username'], password=attrs['password'])
+        if user is None:
+            raise serializers.ValidationError('Unable to log in with the provided credentials.')
+
+        attrs['user'] = user
+        return attrs
+
+
+class TokenSerializer(serializers.Serializer):
+    token = serializers.CharField()
+    expires = serializers.DateTimeField()
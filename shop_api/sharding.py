@@ -0,0 +1,320 @@
+import datetime
+import time
+from contextlib import ExitStack, contextmanager
+from decimal import Decimal
+
+from django.conf import settings
+from django.db import DEFAULT_DB_ALIAS, IntegrityError, connections, transaction
+from django.db.models import Count, Max, Sum
+from django.utils import timezone
+from shop_api.models import Shop, Order, LineItem, ArchivedOrder, OrderEvent, OrderEventLock, ShardSequence
+from shop_api.routers import current_shop, set_current_shop
+
+
+# Shop-keyed sharding of the orders and line items.
+#
+# Shop.shard is the shard map: it names the database of SHOP_API_SHARDS holding the orders and line items of each
+# shop. Shops start on the default shard, the move_shop command moves the busiest ones to the other shards while they
+# keep taking orders. Rows keep their ids when they move, so every shard numbers the rows it creates in a range of
+# ID_SPAN ids of its own, and takes a new range above all the others before rows are moved in. The ids of the change
+# feed events keep growing as the shop moves, so that they stay valid cursors.
+
+ID_SPAN = 2 ** 40
+
+# Databases whose id sequences raise_sequences() can move
+SEQUENCE_VENDORS = ('sqlite', 'mysql', 'postgresql')
+
+
+def shards():
+    return getattr(settings, 'SHOP_API_SHARDS', [DEFAULT_DB_ALIAS])
+
+
+@contextmanager
+def shop_context(shop):
+    """
+    Makes shop the current shop, routing its orders and line items to its shard outside of the requests
+    """
+    previous = current_shop()
+    set_current_shop(shop)
+    try:
+        yield shop
+    finally:
+        set_current_shop(previous)
+
+
+@contextmanager
+def atomic(shop):
+    """
+    Transaction over the shard of shop and the default database. Commits aren't atomic across databases: the default
+    database, holding the stock reservations and sales rollups, commits first, so that a failure between the two
+    commits leaves units reserved for an order which doesn't exist rather than an order whose units weren't reserved.
+    """
+    with ExitStack() as stack:
+        if shop.shard != DEFAULT_DB_ALIAS:
+            stack.enter_context(transaction.atomic(using=shop.shard))
+        stack.enter_context(transaction.atomic())
+        yield
+
+
+def raise_sequences(alias, first_id):
+    """
+    Makes the next order, line item and order event created on alias start at first_id or above
+    """
+    connection = connections[alias]
+
+    with connection.cursor() as cursor:
+        for model in (Order, LineItem, OrderEvent):
+            table = model._meta.db_table
+
+            if connection.vendor == 'sqlite':
+                cursor.execute('SELECT seq FROM sqlite_sequence WHERE name = %s', [table])
+                row = cursor.fetchone()
+                if row is None:
+                    cursor.execute('INSERT INTO sqlite_sequence (name, seq) VALUES (%s, %s)', [table, first_id - 1])
+                elif row[0] < first_id - 1:
+                    cursor.execute('UPDATE sqlite_sequence SET seq = %s WHERE name = %s', [first_id - 1, table])
+            elif connection.vendor == 'mysql':
+                cursor.execute('ALTER TABLE %s AUTO_INCREMENT = %d' % (connection.ops.quote_name(table), first_id))
+            elif connection.vendor == 'postgresql':
+                # is_called false: the next value is first_id itself
+                cursor.execute('SELECT setval(pg_get_serial_sequence(%s, %s), %s, false)',
+                               [table, model._meta.pk.column, first_id])
+            else:
+                raise NotImplementedError('Moving the id sequences of %s databases' % connection.vendor)
+
+
+def take_id_range(alias):
+    """
+    Gives alias a range of ids above the ranges of every other shard, returns its first id.
+    The default shard starts in range 0.
+    """
+    while True:
+        last = ShardSequence.objects.aggregate(last=Max('id_range'))['last'] or 0
+        try:
+            with transaction.atomic():
+                ShardSequence.objects.update_or_create(alias=alias, defaults={'id_range': last + 1})
+            break
+        except IntegrityError:
+            # Another shard took the range first
+            continue
+
+    first_id = (last + 1) * ID_SPAN
+    raise_sequences(alias, first_id)
+    return first_id
+
+
+def shard_summary(alias, shop_id):
+    orders = Order.objects.using(alias).filter(shop_id=shop_id).aggregate(count=Count('id'), total=Sum('total'))
+    line_items = LineItem.objects.using(alias).filter(order__shop_id=shop_id).aggregate(
+        count=Count('id'), units=Sum('quantity')
+    )
+    archived = ArchivedOrder.objects.using(alias).filter(shop_id=shop_id).aggregate(
+        count=Count('id'), total=Sum('total')
+    )
+    # SQLite sums decimals as floats
+    total = Decimal(orders['total'] or 0).quantize(Decimal('0.01'))
+    archived_total = Decimal(archived['total'] or 0).quantize(Decimal('0.01'))
+    return orders['count'], total, line_items['count'], line_items['units'] or 0, archived['count'], archived_total
+
+
+class MoveFailed(Exception):
+    pass
+
+
+class ShopMove:
+    """
+    Moves the orders and line items of a shop to another shard while it keeps taking orders:
+
+    1. the target takes a new id range, so that the rows it creates never clash with the moved ones
+    2. the orders are copied in batches, then the orders changed or archived meanwhile are copied again until few
+       are left. Every change to a line item bumps the updated_at of its order. The change feed events added since
+       the last pass are appended.
+    3. the shop is locked: writes to its orders fail with 503 while the requests in flight finish for `grace`
+       seconds, then the last changes and deletions are copied and both copies are compared
+    4. the shop is switched to the target and unlocked. Once the reads in flight or served by lagging replicas
+       had `grace` seconds to finish, the rows left on the source are deleted.
+
+    Reads are never interrupted, writes are refused for about `grace` seconds.
+    """
+
+    # Clock skew tolerated between the web servers
+    skew = datetime.timedelta(seconds=1)
+
+    def __init__(self, shop, target, batch_size=1000, grace=10, max_passes=10, log=None):
+        self.shop = shop
+        self.source = shop.shard
+        self.target = target
+        self.batch_size = batch_size
+        self.grace = grace
+        self.max_passes = max_passes
+        self.log = log or (lambda message: None)
+        # Id of the last change feed event copied
+        self.last_event = 0
+        # A write stamps updated_at before it commits, a pass also copies the writes in flight when the last one began
+        self.overlap = datetime.timedelta(seconds=grace) + self.skew
+
+    def orders(self, alias):
+        return Order.objects.using(alias).filter(shop_id=self.shop.pk)
+
+    def archived_orders(self, alias):
+        return ArchivedOrder.objects.using(alias).filter(shop_id=self.shop.pk)
+
+    def copy(self, order_ids):
+        """
+        Replaces the copies of the orders and archived orders with ids order_ids on the target, orders missing from
+        the source are deleted
+        """
+        # Read in one transaction, an order being archived is either live or archived
+        with transaction.atomic(using=self.source):
+            orders = list(self.orders(self.source).filter(pk__in=order_ids))
+            line_items = list(LineItem.objects.using(self.source).filter(order_id__in=order_ids))
+            archived_orders = list(self.archived_orders(self.source).filter(pk__in=order_ids))
+
+        with transaction.atomic(using=self.target):
+            LineItem.objects.using(self.target).filter(order_id__in=order_ids).delete()
+            self.orders(self.target).filter(pk__in=order_ids).delete()
+            self.archived_orders(self.target).filter(pk__in=order_ids).delete()
+            Order.objects.using(self.target).bulk_create(orders)
+            LineItem.objects.using(self.target).bulk_create(line_items)
+            ArchivedOrder.objects.using(self.target).bulk_create(archived_orders)
+
+    def copy_changed(self, since):
+        """
+        Copies the orders changed or archived since `since`, or every order when it is None, returns how many were
+        copied
+        """
+        orders = self.orders(self.source)
+        archived_orders = self.archived_orders(self.source)
+        if since is not None:
+            orders = orders.filter(updated_at__gte=since - self.overlap)
+            archived_orders = archived_orders.filter(archived_at__gte=since - self.overlap)
+
+        copied = 0
+        for queryset in (orders, archived_orders):
+            last_id = 0
+            while True:
+                batch = list(
+                    queryset.filter(pk__gt=last_id).order_by('pk').values_list('pk', flat=True)[:self.batch_size]
+                )
+                if not batch:
+                    break
+
+                self.copy(batch)
+                copied += len(batch)
+                last_id = batch[-1]
+
+        return copied
+
+    def copy_events(self):
+        """
+        Appends the change feed events added to the source since the last call to the target, returns how many were
+        copied. Events are never changed, those dropped from the source meanwhile are dropped by the next compaction.
+        """
+        copied = 0
+        while True:
+            events = list(
+                OrderEvent.objects.using(self.source).filter(shop_id=self.shop.pk, pk__gt=self.last_event)
+                .order_by('pk')[:self.batch_size]
+            )
+            if not events:
+                return copied
+
+            OrderEvent.objects.using(self.target).bulk_create(events)
+            copied += len(events)
+            self.last_event = events[-1].pk
+
+    def copy_deletions(self):
+        last_id = 0
+        while True:
+            batch = list(
+                self.orders(self.target).filter(pk__gt=last_id).order_by('pk')
+                .values_list('pk', flat=True)[:self.batch_size]
+            )
+            if not batch:
+                return
+
+            deleted = set(batch) - set(self.orders(self.source).filter(pk__in=batch).values_list('pk', flat=True))
+            if deleted:
+                self.copy(list(deleted))
+            last_id = batch[-1]
+
+    def delete(self, alias):
+        while True:
+            batch = list(self.orders(alias).order_by('pk').values_list('pk', flat=True)[:self.batch_size])
+            if not batch:
+                break
+
+            with transaction.atomic(using=alias):
+                LineItem.objects.using(alias).filter(order_id__in=batch).delete()
+                self.orders(alias).filter(pk__in=batch).delete()
+
+        while True:
+            batch = list(self.archived_orders(alias).order_by('pk').values_list('pk', flat=True)[:self.batch_size])
+            if not batch:
+                break
+
+            self.archived_orders(alias).filter(pk__in=batch).delete()
+
+        events = OrderEvent.objects.using(alias).filter(shop_id=self.shop.pk)
+        while True:
+            batch = list(events.order_by('pk').values_list('pk', flat=True)[:self.batch_size])
+            if not batch:
+                break
+
+            events.filter(pk__in=batch).delete()
+
+        OrderEventLock.objects.using(alias).filter(shop_id=self.shop.pk).delete()
+
+    def set_shop(self, **fields):
+        Shop.objects.filter(pk=self.shop.pk).update(**fields)
+        for name, value in fields.items():
+            setattr(self.shop, name, value)
+
+    def run(self):
+        if self.source == self.target:
+            raise MoveFailed('Shop %d is already on %s' % (self.shop.pk, self.target))
+        # Refused before anything is written rather than once the rows are being moved
+        vendor = connections[self.target].vendor
+        if vendor not in SEQUENCE_VENDORS:
+            raise MoveFailed('The id sequences of %s can\'t be moved, %s databases aren\'t supported' % (
+                self.target, vendor
+            ))
+
+        first_id = take_id_range(self.target)
+        self.log('%s numbers its new rows from %d' % (self.target, first_id))
+
+        since = None
+        for _ in range(self.max_passes):
+            started = timezone.now()
+            changed = self.copy_changed(since)
+            since = started
+            self.log('Copied %d orders and %d events' % (changed, self.copy_events()))
+            if changed < self.batch_size:
+                break
+
+        self.set_shop(shard_locked=True)
+        try:
+            self.log('Locked the shop, waiting %ss for the writes in flight' % self.grace)
+            time.sleep(self.grace)
+
+            self.log('Copied the last %d changed orders' % self.copy_changed(since))
+            self.copy_deletions()
+            self.copy_events()
+
+            source, target = shard_summary(self.source, self.shop.pk), shard_summary(self.target, self.shop.pk)
+            if source != target:
+                raise MoveFailed('The copy differs from the source (orders, total, line items, units, archived orders, '
+                                 'archived total): %s != %s' % (
+                    target, source
+                ))
+
+            self.set_shop(shard=self.target, shard_locked=False)
+        except BaseException:
+            self.set_shop(shard_locked=False)
+            raise
+
+        self.log('Switched the shop to %s, waiting %ss for the reads in flight' % (self.target, self.grace))
+        time.sleep(self.grace)
+        self.delete(self.source)
+        self.log('Deleted the orders left on %s' % self.source)
+        return source
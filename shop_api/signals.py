@@ -0,0 +1,91 @@
+import os
+
+from django.contrib.auth.models import User
+from django.core.signals import request_finished
+from django.db import DEFAULT_DB_ALIAS
+from django.db.models.signals import post_save, post_delete, pre_delete
+from django.dispatch import receiver
+from shop_api import metrics
+from shop_api.authentication import get_user_cache
+from shop_api.cache import get_catalog_cache, invalidate_products, shop_list_namespace, shop_namespace
+from shop_api.exports import export_path
+from shop_api.models import Shop, Product, Order, LineItem, ArchivedOrder, OrderEvent, OrderEventLock, \
+    OrderExport
+from shop_api.search import get_search_backend
+
+
+@receiver(request_finished)
+def flush_metrics(sender, **kwargs):
+    # The response was sent, the samples queued while handling it no longer hold the client
+    metrics.flush()
+
+
+@receiver([post_save, post_delete], sender=Shop)
+def invalidate_shop(sender, instance, **kwargs):
+    cache = get_catalog_cache()
+    cache.invalidate(shop_list_namespace())
+    cache.invalidate(shop_namespace(instance.pk))
+
+    if kwargs['signal'] is post_save and not kwargs.get('raw'):
+        Shop.touch(instance.pk)
+
+
+@receiver([post_save, post_delete], sender=Product)
+def invalidate_product(sender, instance, **kwargs):
+    invalidate_products(instance.shop_id, [instance.pk])
+
+    if not kwargs.get('raw'):
+        Shop.touch(instance.shop_id)
+
+
+@receiver(post_save, sender=Product)
+def index_product(sender, instance, created=False, **kwargs):
+    get_search_backend().index([instance], new=created)
+
+
+@receiver(post_delete, sender=Product)
+def unindex_product(sender, instance, **kwargs):
+    get_search_backend().remove([instance.pk])
+
+
+@receiver(post_delete, sender=OrderExport)
+def remove_export_file(sender, instance, **kwargs):
+    for path in (export_path(instance), export_path(instance) + '.part'):
+        try:
+            os.remove(path)
+        except FileNotFoundError:
+            pass
+
+
+@receiver([post_save, post_delete], sender=User)
+def uncache_user(sender, instance, **kwargs):
+    get_user_cache().discard(instance.pk)
+
+
+# The deletions only cascade to the orders, line items, archived orders and order events of the default shard, those
+# of the other shards are taken care of here. Archived line items keep the ids of the products deleted since.
+
+@receiver(pre_delete, sender=Shop)
+def delete_sharded_orders(sender, instance, **kwargs):
+    if instance.shard != DEFAULT_DB_ALIAS:
+        LineItem.objects.using(instance.shard).filter(order__shop_id=instance.pk).delete()
+        Order.objects.using(instance.shard).filter(shop_id=instance.pk).delete()
+        ArchivedOrder.objects.using(instance.shard).filter(shop_id=instance.pk).delete()
+        OrderEvent.objects.using(instance.shard).filter(shop_id=instance.pk).delete()
+        OrderEventLock.objects.using(instance.shard).filter(shop_id=instance.pk).delete()
+
+
+@receiver(pre_delete, sender=Product)
+def delete_sharded_line_items(sender, instance, **kwargs):
+    # Orders only sell products of their shop
+    shard = Shop.objects.filter(pk=instance.shop_id).values_list('shard', flat=True).first()
+    if shard is not None and shard != DEFAULT_DB_ALIAS:
+        LineItem.objects.using(shard).filter(product_id=instance.pk).delete()
+
+
+@receiver(pre_delete, sender=User)
+def orphan_sharded_orders(sender, instance, **kwargs):
+    shards = Shop.objects.exclude(shard=DEFAULT_DB_ALIAS).order_by().values_list('shard', flat=True).distinct()
+    for shard in shards:
+        Order.objects.using(shard).filter(client_id=instance.pk).update(client=None)
+        ArchivedOrder.objects.using(shard).filter(client_id=instance.pk).update(client=None)
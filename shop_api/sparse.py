@@ -0,0 +1,132 @@
+from collections import defaultdict
+
+from django.conf import settings
+from django.db import connections, router
+from rest_framework import permissions
+from rest_framework.exceptions import ValidationError
+
+
+# Sparse fieldsets and relation expansion.
+#
+# GET requests may pass `fields=id,name` to only receive some fields of the resources, and `expand=products` to embed
+# related resources instead of their ids. The views defer the columns of the omitted fields and skip the prefetches
+# of omitted relations, so that clients only pay for what they read.
+
+FIELDS_PARAM = 'fields'
+EXPAND_PARAM = 'expand'
+
+
+def relation_limit():
+    return getattr(settings, 'SHOP_API_RELATION_LIMIT', 1000)
+
+
+def query_list(request, name):
+    """
+    Comma separated values of a query parameter, None when it is absent or when the request isn't a read
+    """
+    if request is None or request.method not in permissions.SAFE_METHODS:
+        return None
+
+    value = request.query_params.get(name)
+    if value is None:
+        return None
+    return [item.strip() for item in value.split(',') if item.strip()]
+
+
+class SparseFieldsetMixin:
+    """
+    Drops the fields of a serializer which aren't listed in the `fields` query parameter.
+    Serializers list the relations `expand` may embed in expandable_fields.
+    Nested serializers are created with sparse=False so that they keep all their fields.
+    """
+
+    expandable_fields = ()
+
+    def __init__(self, *args, **kwargs):
+        sparse = kwargs.pop('sparse', True)
+        super(SparseFieldsetMixin, self).__init__(*args, **kwargs)
+
+        request = self.context.get('request') if sparse else None
+        self.expand = set()
+
+        fields = query_list(request, FIELDS_PARAM)
+        if fields is not None:
+            unknown = set(fields) - set(self.fields)
+            if unknown:
+                raise ValidationError({FIELDS_PARAM: 'Unknown fields: %s' % ', '.join(sorted(unknown))})
+
+            for name in set(self.fields) - set(fields):
+                self.fields.pop(name)
+
+        expand = query_list(request, EXPAND_PARAM)
+        if expand is not None:
+            unknown = set(expand) - set(self.expandable_fields)
+            if unknown:
+                raise ValidationError({
+                    EXPAND_PARAM: 'Fields which can\'t be expanded: %s' % ', '.join(sorted(unknown))
+                })
+
+            self.expand = set(expand) & set(self.fields)
+
+    def is_expanded(self, name):
+        return name in self.expand
+
+
+class SparseQuerysetMixin:
+    """
+    Defers the columns of the fields omitted from the `fields` query parameter of a generic view
+    """
+
+    def wants_field(self, name):
+        fields = query_list(self.request, FIELDS_PARAM)
+        return fields is None or name in fields
+
+    def filter_queryset(self, queryset):
+        queryset = super(SparseQuerysetMixin, self).filter_queryset(queryset)
+
+        fields = query_list(self.request, FIELDS_PARAM)
+        if fields is None:
+            return queryset
+
+        model = queryset.model
+        columns = [field.name for field in model._meta.concrete_fields if field.name in fields]
+        return queryset.only(model._meta.pk.name, *columns)
+
+
+def related_ids(model, parent_field, parent_ids, limit):
+    """
+    Ids of the first `limit` rows of model related to each of parent_ids through the foreign key parent_field,
+    as a {parent_id: [id, ...]} dict. Databases supporting window functions never return rows past the limit.
+    """
+    connection = connections[router.db_for_read(model)]
+    quote = connection.ops.quote_name
+    column = model._meta.get_field(parent_field).column
+    related = defaultdict(list)
+    parent_ids = list(parent_ids)
+
+    # Keeps the number of parameters under the limits of the backends
+    for start in range(0, len(parent_ids), 500):
+        chunk = parent_ids[start:start + 500]
+
+        if getattr(connection.features, 'supports_over_clause', False):
+            sql = (
+                'SELECT parent, id FROM ('
+                'SELECT {column} AS parent, {pk} AS id, '
+                'ROW_NUMBER() OVER (PARTITION BY {column} ORDER BY {pk}) AS position '
+                'FROM {table} WHERE {column} IN ({params})'
+                ') ranked WHERE position <= %s ORDER BY parent, id'
+            ).format(column=quote(column), pk=quote(model._meta.pk.column), table=quote(model._meta.db_table),
+                     params=', '.join(['%s'] * len(chunk)))
+
+            with connection.cursor() as cursor:
+                cursor.execute(sql, chunk + [limit])
+                rows = cursor.fetchall()
+        else:
+            rows = model.objects.filter(**{parent_field + '__in': chunk}).order_by(parent_field, 'pk') \
+                .values_list(parent_field, 'pk')
+
+        for parent, pk in rows:
+            if len(related[parent]) < limit:
+                related[parent].append(pk)
+
+    return related
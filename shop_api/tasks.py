@@ -0,0 +1,189 @@
+import datetime
+import json
+import time
+import traceback
+
+from django.conf import settings
+from django.core.serializers.json import DjangoJSONEncoder
+from django.db import IntegrityError, close_old_connections, transaction
+from django.db.models import F, Q
+from django.utils import timezone
+from django.utils.module_loading import import_string
+from shop_api import metrics
+from shop_api.models import Task
+from shop_api.routers import set_current_shop
+
+
+# Background tasks.
+#
+# Work which the response doesn't wait for is queued as a Task row of the default database and run by the
+# run_workers processes, so that it doesn't hold one of the gunicorn threads. A task is the dotted path of a function
+# along with JSON keyword arguments. A task queued in a transaction of the default database commits or rolls back
+# with the rows it is about, enqueue_on_commit() waits for the transaction of another database (a shard) instead.
+#
+# Workers claim the due tasks with conditional UPDATEs, the way checkouts reserve stock: nothing stays locked while a
+# task runs, the claim holds a lease of SHOP_API_TASK_LEASE seconds after which another worker takes the task over.
+# Failed attempts are retried with an exponential backoff. A dedup key keeps a single task waiting for the same work,
+# it is released as a worker starts the task so that the changes made during the run queue another one.
+
+
+def lease():
+    return datetime.timedelta(seconds=getattr(settings, 'SHOP_API_TASK_LEASE', 300))
+
+
+def backoff(attempts):
+    """
+    Delay before the attempt following the attempts-th failed one
+    """
+    delay = getattr(settings, 'SHOP_API_TASK_BACKOFF', 10) * 2 ** (attempts - 1)
+    return datetime.timedelta(seconds=min(delay, getattr(settings, 'SHOP_API_TASK_MAX_BACKOFF', 3600)))
+
+
+def enqueue(name, kwargs=None, dedup_key=None, delay=0, max_attempts=None):
+    """
+    Queues a call of the function at the dotted path name with kwargs, in delay seconds. Returns the task, or the task
+    already waiting with dedup_key.
+    """
+    fields = {
+        'name': name,
+        'kwargs': json.dumps(kwargs or {}, cls=DjangoJSONEncoder),
+        'run_at': timezone.now() + datetime.timedelta(seconds=delay),
+    }
+    if max_attempts is not None:
+        fields['max_attempts'] = max_attempts
+
+    if dedup_key is None:
+        return Task.objects.create(**fields)
+
+    while True:
+        try:
+            with transaction.atomic():
+                return Task.objects.create(dedup_key=dedup_key, **fields)
+        except IntegrityError:
+            waiting = Task.objects.filter(dedup_key=dedup_key).first()
+            if waiting is not None:
+                return waiting
+            # A worker started the waiting task meanwhile
+
+
+def enqueue_on_commit(name, kwargs=None, using=None, **options):
+    """
+    Queues the task once the transaction of the database `using` commits, right away outside of a transaction
+    """
+    transaction.on_commit(lambda: enqueue(name, kwargs, **options), using=using)
+
+
+def purge(before, batch_size=1000):
+    """
+    Deletes the tasks which finished before `before`, returns how many were deleted
+    """
+    finished = Task.objects.filter(finished_at__lt=before)
+    deleted = 0
+    while True:
+        batch = list(finished.values_list('pk', flat=True)[:batch_size])
+        if not batch:
+            return deleted
+
+        deleted += Task.objects.filter(pk__in=batch).delete()[0]
+
+
+class Worker:
+    """
+    Runs the due tasks one at a time, polling the queue every `poll` seconds while it is empty. A burst worker returns
+    once no task is due. stop() makes run() return after the task in progress.
+    """
+
+    # Due tasks read per claim, the other workers take some of them meanwhile
+    candidates = 10
+
+    def __init__(self, poll=1, burst=False, purge_interval=3600, log=None):
+        self.poll = poll
+        self.burst = burst
+        self.purge_interval = purge_interval
+        self.log = log or (lambda message: None)
+        self.stopping = False
+
+    def stop(self):
+        self.stopping = True
+
+    def claim(self):
+        now = timezone.now()
+        due = Q(status=Task.PENDING, run_at__lte=now) | Q(status=Task.RUNNING, locked_until__lt=now)
+        candidates = Task.objects.filter(due).order_by('run_at', 'pk').values_list('pk', flat=True)
+
+        for pk in list(candidates[:self.candidates]):
+            # Only one of the workers reading the same candidate updates it
+            claimed = Task.objects.filter(due, pk=pk).update(
+                status=Task.RUNNING, attempts=F('attempts') + 1, locked_until=now + lease(), dedup_key=None
+            )
+            if claimed:
+                return Task.objects.get(pk=pk)
+
+        return None
+
+    def finish(self, task, **fields):
+        # The lease may have expired and the task been taken over, the other worker reports
+        Task.objects.filter(pk=task.pk, status=Task.RUNNING, attempts=task.attempts).update(
+            locked_until=None, **fields
+        )
+
+    def execute(self, task):
+        """
+        Runs an attempt of the claimed task, returns its outcome: done, retried or failed
+        """
+        metrics.TASK_LATENCY.labels(task.name).observe(max((timezone.now() - task.run_at).total_seconds(), 0))
+
+        started = time.perf_counter()
+        try:
+            if task.attempts > task.max_attempts:
+                raise RuntimeError('The lease of the last attempt expired')
+            import_string(task.name)(**json.loads(task.kwargs))
+        except Exception:
+            error = traceback.format_exc()
+            if task.attempts < task.max_attempts:
+                outcome = 'retried'
+                self.finish(task, status=Task.PENDING, run_at=timezone.now() + backoff(task.attempts),
+                            last_error=error)
+            else:
+                outcome = 'failed'
+                self.finish(task, status=Task.FAILED, finished_at=timezone.now(), last_error=error)
+            self.log('%s attempt %d of %d failed:\n%s' % (task, task.attempts, task.max_attempts, error))
+        else:
+            outcome = 'done'
+            self.finish(task, status=Task.DONE, finished_at=timezone.now())
+        finally:
+            set_current_shop(None)
+
+        metrics.TASK_DURATION.labels(task.name).observe(time.perf_counter() - started)
+        metrics.TASKS.labels(task.name, outcome).inc()
+        # Samples the task queued, e.g. catalog cache evictions
+        metrics.flush()
+        return outcome
+
+    def run(self):
+        """
+        Runs tasks until stopped, returns how many attempts were run
+        """
+        attempts = 0
+        next_purge = time.monotonic()
+
+        while not self.stopping:
+            # Like at the end of a request, a long lived process must not keep broken or expired connections
+            close_old_connections()
+
+            if time.monotonic() >= next_purge:
+                retention = datetime.timedelta(days=getattr(settings, 'SHOP_API_TASK_RETENTION_DAYS', 7))
+                purge(timezone.now() - retention)
+                next_purge = time.monotonic() + self.purge_interval
+
+            task = self.claim()
+            if task is None:
+                if self.burst:
+                    break
+                time.sleep(self.poll)
+                continue
+
+            self.execute(task)
+            attempts += 1
+
+        return attempts
@@ -1,3 +1,1487 @@
-from django.test import TestCase
+import datetime
+import json
+import os
+import random
+import tempfile
+import threading
+import time
+from contextlib import contextmanager
+from decimal import Decimal
+from io import StringIO
+from unittest.mock import patch
 
-# Create your tests here.
+from django.contrib.auth.models import Permission, User
+from django.core.cache import caches
+from django.core.management import call_command
+from django.db import connection, connections, router as db_router
+from django.http import HttpResponse
+from django.test import RequestFactory, TestCase, TransactionTestCase, override_settings
+from django.test.utils import CaptureQueriesContext
+from django.urls import reverse
+from django.utils import timezone
+from prometheus_client import REGISTRY
+from rest_framework.renderers import JSONRenderer
+from rest_framework.test import APIClient
+
+from shop_api import changes, metrics
+from shop_api.authentication import RevocationList, get_revocation_list, get_user_cache, issue_token, read_token
+from shop_api.benchmarks import SCENARIOS, Benchmark, BenchmarkData, FlashSale, InProcessClient, create_session
+from shop_api.cache import LRUCache, get_catalog_cache
+from shop_api.imports import CatalogImport, NameCollation
+from shop_api.instrumentation import RequestTimings, current_timings, set_current_timings
+from shop_api.models import Shop, Product, Order, LineItem, ArchivedOrder, ShopDailySales, ProductDailySales, Task, \
+    OrderExport, OrderEventLock, RevokedToken, ShardSequence
+from shop_api.profiling import StackSampler
+from shop_api.routers import PIN_COOKIE, ReplicaPool, ReplicaRoutingMiddleware, check_connection, current_shop, \
+    set_current_shop
+from shop_api.search import MySQLFullTextBackend, check_search_backend, parse_query
+from shop_api.serializers import OrderSerializer, ProductSerializer
+from shop_api.sharding import ID_SPAN, MoveFailed, ShopMove
+from shop_api.tasks import Worker, enqueue
+from shop_api.views import ProductImportView
+
+
+class OrderTotalTests(TestCase):
+
+    fixtures = ['users', 'shops', 'products']
+    multi_db = True
+
+    def setUp(self):
+        self.api = APIClient()
+        self.api.force_authenticate(User.objects.get(pk=4))
+
+    def total(self, order_id):
+        return Order.objects.get(pk=order_id).total
+
+    def reconcile(self, *args):
+        output = StringIO()
+        call_command('reconcile_order_totals', *args, stdout=output)
+        return output.getvalue()
+
+    def test_line_item_changes_adjust_the_total(self):
+        order_id = self.api.post(reverse('shop_api:orders-listcreate', kwargs={'shop_id': 1}), {},
+                                 format='json').data['id']
+        url = reverse('shop_api:lineitems-listcreate', kwargs={'shop_id': 1, 'order_id': order_id})
+
+        line_item_id = self.api.post(url, {'product': 1, 'quantity': 3}, format='json').data['id']
+        self.assertEqual(self.total(order_id), Decimal('49.50'))
+        self.api.post(url, {'product': 2}, format='json')
+        self.assertEqual(self.total(order_id), Decimal('173.07'))
+
+        line_item_url = reverse('shop_api:lineitems-rud', kwargs={'shop_id': 1, 'order_id': order_id,
+                                                                   'pk': line_item_id})
+        self.api.patch(line_item_url, {'quantity': 1}, format='json')
+        self.assertEqual(self.total(order_id), Decimal('140.07'))
+        self.api.delete(line_item_url)
+        self.assertEqual(self.total(order_id), Decimal('123.57'))
+
+        order = Order.objects.get(pk=order_id)
+        order.update_total()
+        self.assertEqual(order.total, Decimal('123.57'))
+
+    def test_reconcile_fixes_the_drifted_totals(self):
+        drifted = Order.objects.create(shop_id=1)
+        LineItem.objects.create(order=drifted, product_id=1, quantity=2, price=Decimal('16.50'))
+        LineItem.objects.create(order=drifted, product_id=2, price=Decimal('123.57'))
+        # SQLite adds decimals as floats, 0.10 + 0.20 must still equal the stored total
+        exact = Order.objects.create(shop_id=1, total=Decimal('0.30'))
+        LineItem.objects.create(order=exact, product_id=1, price=Decimal('0.10'))
+        LineItem.objects.create(order=exact, product_id=2, price=Decimal('0.20'))
+
+        output = self.reconcile('--dry-run')
+        self.assertIn('Order %s: stored 0.00, computed 156.57' % drifted.pk, output)
+        self.assertNotIn('Order %s:' % exact.pk, output)
+        self.assertIn('Found 1 drifted totals', output)
+        self.assertEqual(self.total(drifted.pk), 0)
+
+        self.assertIn('Fixed 1 drifted totals', self.reconcile('--batch-size', '1'))
+        self.assertEqual(self.total(drifted.pk), Decimal('156.57'))
+        self.assertEqual(self.total(exact.pk), Decimal('0.30'))
+        self.assertIn('Fixed 0 drifted totals', self.reconcile())
+
+
+class QueryBudgetTests(TestCase):
+    """
+    Pins the maximum number of SQL queries issued by each route in shop_api/urls.py.
+    The fixtures are grown so that any N+1 pattern blows through the budget.
+    """
+
+    fixtures = ['users', 'shops', 'products', 'orders', 'lineitems']
+
+    EXTRA_ORDERS = 20
+    ITEMS_PER_ORDER = 5
+
+    @classmethod
+    def setUpTestData(cls):
+        cls.shop = Shop.objects.get(pk=1)
+        cls.shop_owner = cls.shop.owner
+        cls.client_user = User.objects.get(pk=4)
+
+        products = list(cls.shop.products.all())
+        for i in range(cls.EXTRA_ORDERS):
+            order = Order.objects.create(shop=cls.shop, client=cls.client_user)
+            LineItem.objects.bulk_create(
+                LineItem(order=order, product=products[j % len(products)], quantity=j + 1,
+                         price=products[j % len(products)].price)
+                for j in range(cls.ITEMS_PER_ORDER)
+            )
+            order.update_total()
+            order.save()
+
+        # Writes then shift existing sales rollups, as they do past the first sale of the day
+        call_command('backfill_sales_rollups', stdout=StringIO())
+        # and append to a change feed which already has events
+        OrderEventLock.objects.create(shop=cls.shop)
+
+        cls.order = Order.objects.filter(shop=cls.shop, client=cls.client_user).last()
+        cls.line_item = cls.order.line_items.first()
+        cls.product = products[0]
+
+    def setUp(self):
+        self.api = APIClient()
+        get_catalog_cache().clear()
+
+    @contextmanager
+    def assertMaxQueries(self, budget):
+        with CaptureQueriesContext(connection) as context:
+            yield context
+
+        executed = len(context.captured_queries)
+        if executed > budget:
+            queries = '\n'.join(query['sql'] for query in context.captured_queries)
+            self.fail('%d queries executed, budget is %d\n%s' % (executed, budget, queries))
+
+    def test_shops_listcreate(self):
+        url = reverse('shop_api:shops-listcreate')
+        with self.assertMaxQueries(4):
+            response = self.api.get(url)
+        self.assertEqual(response.status_code, 200)
+
+        self.api.force_authenticate(self.shop_owner)
+        with self.assertMaxQueries(4):
+            response = self.api.post(url, {'name': 'Budget Shop'}, format='json')
+        self.assertEqual(response.status_code, 201)
+
+    def test_shops_rud(self):
+        url = reverse('shop_api:shops-rud', kwargs={'pk': self.shop.pk})
+        with self.assertMaxQueries(3):
+            response = self.api.get(url)
+        self.assertEqual(response.status_code, 200)
+
+    def test_products_listcreate(self):
+        url = reverse('shop_api:products-listcreate', kwargs={'shop_id': self.shop.pk})
+        with self.assertMaxQueries(2):
+            response = self.api.get(url)
+        self.assertEqual(response.status_code, 200)
+
+        with self.assertMaxQueries(3):
+            response = self.api.get(url, {'q': 'product'})
+        self.assertEqual(response.status_code, 200)
+
+        self.api.force_authenticate(self.shop_owner)
+        with self.assertMaxQueries(5):
+            response = self.api.post(url, {'name': 'Budget Product', 'price': '1.00'}, format='json')
+        self.assertEqual(response.status_code, 201)
+
+    def test_products_search(self):
+        with self.assertMaxQueries(2):
+            response = self.api.get(reverse('shop_api:products-search'), {'q': 'product'})
+        self.assertEqual(response.status_code, 200)
+
+    def test_products_rud(self):
+        url = reverse('shop_api:products-rud', kwargs={'shop_id': self.shop.pk, 'pk': self.product.pk})
+        with self.assertMaxQueries(3):
+            response = self.api.get(url)
+        self.assertEqual(response.status_code, 200)
+
+    def test_orders_listcreate(self):
+        url = reverse('shop_api:orders-listcreate', kwargs={'shop_id': self.shop.pk})
+        with self.assertMaxQueries(3):
+            response = self.api.get(url)
+        self.assertEqual(response.status_code, 200)
+        self.assertGreaterEqual(len(response.data['results']), self.EXTRA_ORDERS)
+
+        # Writes lock the change feed of the shop and append an event to it in their transaction
+        self.api.force_authenticate(self.client_user)
+        with self.assertMaxQueries(7):
+            response = self.api.post(url, {}, format='json')
+        self.assertEqual(response.status_code, 201)
+
+        line_items = [{'product': self.product.pk, 'quantity': quantity} for quantity in range(1, 51)]
+        with self.assertMaxQueries(12):
+            response = self.api.post(url, {'line_items': line_items}, format='json')
+        self.assertEqual(response.status_code, 201)
+        self.assertEqual(len(response.data['line_items']), 50)
+        self.assertEqual(Order.objects.get(pk=response.data['id']).total, 1275 * self.product.price)
+
+        other_shop_product = Product.objects.exclude(shop=self.shop).first()
+        response = self.api.post(url, {'line_items': [{'product': other_shop_product.pk}]}, format='json')
+        self.assertEqual(response.status_code, 400)
+
+    def test_orders_export(self):
+        url = reverse('shop_api:orders-export', kwargs={'shop_id': self.shop.pk})
+        self.api.force_authenticate(self.shop_owner)
+        with self.assertMaxQueries(4):
+            response = self.api.get(url)
+            lines = b''.join(response.streaming_content).splitlines()
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(len(lines), self.shop.orders.count())
+
+        # Documents are encoded like the API encodes the orders, totals and prices included
+        document = json.loads(lines[0].decode('utf-8'))
+        order = Order.objects.get(pk=document['id'])
+        self.assertEqual(document, json.loads(JSONRenderer().render(OrderSerializer(order).data).decode('utf-8')))
+        self.assertIsInstance(document['total'], float)
+
+        with self.assertMaxQueries(4):
+            response = self.api.get(url, {'output': 'csv', 'since_id': self.order.pk - 1})
+            lines = b''.join(response.streaming_content).splitlines()
+        self.assertEqual(len(lines), 1 + self.ITEMS_PER_ORDER)
+
+    def test_orders_rud(self):
+        url = reverse('shop_api:orders-rud', kwargs={'shop_id': self.shop.pk, 'pk': self.order.pk})
+        with self.assertMaxQueries(4):
+            response = self.api.get(url)
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(len(response.data['line_items']), self.ITEMS_PER_ORDER)
+
+    def test_lineitems_listcreate(self):
+        url = reverse('shop_api:lineitems-listcreate', kwargs={'shop_id': self.shop.pk, 'order_id': self.order.pk})
+        self.api.force_authenticate(self.client_user)
+        with self.assertMaxQueries(2):
+            response = self.api.get(url)
+        self.assertEqual(response.status_code, 200)
+
+        total = Order.objects.get(pk=self.order.pk).total
+        with self.assertMaxQueries(13):
+            response = self.api.post(url, {'product': self.product.pk, 'quantity': 2}, format='json')
+        self.assertEqual(response.status_code, 201)
+        self.assertEqual(Order.objects.get(pk=self.order.pk).total, total + 2 * self.product.price)
+
+    def test_lineitems_rud(self):
+        url = reverse('shop_api:lineitems-rud', kwargs={
+            'shop_id': self.shop.pk, 'order_id': self.order.pk, 'pk': self.line_item.pk
+        })
+        self.api.force_authenticate(self.client_user)
+        with self.assertMaxQueries(2):
+            response = self.api.get(url)
+        self.assertEqual(response.status_code, 200)
+
+        total = Order.objects.get(pk=self.order.pk).total
+        with self.assertMaxQueries(13):
+            response = self.api.patch(url, {'quantity': self.line_item.quantity + 1}, format='json')
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(Order.objects.get(pk=self.order.pk).total, total + self.line_item.price)
+
+        with self.assertMaxQueries(13):
+            response = self.api.delete(url)
+        self.assertEqual(response.status_code, 204)
+        self.assertEqual(
+            Order.objects.get(pk=self.order.pk).total,
+            total - self.line_item.price * self.line_item.quantity
+        )
+
+    def test_shops_analytics(self):
+        url = reverse('shop_api:shops-analytics', kwargs={'shop_id': self.shop.pk})
+        self.api.force_authenticate(self.shop_owner)
+        with self.assertMaxQueries(3):
+            response = self.api.get(url)
+        self.assertEqual(response.status_code, 200)
+
+
+class ProductSearchTests(TestCase):
+
+    fixtures = ['users', 'shops', 'products']
+
+    def setUp(self):
+        get_catalog_cache().clear()
+        self.api = APIClient()
+        self.api.force_authenticate(Shop.objects.get(pk=1).owner)
+        self.url = reverse('shop_api:products-listcreate', kwargs={'shop_id': 1})
+
+    def search(self, url, query):
+        response = self.api.get(url, {'q': query})
+        self.assertEqual(response.status_code, 200)
+        return [product['id'] for product in response.data['results']]
+
+    def test_index_follows_writes(self):
+        first = self.api.post(self.url, {'name': 'Walnut desk', 'description': 'Solid wood', 'price': '10.00'},
+                              format='json').data['id']
+        second = self.api.post(self.url, {'name': 'Oak chair', 'description': 'Matches the walnut desk',
+                                          'price': '5.00'}, format='json').data['id']
+
+        # Name matches rank above description matches, the trailing * matches prefixes
+        self.assertEqual(self.search(self.url, 'walnut'), [first, second])
+        self.assertEqual(self.search(self.url, 'wal*'), [first, second])
+        self.assertEqual(self.search(self.url, 'wal'), [])
+
+        product = Product.objects.get(pk=first)
+        product.name = 'Maple desk'
+        product.save()
+        self.assertEqual(self.search(self.url, 'walnut'), [second])
+        self.assertEqual(self.search(self.url, 'maple desk'), [first])
+
+        product.delete()
+        self.assertEqual(self.search(self.url, 'desk'), [second])
+
+    def test_cross_shop_search(self):
+        other_shop = Shop.objects.get(pk=2)
+        Product.objects.create(shop=other_shop, name='Walnut shelf', price=1)
+        Product.objects.create(shop_id=1, name='Walnut desk', price=1)
+
+        self.assertEqual(len(self.search(self.url, 'walnut')), 1)
+        self.assertEqual(len(self.search(reverse('shop_api:products-search'), 'walnut')), 2)
+        self.assertEqual(self.api.get(reverse('shop_api:products-search')).status_code, 400)
+
+    def test_backend_must_match_the_database(self):
+        self.assertEqual(check_search_backend(None), [])
+        with override_settings(SHOP_API_SEARCH={'BACKEND': 'shop_api.search.MySQLFullTextBackend'}):
+            self.assertEqual([error.id for error in check_search_backend(None)], ['shop_api.E001'])
+
+        # Every term is required in boolean mode
+        self.assertEqual(MySQLFullTextBackend().against_expression(parse_query('walnut de*')), '+walnut +de*')
+
+
+class KeysetPaginationTests(TestCase):
+
+    fixtures = ['users', 'shops']
+
+    @classmethod
+    def setUpTestData(cls):
+        cls.shop = Shop.objects.get(pk=1)
+        Order.objects.bulk_create(Order(shop=cls.shop) for _ in range(25))
+        Order.objects.create(shop=Shop.objects.get(pk=2))
+
+    def setUp(self):
+        self.api = APIClient()
+        self.url = reverse('shop_api:orders-listcreate', kwargs={'shop_id': self.shop.pk})
+
+    def test_cursor_walks_every_order_of_the_shop_once(self):
+        seen = []
+        url = self.url + '?page_size=10'
+        while url:
+            response = self.api.get(url)
+            self.assertEqual(response.status_code, 200)
+            self.assertLessEqual(len(response.data['results']), 10)
+            seen.extend(order['id'] for order in response.data['results'])
+            url = response.data['next']
+
+        expected = list(self.shop.orders.order_by('id').values_list('id', flat=True))
+        self.assertEqual(seen, expected)
+
+    def test_last_page_has_no_next_cursor(self):
+        response = self.api.get(self.url + '?page_size=100000')
+        self.assertEqual(len(response.data['results']), 25)
+        self.assertEqual(self.api.get(self.url).data['next'], None)
+
+    def test_limit_offset_still_available(self):
+        response = self.api.get(self.url + '?limit=5&offset=20')
+        self.assertEqual(response.data['count'], 25)
+        self.assertEqual(len(response.data['results']), 5)
+        self.assertEqual(response.data['next'], None)
+
+
+class CatalogCacheTests(TestCase):
+
+    fixtures = ['users', 'shops', 'products']
+
+    def setUp(self):
+        self.api = APIClient()
+        get_catalog_cache().clear()
+        self.shop = Shop.objects.get(pk=1)
+
+    def test_repeated_reads_are_served_from_the_cache(self):
+        url = reverse('shop_api:products-listcreate', kwargs={'shop_id': self.shop.pk})
+        first = self.api.get(url)
+
+        with CaptureQueriesContext(connection) as context:
+            second = self.api.get(url)
+
+        # Only the shop's version is read, for the ETag
+        self.assertEqual(len(context.captured_queries), 1)
+        self.assertEqual(first.data, second.data)
+
+    def test_writes_invalidate_the_affected_entries(self):
+        shops_url = reverse('shop_api:shops-rud', kwargs={'pk': self.shop.pk})
+        products_url = reverse('shop_api:products-listcreate', kwargs={'shop_id': self.shop.pk})
+        product_count = len(self.api.get(shops_url).data['products'])
+        self.api.get(products_url)
+
+        self.api.force_authenticate(self.shop.owner)
+        response = self.api.post(products_url, {'name': 'Cached Product', 'price': '2.00'}, format='json')
+        self.assertEqual(response.status_code, 201)
+
+        self.assertEqual(len(self.api.get(shops_url).data['products']), product_count + 1)
+        self.assertIn(response.data['id'], [p['id'] for p in self.api.get(products_url).data['results']])
+
+    def test_product_changes_invalidate_the_expanded_shops(self):
+        shop_url = reverse('shop_api:shops-rud', kwargs={'pk': self.shop.pk})
+        shops_url = reverse('shop_api:shops-listcreate')
+        product = self.shop.products.order_by('pk').first()
+
+        def names():
+            shop = self.api.get(shop_url, {'expand': 'products'}).data
+            listed = next(shop for shop in self.api.get(shops_url, {'expand': 'products'}).data
+                          if shop['id'] == self.shop.pk)
+            return [p['name'] for p in shop['products'] if p['id'] == product.pk] + \
+                [p['name'] for p in listed['products'] if p['id'] == product.pk]
+
+        self.assertEqual(names(), [product.name, product.name])
+        product.name = 'Renamed Product'
+        product.save()
+        self.assertEqual(names(), ['Renamed Product', 'Renamed Product'])
+
+    def test_lru_evicts_least_recently_used_entries(self):
+        cache = LRUCache(max_entries=2, timeout=60)
+        cache.set('a', 1)
+        cache.set('b', 2)
+        cache.get('a')
+        cache.set('c', 3)
+
+        self.assertEqual(cache.get('b'), None)
+        self.assertEqual(cache.get('a'), 1)
+        self.assertEqual(cache.stats()['evictions'], 1)
+
+
+class ConditionalGetTests(TestCase):
+
+    fixtures = ['users', 'shops', 'products', 'orders', 'lineitems']
+
+    def setUp(self):
+        self.api = APIClient()
+        get_catalog_cache().clear()
+        self.shop = Shop.objects.get(pk=1)
+        self.url = reverse('shop_api:products-listcreate', kwargs={'shop_id': self.shop.pk})
+
+    def test_matching_etag_returns_not_modified(self):
+        response = self.api.get(self.url)
+        self.assertEqual(response.status_code, 200)
+        self.assertIn('public', response['Cache-Control'])
+
+        with CaptureQueriesContext(connection) as context:
+            response = self.api.get(self.url, HTTP_IF_NONE_MATCH=response['ETag'])
+
+        self.assertEqual(response.status_code, 304)
+        self.assertEqual(len(context.captured_queries), 1)
+
+    def test_product_changes_change_the_etag(self):
+        etag = self.api.get(self.url)['ETag']
+
+        product = self.shop.products.first()
+        product.price += 1
+        product.save()
+
+        response = self.api.get(self.url, HTTP_IF_NONE_MATCH=etag)
+        self.assertEqual(response.status_code, 200)
+        self.assertNotEqual(response['ETag'], etag)
+
+    def test_line_item_changes_change_the_order_etag(self):
+        order = Order.objects.get(pk=3)
+        url = reverse('shop_api:orders-rud', kwargs={'shop_id': order.shop_id, 'pk': order.pk})
+        etag = self.api.get(url)['ETag']
+
+        self.api.force_authenticate(order.client)
+        line_item = order.line_items.first()
+        self.api.patch(
+            reverse('shop_api:lineitems-rud', kwargs={'shop_id': order.shop_id, 'order_id': order.pk, 'pk': line_item.pk}),
+            {'quantity': line_item.quantity + 1}, format='json'
+        )
+
+        response = self.api.get(url, HTTP_IF_NONE_MATCH=etag)
+        self.assertEqual(response.status_code, 200)
+        self.assertIn('private', response['Cache-Control'])
+
+
+class InstrumentationTests(TestCase):
+
+    fixtures = ['users', 'shops', 'products', 'orders', 'lineitems']
+
+    def test_server_timing_reports_queries_and_phases(self):
+        get_catalog_cache().clear()
+        response = APIClient().get(reverse('shop_api:orders-listcreate', kwargs={'shop_id': 1}))
+
+        timing = response['Server-Timing']
+        self.assertRegex(timing, r'db;dur=[\d.]+;desc="3 queries"')
+        for phase in ('perm', 'serialize', 'render', 'total'):
+            self.assertIn(phase + ';dur=', timing)
+
+    @override_settings(SHOP_API_SLOW_REQUEST_MS=0)
+    def test_slow_requests_are_logged_with_their_sql(self):
+        get_catalog_cache().clear()
+        with self.assertLogs('shop_api.slow_requests', level='WARNING') as logs:
+            APIClient().get(reverse('shop_api:products-listcreate', kwargs={'shop_id': 1}))
+
+        entry = json.loads(logs.records[0].getMessage())
+        self.assertEqual(entry['route'], 'shop_api:products-listcreate')
+        self.assertTrue(entry['slowest_queries'])
+
+    def test_metrics_count_requests_queries_and_cache_lookups(self):
+        get_catalog_cache().clear()
+        labels = {'route': 'shop_api:products-listcreate'}
+
+        def sample(name, **extra):
+            return REGISTRY.get_sample_value(name, dict(labels, **extra)) or 0
+
+        requests = sample('shop_api_requests_total', method='GET', status='200')
+        hits = sample('shop_api_catalog_cache_requests_total', result='hit')
+        queries = sample('shop_api_db_queries_count')
+
+        url = reverse('shop_api:products-listcreate', kwargs={'shop_id': 1})
+        APIClient().get(url)
+        APIClient().get(url)
+
+        self.assertEqual(sample('shop_api_requests_total', method='GET', status='200'), requests + 2)
+        self.assertEqual(sample('shop_api_catalog_cache_requests_total', result='hit'), hits + 1)
+        self.assertEqual(sample('shop_api_db_queries_count'), queries + 2)
+
+        # Written once the response was sent, the request path never takes the lock of prometheus_client
+        with patch('shop_api.metrics.flush'):
+            APIClient().get(url)
+        self.assertEqual(sample('shop_api_requests_total', method='GET', status='200'), requests + 2)
+        metrics.flush()
+        self.assertEqual(sample('shop_api_requests_total', method='GET', status='200'), requests + 3)
+
+    def test_metrics_are_only_served_to_staff(self):
+        url = reverse('shop_api:metrics')
+        self.assertEqual(APIClient().get(url).status_code, 403)
+
+        api = APIClient()
+        api.force_authenticate(User.objects.filter(is_staff=False).first())
+        self.assertEqual(api.get(url).status_code, 403)
+
+        api.force_authenticate(User.objects.filter(is_staff=True).first())
+        response = api.get(url, HTTP_ACCEPT='text/plain; version=0.0.4')
+        self.assertEqual(response.status_code, 200)
+        self.assertTrue(response['Content-Type'].startswith('text/plain'))
+        self.assertIn(b'shop_api_request_duration_seconds_bucket{', response.content)
+
+    def test_staff_can_profile_a_request(self):
+        staff = User.objects.filter(is_staff=True).first()
+        client = User.objects.filter(is_staff=False).first()
+        url = reverse('shop_api:orders-listcreate', kwargs={'shop_id': 1})
+
+        with tempfile.TemporaryDirectory() as directory, override_settings(SHOP_API_PROFILE_DIR=directory):
+            # Other clients sending the header aren't sampled at all
+            with patch.object(StackSampler, 'start') as start:
+                self.assertNotIn('X-Profile', APIClient().get(url, HTTP_X_PROFILE='1'))
+                api = APIClient()
+                api.force_authenticate(client)
+                self.assertNotIn('X-Profile', api.get(url, HTTP_X_PROFILE='1'))
+            self.assertFalse(start.called)
+
+            api.force_authenticate(staff)
+            api.get(url, HTTP_X_PROFILE='1')
+            api.get(url, HTTP_X_PROFILE='1')
+            self.assertEqual(len(os.listdir(os.path.join(directory, 'shop_api.orders-listcreate'))), 2)
+
+            output = StringIO()
+            call_command('merge_profiles', 'shop_api:orders-listcreate', stdout=output, stderr=StringIO())
+            self.assertIn('profiling.py', output.getvalue())
+
+
+class AnalyticsTests(TestCase):
+
+    fixtures = ['users', 'shops', 'products', 'orders', 'lineitems']
+
+    def setUp(self):
+        get_catalog_cache().clear()
+        call_command('backfill_sales_rollups', stdout=StringIO())
+
+    def rollups(self):
+        # Rows whose sales were all removed are kept at zero by the incremental updates
+        columns = ('day', 'revenue', 'units', 'orders')
+        return (
+            sorted(ShopDailySales.objects.exclude(orders=0).values_list('shop_id', *columns)),
+            sorted(ProductDailySales.objects.exclude(orders=0).values_list('product_id', *columns)),
+        )
+
+    def test_writes_keep_the_rollups_in_sync_with_the_line_items(self):
+        api = APIClient()
+        api.force_authenticate(User.objects.get(pk=4))
+        orders_url = reverse('shop_api:orders-listcreate', kwargs={'shop_id': 1})
+
+        order_id = api.post(orders_url, {'line_items': [
+            {'product': 1, 'quantity': 2}, {'product': 2}, {'product': 1, 'quantity': 3}
+        ]}, format='json').data['id']
+
+        line_items_url = reverse('shop_api:lineitems-listcreate', kwargs={'shop_id': 1, 'order_id': order_id})
+        line_item_id = api.post(line_items_url, {'product': 3, 'quantity': 4}, format='json').data['id']
+        api.post(line_items_url, {'product': 2, 'quantity': 1}, format='json')
+
+        line_item_url = reverse('shop_api:lineitems-rud', kwargs={'shop_id': 1, 'order_id': order_id,
+                                                                   'pk': line_item_id})
+        api.patch(line_item_url, {'quantity': 1}, format='json')
+        api.delete(line_item_url)
+
+        other_order_id = api.post(orders_url, {'line_items': [{'product': 3}]}, format='json').data['id']
+        api.delete(reverse('shop_api:orders-rud', kwargs={'shop_id': 1, 'pk': other_order_id}))
+
+        maintained = self.rollups()
+        call_command('backfill_sales_rollups', stdout=StringIO())
+        self.assertEqual(maintained, self.rollups())
+
+    def test_report_is_read_from_the_rollups(self):
+        url = reverse('shop_api:shops-analytics', kwargs={'shop_id': 1})
+        api = APIClient()
+        api.force_authenticate(User.objects.get(pk=4))
+        self.assertEqual(api.get(url).status_code, 403)
+
+        api.force_authenticate(Shop.objects.get(pk=1).owner)
+        response = api.get(url, {'start': '2018-09-01', 'end': '2018-09-30', 'top': 1})
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response.data['totals'], {'revenue': '173.07', 'units': 4, 'orders': 1})
+        self.assertEqual([day['day'] for day in response.data['days']], ['2018-09-24'])
+        self.assertEqual(len(response.data['top_products']), 1)
+
+        self.assertEqual(api.get(url, {'start': 'yesterday'}).status_code, 400)
+
+
+class SparseFieldsetTests(TestCase):
+
+    fixtures = ['users', 'shops', 'products', 'orders', 'lineitems']
+
+    def setUp(self):
+        get_catalog_cache().clear()
+        self.api = APIClient()
+
+    def get(self, url, params):
+        with CaptureQueriesContext(connection) as context:
+            response = self.api.get(url, params)
+        self.assertEqual(response.status_code, 200)
+        return response, ' '.join(query['sql'] for query in context.captured_queries)
+
+    def test_omitted_fields_are_not_queried(self):
+        response, sql = self.get(reverse('shop_api:shops-listcreate'), {'fields': 'id,name'})
+        self.assertEqual(set(response.data[0]), {'id', 'name'})
+        self.assertNotIn('shop_api_product', sql)
+        self.assertNotIn('owner_id', sql)
+
+        self.api.force_authenticate(User.objects.get(pk=4))
+        response, sql = self.get(reverse('shop_api:orders-listcreate', kwargs={'shop_id': 1}), {'fields': 'id,total'})
+        self.assertEqual(set(response.data['results'][0]), {'id', 'total'})
+        self.assertNotIn('shop_api_lineitem', sql)
+
+        response = self.api.get(reverse('shop_api:shops-listcreate'), {'fields': 'id,secret'})
+        self.assertEqual(response.status_code, 400)
+
+    @override_settings(SHOP_API_RELATION_LIMIT=2)
+    def test_relations_are_capped_and_expandable(self):
+        response, _ = self.get(reverse('shop_api:shops-rud', kwargs={'pk': 1}), {})
+        self.assertEqual(response.data['products'], [1, 2])
+
+        response, _ = self.get(reverse('shop_api:shops-listcreate'), {'expand': 'products'})
+        shop = next(shop for shop in response.data if shop['id'] == 1)
+        self.assertEqual([product['id'] for product in shop['products']], [1, 2])
+        self.assertEqual(shop['products'][0]['name'], Product.objects.get(pk=1).name)
+
+
+class TokenAuthenticationTests(TestCase):
+
+    fixtures = ['users', 'shops', 'products', 'orders', 'lineitems']
+
+    def setUp(self):
+        get_user_cache().clear()
+        get_revocation_list().clear()
+        self.user = User.objects.get(pk=4)
+        self.user.set_password('correct horse')
+        self.user.save()
+        self.api = APIClient()
+        self.url = reverse('shop_api:orders-listcreate', kwargs={'shop_id': 1})
+
+    def obtain_token(self):
+        response = self.api.post(reverse('shop_api:auth-token'),
+                                 {'username': self.user.username, 'password': 'correct horse'}, format='json')
+        self.assertEqual(response.status_code, 201)
+        return response.data['token']
+
+    def test_tokens_authenticate_without_reading_sessions_or_users(self):
+        self.api.credentials(HTTP_AUTHORIZATION='Bearer ' + self.obtain_token())
+        self.assertEqual(self.api.get(self.url).status_code, 200)
+
+        with CaptureQueriesContext(connection) as context:
+            response = self.api.get(self.url)
+        self.assertEqual(response.status_code, 200)
+
+        sql = ' '.join(query['sql'] for query in context.captured_queries)
+        for table in ('django_session', 'auth_user', 'shop_api_revokedtoken'):
+            self.assertNotIn(table, sql)
+
+        self.api.credentials(HTTP_AUTHORIZATION='Bearer forged')
+        self.assertEqual(self.api.get(self.url).status_code, 403)
+
+        self.api.credentials()
+        response = self.api.post(reverse('shop_api:auth-token'),
+                                 {'username': self.user.username, 'password': 'wrong'}, format='json')
+        self.assertEqual(response.status_code, 400)
+
+    def test_revoked_tokens_are_rejected_by_every_worker(self):
+        token = self.obtain_token()
+        self.api.credentials(HTTP_AUTHORIZATION='Bearer ' + token)
+        self.assertEqual(self.api.delete(reverse('shop_api:auth-token')).status_code, 204)
+        self.assertEqual(self.api.get(self.url).status_code, 403)
+
+        other_worker = RevocationList(refresh=0)
+        self.assertTrue(other_worker.is_revoked(read_token(token)['id']))
+
+    def test_revocations_committed_out_of_id_order_are_seen(self):
+        other_worker = RevocationList(refresh=0)
+        expires_at = timezone.now() + datetime.timedelta(hours=1)
+        RevokedToken.objects.create(pk=10, token_id='later', user=self.user, expires_at=expires_at)
+        self.assertFalse(other_worker.is_revoked('earlier'))
+
+        # A transaction which got a lower id commits after the worker read the row above
+        RevokedToken.objects.create(pk=5, token_id='earlier', user=self.user, expires_at=expires_at)
+        self.assertTrue(other_worker.is_revoked('earlier'))
+        self.assertTrue(other_worker.is_revoked('later'))
+
+    def test_session_login_still_works(self):
+        self.assertTrue(self.client.login(username=self.user.username, password='correct horse'))
+        self.assertEqual(self.client.get(self.url).status_code, 200)
+
+
+class StockReservationTests(TestCase):
+
+    fixtures = ['users', 'shops', 'products', 'orders', 'lineitems']
+
+    def setUp(self):
+        get_catalog_cache().clear()
+        self.api = APIClient()
+        self.api.force_authenticate(User.objects.get(pk=4))
+        Product.objects.filter(pk=1).update(stock=5)
+
+    def stock(self):
+        return Product.objects.get(pk=1).stock
+
+    def test_line_items_reserve_and_release_stock(self):
+        order_id = self.api.post(reverse('shop_api:orders-listcreate', kwargs={'shop_id': 1}), {},
+                                 format='json').data['id']
+        url = reverse('shop_api:lineitems-listcreate', kwargs={'shop_id': 1, 'order_id': order_id})
+
+        response = self.api.post(url, {'product': 1, 'quantity': 6}, format='json')
+        self.assertEqual(response.status_code, 409)
+        self.assertEqual(self.stock(), 5)
+        self.assertFalse(LineItem.objects.filter(order_id=order_id).exists())
+
+        line_item_id = self.api.post(url, {'product': 1, 'quantity': 3}, format='json').data['id']
+        self.assertEqual(self.stock(), 2)
+
+        line_item_url = reverse('shop_api:lineitems-rud', kwargs={'shop_id': 1, 'order_id': order_id,
+                                                                   'pk': line_item_id})
+        self.assertEqual(self.api.patch(line_item_url, {'quantity': 6}, format='json').status_code, 409)
+        self.assertEqual(self.api.patch(line_item_url, {'quantity': 5}, format='json').status_code, 200)
+        self.assertEqual(self.stock(), 0)
+        self.api.patch(line_item_url, {'quantity': 1}, format='json')
+        self.assertEqual(self.stock(), 4)
+
+        self.api.delete(line_item_url)
+        self.assertEqual(self.stock(), 5)
+
+    def test_orders_reserve_every_product_or_none(self):
+        Product.objects.filter(pk=2).update(stock=1)
+        url = reverse('shop_api:orders-listcreate', kwargs={'shop_id': 1})
+
+        response = self.api.post(url, {'line_items': [{'product': 1, 'quantity': 2}, {'product': 2, 'quantity': 2}]},
+                                 format='json')
+        self.assertEqual(response.status_code, 409)
+        self.assertIn('2', response.data['detail'])
+        self.assertEqual(self.stock(), 5)
+
+        response = self.api.post(url, {'line_items': [{'product': 1, 'quantity': 2}, {'product': 2},
+                                                      {'product': 1, 'quantity': 3}]}, format='json')
+        self.assertEqual(response.status_code, 201)
+        self.assertEqual(self.stock(), 0)
+
+        self.api.delete(reverse('shop_api:orders-rud', kwargs={'shop_id': 1, 'pk': response.data['id']}))
+        self.assertEqual(self.stock(), 5)
+        self.assertEqual(Product.objects.get(pk=2).stock, 1)
+
+    def test_product_updates_only_write_the_stock_they_set(self):
+        product = Product.objects.get(pk=1)
+        Product.objects.filter(pk=1).update(stock=3)
+
+        serializer = ProductSerializer(product, data={'name': 'Renamed'}, partial=True)
+        self.assertTrue(serializer.is_valid())
+        serializer.save()
+        self.assertEqual(self.stock(), 3)
+
+
+class FlashSaleTests(TransactionTestCase):
+    """
+    Concurrent buyers go through the whole API in threads with connections of their own.
+    SQLite answers some of them with lock errors, the stock must add up regardless.
+    """
+
+    fixtures = ['users', 'shops', 'products', 'orders', 'lineitems']
+
+    def test_concurrent_buyers_never_oversell(self):
+        results = FlashSale(InProcessClient(), 1, stock=30).run([2, 3, 4, 2, 3, 4])
+
+        self.assertTrue(results['consistent'])
+        self.assertGreater(results['orders'], 0)
+        self.assertEqual(results['sold'] + results['remaining'], 30)
+
+
+class StockCacheTests(TransactionTestCase):
+    """
+    The catalog entries showing the stock are invalidated once the checkout committed, which only happens outside of
+    TestCase. The rows are created rather than loaded from the fixtures, the flush between the tests leaves the search
+    index.
+    """
+
+    def setUp(self):
+        get_catalog_cache().clear()
+        owner = User.objects.create_user('stock-owner')
+        self.shop = Shop.objects.create(name='Stock shop', owner=owner)
+        self.product = Product.objects.create(shop=self.shop, name='Stocked product', price=1, stock=5)
+        self.api = APIClient()
+        self.api.force_authenticate(User.objects.create_user('stock-buyer'))
+
+    def test_reservations_refresh_the_cached_stock(self):
+        url = reverse('shop_api:products-rud', kwargs={'shop_id': self.shop.pk, 'pk': self.product.pk})
+        list_url = reverse('shop_api:products-listcreate', kwargs={'shop_id': self.shop.pk})
+        etag = self.api.get(url)['ETag']
+        list_etag = self.api.get(list_url)['ETag']
+
+        response = self.api.post(reverse('shop_api:orders-listcreate', kwargs={'shop_id': self.shop.pk}), {
+            'line_items': [{'product': self.product.pk, 'quantity': 3}]
+        }, format='json')
+        self.assertEqual(response.status_code, 201)
+        order_id = response.data['id']
+
+        response = self.api.get(url, HTTP_IF_NONE_MATCH=etag)
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response.data['stock'], 2)
+        response = self.api.get(list_url, HTTP_IF_NONE_MATCH=list_etag)
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response.data['results'][0]['stock'], 2)
+
+        # Releases too
+        self.api.delete(reverse('shop_api:orders-rud', kwargs={'shop_id': self.shop.pk, 'pk': order_id}))
+        self.assertEqual(self.api.get(url).data['stock'], 5)
+
+
+class ProductImportTests(TestCase):
+
+    fixtures = ['users', 'shops', 'products', 'orders', 'lineitems']
+
+    def setUp(self):
+        get_catalog_cache().clear()
+        self.api = APIClient()
+        self.api.force_authenticate(Shop.objects.get(pk=1).owner)
+        self.url = reverse('shop_api:products-import', kwargs={'shop_id': 1})
+
+    def test_csv_rows_are_upserted_in_batches(self):
+        rows = ['name,price,stock'] + ['"Imported, %d",%d.50,' % (i, i) for i in range(20)] + [
+            '%s,1.00,7' % Product.objects.get(pk=1).name,
+            '%s,1.00,' % Product.objects.get(pk=4).name,
+            'Imported bad price,cheap,',
+            'Imported short row',
+            '"Imported, 3",9.99,2',
+        ]
+
+        with patch.object(ProductImportView, 'batch_size', 10), CaptureQueriesContext(connection) as context:
+            response = self.api.post(self.url, '\n'.join(rows).encode('utf-8'), content_type='text/csv')
+
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual((response.data['created'], response.data['updated'], response.data['failed']), (20, 2, 3))
+        self.assertEqual(response.data['rows'], 25)
+        self.assertEqual(response.data['superseded'], 0)
+        self.assertEqual([error['row'] for error in response.data['errors']], [22, 23, 24])
+        self.assertIn('price', response.data['errors'][1]['errors'])
+        # Queries grow with the batches, not the rows
+        self.assertLess(len(context.captured_queries), 50)
+
+        self.assertEqual(Product.objects.get(name='Imported, 3').stock, 2)
+        self.assertEqual(Product.objects.get(name='Imported, 4').price, Decimal('4.50'))
+        self.assertEqual(Product.objects.get(pk=1).stock, 7)
+        self.assertEqual(Product.objects.get(pk=4).shop_id, 2)
+
+        search_url = reverse('shop_api:products-listcreate', kwargs={'shop_id': 1})
+        self.assertEqual(len(self.api.get(search_url, {'q': 'imported'}).data['results']), 20)
+
+    def test_names_are_matched_like_the_collation(self):
+        # SQLite compares names byte for byte, whichever batch the rows fall in
+        rows = [{'name': name, 'price': '1.00'} for name in ('Imported', 'imported  ', 'IMPORTED ', 'Imported')]
+        for batch_size in (1, 10):
+            Product.objects.filter(name__iexact='imported').delete()
+            report = CatalogImport(1, batch_size=batch_size).run(rows)
+            self.assertEqual(Product.objects.filter(name__istartswith='imported').count(), 3)
+            self.assertEqual(report['rows'], report['created'] + report['updated'] + report['superseded'])
+
+        # MySQL's default collations ignore the case and the trailing spaces, the last spelling wins
+        collation = NameCollation(case_insensitive=True, pad_space=True)
+        Product.objects.filter(name__istartswith='imported').delete()
+        report = CatalogImport(1, collation=collation).run([
+            {'name': 'Imported', 'price': '1.00'}, {'name': 'imported  ', 'price': '2.00'},
+            {'name': 'IMPORTED ', 'price': '3.00'}, {'name': 'Imported bad', 'price': 'cheap'},
+        ])
+        self.assertEqual((report['rows'], report['created'], report['superseded'], report['failed']), (4, 1, 2, 1))
+        self.assertEqual(Product.objects.get(name__istartswith='imported').name, 'IMPORTED ')
+
+        # and find the stored name for any of its spellings
+        product = Product.objects.get(pk=1)
+        with patch.object(CatalogImport, 'existing', return_value=[(product.name, product.pk, product.shop_id)]):
+            report = CatalogImport(1, collation=collation).run([{'name': product.name.upper() + ' ', 'price': '5.00'}])
+        self.assertEqual((report['created'], report['updated']), (0, 1))
+        self.assertEqual(Product.objects.get(pk=1).price, Decimal('5.00'))
+        self.assertEqual(Product.objects.get(pk=1).name, product.name)
+
+    def test_ndjson_and_invalid_uploads(self):
+        lines = [{'name': 'Imported float', 'price': 12.99}, {'name': 'Imported missing price'}, 'not json']
+        body = '\n'.join(json.dumps(line) if isinstance(line, dict) else line for line in lines)
+
+        response = self.api.post(self.url, body.encode('utf-8'), content_type='application/x-ndjson')
+        self.assertEqual((response.data['created'], response.data['failed']), (1, 2))
+        self.assertEqual(Product.objects.get(name='Imported float').price, Decimal('12.99'))
+
+        response = self.api.post(self.url, b'title,price\nx,1', content_type='text/csv')
+        self.assertEqual(response.status_code, 400)
+        response = self.api.post(self.url, b'{}', content_type='application/json')
+        self.assertEqual(response.status_code, 415)
+
+        self.api.force_authenticate(User.objects.get(pk=4))
+        self.assertEqual(self.api.post(self.url, b'name,price', content_type='text/csv').status_code, 403)
+
+
+class FastSerializerTests(TestCase):
+    """
+    The values() serializers of the list endpoints must render exactly the bytes of the DRF serializers
+    """
+
+    fixtures = ['users', 'shops', 'products', 'orders', 'lineitems']
+
+    def assertSameBytes(self, url, params):
+        responses = []
+        for fast in (False, True):
+            get_catalog_cache().clear()
+            with override_settings(SHOP_API_FAST_SERIALIZERS=fast):
+                response = self.api.get(url, params)
+            self.assertEqual(response.status_code, 200)
+            responses.append(response.content)
+
+        self.assertEqual(responses[0], responses[1])
+
+    def test_list_endpoints_render_the_same_bytes(self):
+        self.api = APIClient()
+        self.api.force_authenticate(User.objects.get(pk=4))
+        Product.objects.create(shop_id=1, name='Ünïcode "quoted"', description='line\nbreak', price='1234567.5')
+
+        urls = [
+            (reverse('shop_api:products-listcreate', kwargs={'shop_id': 1}), 'price,id'),
+            (reverse('shop_api:orders-listcreate', kwargs={'shop_id': 1}), 'line_items,total'),
+            (reverse('shop_api:lineitems-listcreate', kwargs={'shop_id': 1, 'order_id': 3}), 'price,id'),
+        ]
+        for url, fields in urls:
+            for params in ({}, {'page_size': 1}, {'limit': 1, 'offset': 1}, {'fields': fields}):
+                self.assertSameBytes(url, params)
+
+
+class ReplicaRoutingTests(TestCase):
+    """
+    Reads of safe requests go to a replica, unless the request or its client wrote recently
+    """
+
+    fixtures = ['users']
+
+    def setUp(self):
+        self.factory = RequestFactory()
+        self.pool = ReplicaPool(['replica1', 'replica2'])
+        self.pool.healthy = lambda alias: alias != 'replica1'
+
+    def route(self, request, write=False):
+        routes = []
+
+        def view(request):
+            routes.append(db_router.db_for_read(Product))
+            if write:
+                db_router.db_for_write(Product)
+                routes.append(db_router.db_for_read(Product))
+            return HttpResponse()
+
+        with patch('shop_api.routers.get_replica_pool', return_value=self.pool):
+            response = ReplicaRoutingMiddleware(view)(request)
+        return routes, response
+
+    def test_safe_requests_read_a_healthy_replica(self):
+        routes, _ = self.route(self.factory.get('/'), write=True)
+        # The request reads the primary once it wrote
+        self.assertEqual(routes, ['replica2', 'default'])
+        self.assertEqual(db_router.db_for_read(Product), 'default')
+
+        self.pool.healthy = lambda alias: False
+        routes, _ = self.route(self.factory.get('/'))
+        self.assertEqual(routes, ['default'])
+
+    def test_unreachable_replicas_are_skipped(self):
+        pool = ReplicaPool(['replica1'], retry_after=30)
+        pool.healthy = lambda alias: False
+        self.assertIsNone(pool.choose())
+
+        # Not checked again until it may have recovered
+        pool.healthy = lambda alias: True
+        self.assertIsNone(pool.choose())
+        pool.down['replica1'] -= 30
+        self.assertEqual(pool.choose(), 'replica1')
+
+    def test_clients_read_their_writes(self):
+        routes, response = self.route(self.factory.post('/'))
+        self.assertEqual(routes, ['default'])
+        self.assertEqual(response.cookies[PIN_COOKIE]['max-age'], 5)
+
+        request = self.factory.get('/')
+        request.COOKIES[PIN_COOKIE] = '1'
+        routes, response = self.route(request)
+        self.assertEqual(routes, ['default'])
+        self.assertNotIn(PIN_COOKIE, response.cookies)
+
+    def test_token_clients_read_their_writes(self):
+        caches['replica_pins'].clear()
+        writer, reader = User.objects.get(pk=2), User.objects.get(pk=3)
+        headers = dict((user.pk, {'HTTP_AUTHORIZATION': 'Bearer ' + issue_token(user)[0]}) for user in (writer, reader))
+
+        routes, _ = self.route(self.factory.post('/', **headers[writer.pk]))
+        self.assertEqual(routes, ['default'])
+
+        # Without the cookie, the token of the user who wrote pins it
+        routes, _ = self.route(self.factory.get('/', **headers[writer.pk]))
+        self.assertEqual(routes, ['default'])
+        routes, _ = self.route(self.factory.get('/', **headers[reader.pk]))
+        self.assertEqual(routes, ['replica2'])
+        routes, _ = self.route(self.factory.get('/', HTTP_AUTHORIZATION='Bearer forged'))
+        self.assertEqual(routes, ['replica2'])
+
+    def test_idle_connections_which_dont_answer_are_closed(self):
+        connection.ensure_connection()
+        connection.checked_at = 0
+        with patch.object(connection, 'is_usable', return_value=False), patch.object(connection, 'close') as close:
+            self.assertTrue(check_connection('default'))
+        close.assert_called_once_with()
+
+        connection.checked_at = time.monotonic()
+        with patch.object(connection, 'is_usable') as is_usable:
+            check_connection('default')
+        is_usable.assert_not_called()
+
+
+class ShardingTests(TestCase):
+    """
+    Shop 1 is moved to the second shard, its orders and line items must follow it without the API noticing
+    """
+
+    fixtures = ['users', 'shops', 'products', 'orders', 'lineitems']
+    multi_db = True
+
+    def setUp(self):
+        get_catalog_cache().clear()
+        self.api = APIClient()
+        self.api.force_authenticate(User.objects.get(pk=4))
+        self.orders_url = reverse('shop_api:orders-listcreate', kwargs={'shop_id': 1})
+
+        # The fixtures are loaded in every database, the shard starts empty
+        LineItem.objects.using('shard1').all().delete()
+        Order.objects.using('shard1').all().delete()
+
+    def move(self, shard):
+        return ShopMove(Shop.objects.get(pk=1), shard, batch_size=1, grace=0).run()
+
+    def test_orders_follow_their_shop(self):
+        order = self.api.post(self.orders_url, {'line_items': [{'product': 1, 'quantity': 2}]}, format='json').data
+        before = self.api.get(self.orders_url).data['results']
+
+        self.move('shard1')
+        self.assertEqual(Shop.objects.get(pk=1).shard, 'shard1')
+        self.assertFalse(Order.objects.using('default').filter(shop_id=1).exists())
+        self.assertEqual(self.api.get(self.orders_url).data['results'], before)
+
+        line_items_url = reverse('shop_api:lineitems-listcreate', kwargs={'shop_id': 1, 'order_id': order['id']})
+        line_item = self.api.post(line_items_url, {'product': 2, 'quantity': 1}, format='json').data
+        self.assertGreaterEqual(line_item['id'], ID_SPAN)
+        self.assertEqual(LineItem.objects.using('shard1').filter(order_id=order['id']).count(), 2)
+
+        line_item_url = reverse('shop_api:lineitems-rud', kwargs={
+            'shop_id': 1, 'order_id': order['id'], 'pk': line_item['id']
+        })
+        self.assertEqual(self.api.patch(line_item_url, {'quantity': 3}, format='json').status_code, 200)
+        new_order = self.api.post(self.orders_url, {'line_items': [{'product': 1}]}, format='json').data
+        self.assertGreaterEqual(new_order['id'], ID_SPAN)
+        self.assertEqual(
+            Order.objects.using('shard1').get(pk=order['id']).total,
+            Product.objects.get(pk=1).price * 2 + Product.objects.get(pk=2).price * 3
+        )
+
+        # Moving back gives the default shard a new range, the ids created on the second shard stay unique
+        self.move('default')
+        self.assertFalse(Order.objects.using('shard1').exists())
+        self.assertGreaterEqual(self.api.post(self.orders_url, {}, format='json').data['id'], 2 * ID_SPAN)
+        self.assertEqual(self.api.delete(line_item_url).status_code, 204)
+        self.assertEqual(Order.objects.get(pk=order['id']).line_items.count(), 1)
+
+    def test_unsupported_databases_are_refused_up_front(self):
+        with patch.object(connections['shard1'], 'vendor', 'oracle'):
+            with self.assertRaises(MoveFailed):
+                self.move('shard1')
+
+        self.assertEqual(Shop.objects.get(pk=1).shard, 'default')
+        self.assertFalse(ShardSequence.objects.filter(alias='shard1').exists())
+        self.assertFalse(Order.objects.using('shard1').exists())
+
+    def test_locked_shops_refuse_order_writes(self):
+        Shop.objects.filter(pk=1).update(shard='shard1', shard_locked=True)
+
+        self.assertEqual(self.api.get(self.orders_url).status_code, 200)
+        self.assertEqual(self.api.post(self.orders_url, {}, format='json').status_code, 503)
+        self.assertFalse(Order.objects.using('shard1').exists())
+
+    def test_moves_fail_when_the_copy_differs(self):
+        with patch.object(ShopMove, 'copy_deletions', side_effect=lambda: Order.objects.using('shard1').create(
+                shop_id=1, total=1)):
+            with self.assertRaises(MoveFailed):
+                self.move('shard1')
+
+        shop = Shop.objects.get(pk=1)
+        self.assertEqual((shop.shard, shop.shard_locked), ('default', False))
+        self.assertTrue(Order.objects.using('default').filter(shop_id=1).exists())
+
+
+class OrderArchiveTests(TestCase):
+    """
+    The fixture orders were placed in 2018, long enough ago to be archived
+    """
+
+    fixtures = ['users', 'shops', 'products', 'orders', 'lineitems']
+    multi_db = True
+
+    def setUp(self):
+        get_catalog_cache().clear()
+        self.api = APIClient()
+        self.api.force_authenticate(Shop.objects.get(pk=1).owner)
+        self.orders_url = reverse('shop_api:orders-listcreate', kwargs={'shop_id': 1})
+
+        # The fixtures are loaded in every database, the shard starts empty
+        LineItem.objects.using('shard1').all().delete()
+        Order.objects.using('shard1').all().delete()
+
+    def archive(self):
+        call_command('archive_orders', '--pause', '0', '--quiet', '0', stdout=StringIO())
+
+    def rollups(self):
+        call_command('backfill_sales_rollups', stdout=StringIO())
+        return (
+            sorted(ShopDailySales.objects.values_list('shop_id', 'day', 'revenue', 'units', 'orders')),
+            sorted(ProductDailySales.objects.values_list('product_id', 'day', 'revenue', 'units', 'orders')),
+        )
+
+    def test_archived_orders_stay_readable(self):
+        order = Order.objects.filter(shop_id=1).exclude(line_items=None).first()
+        url = reverse('shop_api:orders-rud', kwargs={'shop_id': 1, 'pk': order.pk})
+        export_url = reverse('shop_api:orders-export', kwargs={'shop_id': 1})
+        detail = self.api.get(url).content
+        export = b''.join(self.api.get(export_url).streaming_content)
+        rollups = self.rollups()
+
+        self.archive()
+        self.assertFalse(Order.objects.filter(shop_id=1).exists())
+        self.assertFalse(LineItem.objects.filter(order_id=order.pk).exists())
+        self.assertEqual(self.api.get(self.orders_url).data['results'], [])
+        self.assertEqual(self.api.get(url).content, detail)
+        self.assertEqual(b''.join(self.api.get(export_url).streaming_content), export)
+        self.assertEqual(self.rollups(), rollups)
+        self.assertEqual(self.api.delete(url).status_code, 404)
+
+        # Archived orders follow their shop to another shard
+        ShopMove(Shop.objects.get(pk=1), 'shard1', batch_size=1, grace=0).run()
+        self.assertFalse(ArchivedOrder.objects.using('default').filter(shop_id=1).exists())
+        self.assertEqual(self.api.get(url).content, detail)
+
+    def test_recent_orders_stay_live(self):
+        order = self.api.post(self.orders_url, {'line_items': [{'product': 1}]}, format='json').data
+        self.archive()
+
+        self.assertTrue(Order.objects.filter(pk=order['id']).exists())
+        self.assertEqual([row['id'] for row in self.api.get(self.orders_url).data['results']], [order['id']])
+
+
+class ChangeFeedTests(TestCase):
+    fixtures = ['users', 'shops', 'products', 'orders', 'lineitems']
+    multi_db = True
+
+    def setUp(self):
+        get_catalog_cache().clear()
+        self.api = APIClient()
+        self.api.force_authenticate(Shop.objects.get(pk=1).owner)
+        self.url = reverse('shop_api:orders-changes', kwargs={'shop_id': 1})
+
+        # The fixtures are loaded in every database, the shard starts empty
+        LineItem.objects.using('shard1').all().delete()
+        Order.objects.using('shard1').all().delete()
+
+        order = self.api.post(reverse('shop_api:orders-listcreate', kwargs={'shop_id': 1}), {
+            'line_items': [{'product': 1, 'quantity': 2}]
+        }, format='json').data
+        self.order_id = order['id']
+        self.line_item_id = order['line_items'][0]['id']
+        line_item_url = reverse('shop_api:lineitems-rud', kwargs={
+            'shop_id': 1, 'order_id': self.order_id, 'pk': self.line_item_id
+        })
+        self.api.patch(line_item_url, {'quantity': 3}, format='json')
+        self.api.patch(line_item_url, {'quantity': 4}, format='json')
+        self.api.delete(reverse('shop_api:orders-rud', kwargs={'shop_id': 1, 'pk': self.order_id}))
+
+    def events(self, after=0):
+        response = self.api.get(self.url, {'after': after})
+        self.assertEqual(response.status_code, 200)
+        return [(event['type'], event['line_item']) for event in response.data['events']], response.data['cursor']
+
+    def compact(self, *args):
+        call_command('compact_order_changes', '--pause', '0', *args, stdout=StringIO())
+
+    def test_events_follow_the_changes(self):
+        events, cursor = self.events()
+        self.assertEqual(events, [
+            ('order.created', None),
+            ('line_item.updated', self.line_item_id),
+            ('line_item.updated', self.line_item_id),
+            ('order.deleted', None),
+        ])
+        first = self.api.get(self.url).data['events']
+        self.assertEqual(first[0]['data']['line_items'][0]['quantity'], 2)
+        self.assertEqual(first[2]['data']['quantity'], 4)
+        self.assertEqual(self.events(cursor), ([], cursor))
+        self.assertEqual(self.events(first[1]['id'])[0], events[2:])
+        # Appends were serialized by the lock row of the shop, the events are served as soon as they committed
+        self.assertTrue(OrderEventLock.objects.filter(shop_id=1).exists())
+
+        for wait in ('nan', 'inf', 'soon'):
+            self.assertEqual(self.api.get(self.url, {'wait': wait}).status_code, 400)
+
+        # Other shops can't read the feed
+        self.api.force_authenticate(Shop.objects.get(pk=2).owner)
+        self.assertEqual(self.api.get(self.url).status_code, 403)
+
+    def test_compaction_keeps_the_last_changes(self):
+        _, cursor = self.events()
+        self.compact('--compact-after', '0')
+        self.assertEqual(self.events(), ([('order.deleted', None)], cursor))
+
+        # Cursors from before the retention expire
+        self.compact('--retention-days', '0')
+        response = self.api.get(self.url)
+        self.assertEqual(response.status_code, 410)
+        self.assertEqual(response.data['cursor'], cursor)
+        self.assertEqual(self.events(response.data['cursor']), ([], cursor))
+
+    def test_waiting_threads_keep_their_request_state(self):
+        # The feed pool serves its long-polls on threads (gunicorn.feed.conf.py), a request served by another thread
+        # of the worker while one waits must not change the shop or the timings of the waiting request
+        shop = Shop.objects.get(pk=1)
+        waiting, answered = threading.Event(), threading.Event()
+        state = {}
+
+        def read(shop, after, limit):
+            waiting.set()
+            return ['event'] if answered.is_set() else []
+
+        def long_poll():
+            timings = RequestTimings()
+            set_current_timings(timings)
+            set_current_shop(shop)
+            try:
+                state['events'] = changes.wait_for(shop, 0, 10, 5, interval=0.01)
+                state['shop'] = current_shop()
+                state['timings'] = current_timings()
+            finally:
+                set_current_timings(None)
+                set_current_shop(None)
+
+        with patch('shop_api.changes.read', read):
+            thread = threading.Thread(target=long_poll)
+            thread.start()
+            self.assertTrue(waiting.wait(5))
+            self.api.force_authenticate(Shop.objects.get(pk=2).owner)
+            response = self.api.get(reverse('shop_api:orders-listcreate', kwargs={'shop_id': 2}))
+            answered.set()
+            thread.join(5)
+
+        self.assertEqual(response.status_code, 200)
+        self.assertNotIn('wait;', response['Server-Timing'])
+        self.assertEqual(state['events'], ['event'])
+        self.assertEqual(state['shop'], shop)
+        self.assertEqual(state['timings'].query_count, 0)
+        self.assertIn('wait', state['timings'].spans)
+
+
+class ShopDataGenerationTests(TestCase):
+
+    fixtures = ['users', 'shops', 'products']
+
+    def test_generated_rows_are_consistent(self):
+        call_command('generate_shop_data', '--users', '5', '--shops', '3', '--products', '10', '--orders', '40',
+                     '--seed', '7', '--transaction-size', '25', stdout=StringIO())
+
+        shops = Shop.objects.filter(name__startswith='Generated Shop')
+        orders = Order.objects.filter(shop__in=shops).prefetch_related('line_items')
+        self.assertEqual(User.objects.filter(username__startswith='generated_user_').count(), 5)
+        self.assertEqual(shops.count(), 3)
+        self.assertEqual(Product.objects.filter(shop__in=shops).count(), 10)
+        self.assertEqual(len(orders), 40)
+
+        for order in orders:
+            self.assertTrue(order.line_items.all())
+            self.assertEqual(order.total, sum(item.price * item.quantity for item in order.line_items.all()))
+
+        # The sequences were moved past the generated ids
+        self.assertGreater(Order.objects.create(shop=shops[0], client_id=1).pk, max(order.pk for order in orders))
+
+
+# Attempts of failing_task by key
+task_attempts = {}
+
+
+def failing_task(key, failures):
+    task_attempts[key] = task_attempts.get(key, 0) + 1
+    if task_attempts[key] <= failures:
+        raise ValueError('Attempt %d of %s failed' % (task_attempts[key], key))
+
+
+class TaskQueueTests(TransactionTestCase):
+    """
+    The views queue their tasks once their transaction committed, which only happens outside of TestCase.
+    The rows are created rather than loaded from the fixtures, the flush between the tests leaves the search index.
+    """
+
+    def setUp(self):
+        get_catalog_cache().clear()
+        task_attempts.clear()
+        self.owner = User.objects.create_user('export-owner')
+        self.shop = Shop.objects.create(name='Export shop', owner=self.owner)
+        self.product = Product.objects.create(shop=self.shop, name='Exported product', price=Decimal('2.50'))
+
+    def work(self):
+        return Worker(burst=True).run()
+
+    def outcomes(self, outcome):
+        return REGISTRY.get_sample_value('shop_api_tasks_total', {
+            'task': 'shop_api.tests.failing_task', 'outcome': outcome
+        }) or 0
+
+    @override_settings(SHOP_API_TASK_BACKOFF=0)
+    def test_failed_attempts_are_retried(self):
+        done, failed = self.outcomes('done'), self.outcomes('failed')
+        task = enqueue('shop_api.tests.failing_task', {'key': 'flaky', 'failures': 2}, dedup_key='flaky')
+        self.assertEqual(enqueue('shop_api.tests.failing_task', {'key': 'flaky', 'failures': 0}, dedup_key='flaky'),
+                         task)
+        hopeless = enqueue('shop_api.tests.failing_task', {'key': 'hopeless', 'failures': 9}, max_attempts=2)
+
+        self.assertEqual(self.work(), 5)
+        task.refresh_from_db()
+        self.assertEqual((task.status, task.attempts, task.dedup_key), (Task.DONE, 3, None))
+        hopeless.refresh_from_db()
+        self.assertEqual((hopeless.status, hopeless.attempts), (Task.FAILED, 2))
+        self.assertIn('Attempt 2 of hopeless failed', hopeless.last_error)
+        self.assertEqual((self.outcomes('done') - done, self.outcomes('failed') - failed), (1, 1))
+
+        # The key is free again once the task started
+        self.assertNotEqual(enqueue('shop_api.tests.failing_task', {'key': 'flaky', 'failures': 0},
+                                    dedup_key='flaky'), task)
+
+    def test_retries_back_off_and_expired_leases_are_taken_over(self):
+        task = enqueue('shop_api.tests.failing_task', {'key': 'slow', 'failures': 1})
+        self.assertEqual(self.work(), 1)
+        task.refresh_from_db()
+        self.assertEqual(task.status, Task.PENDING)
+        self.assertGreater(task.run_at, timezone.now())
+
+        # The worker of the second attempt died
+        Task.objects.filter(pk=task.pk).update(status=Task.RUNNING, attempts=2,
+                                               locked_until=timezone.now() - datetime.timedelta(seconds=1))
+        self.assertEqual(self.work(), 1)
+        task.refresh_from_db()
+        self.assertEqual((task.status, task.attempts), (Task.DONE, 3))
+
+    def test_exports_are_written_by_the_workers(self):
+        api = APIClient()
+        api.force_authenticate(self.owner)
+        api.post(reverse('shop_api:orders-listcreate', kwargs={'shop_id': self.shop.pk}), {
+            'line_items': [{'product': self.product.pk, 'quantity': 2}]
+        }, format='json')
+        url = reverse('shop_api:orders-export', kwargs={'shop_id': self.shop.pk})
+        streamed = b''.join(api.get(url, {'output': 'csv'}).streaming_content)
+        self.assertEqual(len(streamed.splitlines()), 2)
+
+        with tempfile.TemporaryDirectory() as directory, override_settings(SHOP_API_EXPORT_DIR=directory):
+            response = api.post(url, {'output': 'csv'}, format='json')
+            self.assertEqual(response.status_code, 202)
+            self.assertEqual(response.data['status'], OrderExport.PENDING)
+            self.assertEqual(api.post(url, {'output': 'csv'}, format='json').data['id'], response.data['id'])
+            self.assertEqual(api.get(response['Location']).status_code, 202)
+
+            self.assertEqual(self.work(), 1)
+            download = api.get(response['Location'])
+            self.assertEqual(download.status_code, 200)
+            self.assertEqual(b''.join(download.streaming_content), streamed)
+
+            OrderExport.objects.get(pk=response.data['id']).delete()
+            self.assertEqual(os.listdir(directory), [])
+
+            api.force_authenticate(User.objects.create_user('client'))
+            self.assertEqual(api.post(url, {'output': 'csv'}, format='json').status_code, 403)
+
+
+class LoadBenchmarkTests(TransactionTestCase):
+    """
+    The benchmark threads use connections of their own. The rows are created rather than loaded from the fixtures,
+    the flush between the tests leaves the search index.
+    """
+
+    multi_db = True
+
+    def setUp(self):
+        get_catalog_cache().clear()
+        owner = User.objects.create_user('benchmark-owner')
+        # Editing products takes the model permissions on top of owning the shop
+        owner.user_permissions.set(Permission.objects.filter(codename__in=['change_product', 'delete_product']))
+        User.objects.create_user('benchmark-staff', is_staff=True)
+        shop = Shop.objects.create(name='Benchmark shop', owner=owner)
+        for index in range(3):
+            Product.objects.create(shop=shop, name='Benchmark product %d' % index, price=2, stock=1000)
+        Order.objects.create(shop=shop, client=User.objects.create_user('benchmark-buyer'))
+
+    def test_scenarios_cover_the_routes(self):
+        data = BenchmarkData(random.Random(0))
+        users = set(owner for _, owner in data.shops) | set(data.buyer_ids) | set(data.staff_ids)
+        sessions = dict((user_id, create_session(user_id)) for user_id in users)
+        benchmark = Benchmark(InProcessClient(), data, [], sessions)
+
+        samples = []
+        rng = random.Random(0)
+        for name in sorted(SCENARIOS):
+            benchmark.mix = [(name, 1)]
+            for _ in range(5):
+                benchmark.run_scenario(rng, samples)
+
+        statuses = dict((sample.route, sample.status) for sample in samples)
+        self.assertEqual([route for route, status in statuses.items() if status >= 400], [])
+        for route in ['orders-export GET', 'orders-export POST', 'orders-exports-detail GET', 'orders-changes GET',
+                      'orders-rud DELETE', 'shops-listcreate POST', 'shops-rud PATCH', 'shops-rud DELETE',
+                      'products-listcreate POST', 'products-rud PATCH', 'products-rud DELETE', 'products-search GET',
+                      'shops-analytics GET', 'cache-stats GET']:
+            self.assertIn(route, statuses)
+
+    def test_command_writes_a_report(self):
+        with tempfile.TemporaryDirectory() as directory:
+            output = os.path.join(directory, 'results.json')
+            call_command('benchmark_api', '--duration', '0.2', '--warmup', '0', '--output', output,
+                         '--mix', 'browse', stdout=StringIO())
+            with open(output) as f:
+                report = json.load(f)
+
+        self.assertEqual(report['meta']['mode'], 'inprocess')
+        self.assertEqual(report['meta']['mix'], 'browse')
+        total = report['results']['total']
+        self.assertGreater(total['requests'], 0)
+        self.assertEqual(total['errors'], 0)
+        self.assertEqual(set(total), {'requests', 'errors', 'client_errors', 'throughput', 'latency_ms', 'queries'})
+        self.assertEqual(set(total['latency_ms']), {'mean', 'p50', 'p95', 'p99', 'max'})
+        self.assertEqual(set(total['queries']), {'mean', 'max'})
+        self.assertIn('shops-listcreate GET', report['results']['routes'])
+        self.assertGreater(report['results']['routes']['shops-listcreate GET']['queries']['mean'], 0)
@@ -8,9 +8,18 @@ urlpatterns = [
     url(r'shops/$', views.ShopAPIView.as_view(), name='shops-listcreate'),
     url(r'shops/(?P<pk>\d+)/$', views.ShopRUDView.as_view(), name='shops-rud'),
     url(r'shops/(?P<shop_id>\d+)/products/$', views.ProductAPIView.as_view(), name='products-listcreate'),
+    url(r'shops/(?P<shop_id>\d+)/products/import/$', views.ProductImportView.as_view(), name='products-import'),
     url(r'shops/(?P<shop_id>\d+)/products/(?P<pk>\d+)/$', views.ProductRUDView.as_view(), name='products-rud'),
     url(r'shops/(?P<shop_id>\d+)/orders/$', views.OrderAPIView.as_view(), name='orders-listcreate'),
+    url(r'shops/(?P<shop_id>\d+)/orders/export/$', views.OrderExportView.as_view(), name='orders-export'),
+    url(r'shops/(?P<shop_id>\d+)/orders/exports/(?P<pk>\d+)/$', views.OrderExportDetailView.as_view(), name='orders-exports-detail'),
+    url(r'shops/(?P<shop_id>\d+)/orders/changes/$', views.OrderChangesView.as_view(), name='orders-changes'),
     url(r'shops/(?P<shop_id>\d+)/orders/(?P<pk>\d+)/$', views.OrderRUDView.as_view(), name='orders-rud'),
     url(r'shops/(?P<shop_id>\d+)/orders/(?P<order_id>\d+)/lineitems/$', views.LineItemAPIView.as_view(), name='lineitems-listcreate'),
     url(r'shops/(?P<shop_id>\d+)/orders/(?P<order_id>\d+)/lineitems/(?P<pk>\d+)/$', views.LineItemRUDView.as_view(), name='lineitems-rud'),
+    url(r'^products/search/$', views.ProductSearchView.as_view(), name='products-search'),
+    url(r'shops/(?P<shop_id>\d+)/analytics/$', views.ShopAnalyticsView.as_view(), name='shops-analytics'),
+    url(r'^auth/token/$', views.TokenView.as_view(), name='auth-token'),
+    url(r'cache/stats/$', views.CatalogCacheStatsView.as_view(), name='cache-stats'),
+    url(r'^metrics$', views.MetricsView.as_view(), name='metrics'),
 ]
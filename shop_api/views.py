@@ -1,15 +1,42 @@
-from rest_framework import generics, permissions
-from shop_api import serializers
-from shop_api.models import Shop, Order, Product, LineItem
-from shop_api.permissions import IsResourceOwnerOrReadOnly, IsShopOwnerOrReadOnly, IsOrderOwnerOrShopOwnerReadOnly
-
-
-class ShopAPIView(generics.ListCreateAPIView):
+import datetime
+import math
+
+from django.db import transaction
+from django.db.models import Count, Max, Sum
+from django.http import FileResponse, Http404, HttpResponse, StreamingHttpResponse
+from django.utils import timezone
+from django.utils.dateparse import parse_date
+from rest_framework import generics, permissions, status, views
+from rest_framework.exceptions import NotAuthenticated, ParseError, UnsupportedMediaType, ValidationError
+from prometheus_client import CONTENT_TYPE_LATEST
+from rest_framework.response import Response
+from shop_api import analytics, archive, changes, inventory, metrics, serializers, sharding, tasks
+from shop_api.authentication import SignedTokenAuthentication, get_revocation_list, issue_token
+from shop_api.instrumentation import InstrumentedViewMixin
+from shop_api.conditional import ConditionalGetMixin, timestamp_validators
+from shop_api.cache import CachedReadMixin, get_catalog_cache, shop_list_namespace, shop_namespace, \
+    product_list_namespace, product_namespace
+from shop_api.exports import EXPORT_FORMATS, export_path, iter_order_chunks
+from shop_api.imports import IMPORT_FORMATS, CatalogImport, InvalidUpload
+from shop_api.fastpath import FastListMixin, ProductValuesSerializer, OrderValuesSerializer, LineItemValuesSerializer
+from shop_api.models import Shop, Order, Product, LineItem, OrderExport
+from shop_api.pagination import KeysetOrLimitOffsetPagination
+from shop_api.resolvers import resolve_shop, resolve_order
+from shop_api.search import SearchMixin
+from shop_api.sparse import SparseQuerysetMixin
+from shop_api.permissions import IsResourceOwnerOrReadOnly, IsShopOwnerOrReadOnly, IsOrderOwnerOrShopOwnerReadOnly, \
+    IsShopOwner
+
+
+class ShopAPIView(InstrumentedViewMixin, ConditionalGetMixin, CachedReadMixin, SparseQuerysetMixin,
+                  generics.ListCreateAPIView):
     """
     API view for listing and creating shops
 
     get:
-    Returns a list of all the available shops
+    Returns a list of all the available shops.
+    Every shop lists the ids of its first products, pass `expand=products` to embed the products instead.
+    Pass `fields` (e.g. `fields=id,name`) to only receive some of the fields, this works on every route.
 
     post:
     Creates a new shop with the authenticated user as the owner.
@@ -19,13 +46,22 @@ class ShopAPIView(generics.ListCreateAPIView):
     permission_classes = [permissions.IsAuthenticatedOrReadOnly]
 
     def get_queryset(self):
-        return Shop.objects.all()
+        # The serializer reads a capped list of product ids per shop
+        return Shop.objects.order_by('pk')
+
+    def get_cache_namespace(self):
+        return shop_list_namespace()
+
+    def get_validators(self):
+        shops = Shop.objects.aggregate(count=Count('id'), versions=Sum('version'), last_modified=Max('updated_at'))
+        return '%(count)s-%(versions)s-%(last_modified)s' % shops, shops['last_modified']
 
     def perform_create(self, serializer):
         serializer.save(owner=self.request.user)
 
 
-class ShopRUDView(generics.RetrieveUpdateDestroyAPIView):
+class ShopRUDView(InstrumentedViewMixin, ConditionalGetMixin, CachedReadMixin, SparseQuerysetMixin,
+                  generics.RetrieveUpdateDestroyAPIView):
     """
     API view for retrieving, updating and destroying shops
 
@@ -54,15 +90,25 @@ class ShopRUDView(generics.RetrieveUpdateDestroyAPIView):
     permission_classes = [IsResourceOwnerOrReadOnly]
 
     def get_queryset(self):
+        # The serializer reads a capped list of product ids per shop
         return Shop.objects.all()
 
+    def get_cache_namespace(self):
+        return shop_namespace(self.kwargs.get('pk'))
+
+    def get_validators(self):
+        return Shop.objects.filter(pk=self.kwargs.get('pk')).values_list('version', 'updated_at').first()
 
-class ProductAPIView(generics.ListCreateAPIView):
+
+class ProductAPIView(InstrumentedViewMixin, ConditionalGetMixin, CachedReadMixin, SearchMixin, FastListMixin,
+                     SparseQuerysetMixin, generics.ListCreateAPIView):
     """
     API view for listing and creating products belonging to a shop
 
     get:
-    Returns a list of all the available products for the shop with id=shop_id
+    Returns a list of all the available products for the shop with id=shop_id.
+    Pass `q` to only list the products whose name or description contain every word of the query, best match first.
+    Words ending with `*` match as prefixes, e.g. `q=blue shi*`. Search results are paginated with `limit` and `offset`.
 
     post:
     Creates a new product for the shop with id=shop_id.
@@ -70,20 +116,85 @@ class ProductAPIView(generics.ListCreateAPIView):
     """
 
     serializer_class = serializers.ProductSerializer
+    values_serializer_class = ProductValuesSerializer
+    pagination_class = KeysetOrLimitOffsetPagination
     permission_classes = [IsShopOwnerOrReadOnly]
 
     def get_queryset(self):
         shop_id = self.kwargs.get('shop_id')
-        shop_object = Shop.objects.get(pk=shop_id)
+        shop_object = resolve_shop(self.request, shop_id)
         return shop_object.products.all()
 
+    def get_cache_namespace(self):
+        return product_list_namespace(self.kwargs.get('shop_id'))
+
+    def get_validators(self):
+        shop_object = resolve_shop(self.request, self.kwargs.get('shop_id'))
+        return shop_object.version, shop_object.updated_at
+
     def perform_create(self, serializer):
         shop_id = self.kwargs.get('shop_id')
-        shop_object = Shop.objects.get(pk=shop_id)
+        shop_object = resolve_shop(self.request, shop_id)
         serializer.save(shop=shop_object)
 
 
-class ProductRUDView(generics.RetrieveUpdateDestroyAPIView):
+class ProductSearchView(InstrumentedViewMixin, SearchMixin, generics.ListAPIView):
+    """
+    API view searching the products of every shop
+
+    get:
+    Returns the products of any shop whose name or description contain every word of `q`, best match first.
+    Words ending with `*` match as prefixes. Results are paginated with `limit` and `offset`.
+    """
+
+    serializer_class = serializers.ProductSerializer
+    queryset = Product.objects.all()
+    search_required = True
+
+    def get_search_shop_id(self):
+        return None
+
+
+class ProductImportView(InstrumentedViewMixin, views.APIView):
+    """
+    API view importing products in bulk
+
+    post:
+    Creates or updates the products of the shop with id=shop_id from the request body, one product per row.
+    Send `Content-Type: text/csv` with a header row, or `Content-Type: application/x-ndjson` with one JSON object
+    per line. Rows have a `name` and a `price`, optionally a `description` and a `stock`. Products are matched by name,
+    rows naming a product of another shop fail. Returns the number of rows created, updated, superseded by a later row
+    naming the same product and failed, along with the errors of the first 1000 failed rows numbered from 1.
+    The authenticated user must be the shop owner to perform this action.
+    """
+
+    permission_classes = [permissions.IsAuthenticated, IsShopOwner]
+    batch_size = 500
+    max_errors = 1000
+
+    def post(self, request, shop_id):
+        content_type = request.content_type.split(';')[0].strip()
+        if content_type not in IMPORT_FORMATS:
+            raise UnsupportedMediaType(content_type)
+
+        # The body is read as a stream, request.data would load all of it
+        stream = request.stream
+        if stream is None:
+            raise ParseError('The upload is empty.')
+
+        importer = CatalogImport(shop_id, batch_size=self.batch_size, max_errors=self.max_errors)
+        try:
+            report = importer.run(IMPORT_FORMATS[content_type](stream))
+        except InvalidUpload as e:
+            raise ParseError(str(e))
+        except UnicodeDecodeError:
+            raise ParseError('The upload must be encoded in UTF-8.')
+
+        return Response(report)
+
+
+class ProductRUDView(InstrumentedViewMixin, ConditionalGetMixin, CachedReadMixin, SparseQuerysetMixin,
+                     generics.RetrieveUpdateDestroyAPIView):
     """
     API view for retrieving, updating and destroying products belonging to a shop
 
@@ -113,11 +224,18 @@ class ProductRUDView(generics.RetrieveUpdateDestroyAPIView):
         if shop_id is None:
             return Product.objects.none()
 
-        shop_object = Shop.objects.get(pk=shop_id)
+        shop_object = resolve_shop(self.request, shop_id)
         return shop_object.products.all()
 
+    def get_cache_namespace(self):
+        return product_namespace(self.kwargs.get('pk'))
 
-class OrderAPIView(generics.ListCreateAPIView):
+    def get_validators(self):
+        product = Product.objects.filter(pk=self.kwargs.get('pk'), shop_id=self.kwargs.get('shop_id'))
+        return timestamp_validators(product.values_list('updated_at', flat=True).first())
+
+
+class OrderAPIView(InstrumentedViewMixin, FastListMixin, SparseQuerysetMixin, generics.ListCreateAPIView):
     """
     API view for listing and creating orders belonging to a shop
 
@@ -126,10 +244,14 @@ class OrderAPIView(generics.ListCreateAPIView):
 
     post:
     Creates a new order for the shop with id=shop_id.
+    The order's line items may be submitted along with it as a `line_items` list of products and quantities,
+    they are all created in the same transaction and the order total is computed once.
     The authenticated user will be the owner of the order that's created
     """
 
     serializer_class = serializers.OrderSerializer
+    values_serializer_class = OrderValuesSerializer
+    pagination_class = KeysetOrLimitOffsetPagination
     permission_classes = [permissions.IsAuthenticatedOrReadOnly]
 
     def get_queryset(self):
@@ -137,24 +259,163 @@ class OrderAPIView(generics.ListCreateAPIView):
         if shop_id is None:
             return Order.objects.none()
 
-        shop_object = Shop.objects.get(pk=shop_id)
-        return shop_object.orders.all()
+        shop_object = resolve_shop(self.request, shop_id)
+        orders = shop_object.orders.all()
+        if self.wants_field('line_items'):
+            orders = orders.prefetch_related('line_items')
+        return orders
 
     def perform_create(self, serializer):
         shop_id = self.kwargs.get('shop_id')
-        shop_object = Shop.objects.get(pk=shop_id)
-        serializer.save(shop=shop_object, client=self.request.user)
+        shop_object = resolve_shop(self.request, shop_id)
+
+        # The serializer reserves the stock last
+        with sharding.atomic(shop_object):
+            serializer.save(shop=shop_object, client=self.request.user)
+
+
+class OrderChangesView(InstrumentedViewMixin, views.APIView):
+    """
+    API view serving the change feed of the orders of a shop
+
+    get:
+    Returns the changes to the orders and line items of the shop with id=shop_id made after the cursor `after`
+    (0, the start of the feed, by default), at most `limit` (default 100) events in the order they were made.
+    Events carry the order or line item as it is after the change. Pass the returned `cursor` as `after` to read
+    the next changes, and `wait` (seconds, at most 30) to wait for changes when there are none yet.
+    Cursors older than the retention of the feed get a 410 along with the cursor to resume from, once the orders
+    were listed again.
+    The authenticated user must be the shop owner to perform this action.
+    """
+
+    permission_classes = [permissions.IsAuthenticated, IsShopOwner]
+    default_limit = 100
+    max_limit = 1000
+    max_wait = 30
+
+    def get_number(self, name, default, parse=int):
+        try:
+            value = parse(self.request.query_params.get(name, default))
+        except ValueError:
+            value = None
+        # float() reads nan and inf, which would never reach the deadline of a wait
+        if value is None or not math.isfinite(value):
+            raise ValidationError({name: 'A valid number is required.'})
+        return max(value, 0)
+
+    def get(self, request, shop_id):
+        shop_object = resolve_shop(request, shop_id)
+        after = self.get_number('after', 0)
+        limit = min(self.get_number('limit', self.default_limit), self.max_limit)
+        wait = min(self.get_number('wait', 0, parse=float), self.max_wait)
+
+        events = changes.wait_for(shop_object, after, limit, wait)
+        cursor = events[-1].pk if events else after
+        return Response(serializers.ChangeFeedSerializer({'events': events, 'cursor': cursor}).data)
+
+
+class OrderExportView(InstrumentedViewMixin, views.APIView):
+    """
+    API view exporting the full order history of a shop
+
+    get:
+    Streams every order of the shop with id=shop_id along with its line items, archived orders included.
+    Use `output=ndjson` (default) for one JSON document per order, or `output=csv` for one row per line item.
+    Pass `since_id` to only export the orders created after the order with that id.
+    The authenticated user must be the shop owner to perform this action.
 
+    post:
+    Queues the same export, taking the same `output` and `since_id` options, to be written to a file by the workers
+    rather than streamed by the request. Returns 202 with the export, whose `url` serves the file once ready.
+    An export with the same options still waiting is returned instead of queueing another one.
+    The authenticated user must be the shop owner to perform this action.
+    """
+
+    permission_classes = [permissions.IsAuthenticated, IsShopOwner]
+    chunk_size = 500
+
+    def get_options(self, params):
+        output = params.get('output', 'ndjson')
+        if output not in EXPORT_FORMATS:
+            raise ValidationError({'output': 'Must be one of: %s' % ', '.join(sorted(EXPORT_FORMATS))})
+
+        try:
+            since_id = int(params.get('since_id', 0))
+        except (TypeError, ValueError):
+            raise ValidationError({'since_id': 'A valid integer is required.'})
+
+        return output, since_id
+
+    def get(self, request, shop_id):
+        output, since_id = self.get_options(request.query_params)
 
-class OrderRUDView(generics.RetrieveDestroyAPIView):
+        render_rows, content_type = EXPORT_FORMATS[output]
+        # The rows are read while the response streams, once the request no longer routes the queries
+        shard = resolve_shop(request, shop_id).shard
+        chunks = iter_order_chunks(shop_id, since_id=since_id, chunk_size=self.chunk_size, using=shard)
+
+        response = StreamingHttpResponse(render_rows(chunks), content_type=content_type)
+        response['Content-Disposition'] = 'attachment; filename="shop-%s-orders.%s"' % (shop_id, output)
+        return response
+
+    def post(self, request, shop_id):
+        output, since_id = self.get_options(request.data)
+        shop_object = resolve_shop(request, shop_id)
+
+        with transaction.atomic():
+            export = OrderExport.objects.filter(
+                shop=shop_object, output=output, since_id=since_id, status=OrderExport.PENDING
+            ).first()
+            if export is None:
+                export = OrderExport.objects.create(shop=shop_object, output=output, since_id=since_id)
+                tasks.enqueue_on_commit('shop_api.exports.write_export', {'export_id': export.pk},
+                                        dedup_key='export:%d' % export.pk)
+
+        data = serializers.OrderExportSerializer(export, context={'request': request}).data
+        return Response(data, status=status.HTTP_202_ACCEPTED, headers={'Location': data['url']})
+
+
+class OrderExportDetailView(InstrumentedViewMixin, views.APIView):
+    """
+    API view serving an order export queued with a POST to the export endpoint
+
+    get:
+    Returns the file of the export with id=pk of the shop with id=shop_id once it is ready. Until then returns the
+    export with a 202 while it is pending, or with the error of its last attempt once it failed, failed exports are
+    retried. Exports are kept for at least a day.
+    The authenticated user must be the shop owner to perform this action.
+    """
+
+    permission_classes = [permissions.IsAuthenticated, IsShopOwner]
+
+    def get(self, request, shop_id, pk):
+        export = OrderExport.objects.filter(shop_id=shop_id, pk=pk).first()
+        if export is None:
+            raise Http404('No export matches the given query.')
+
+        if export.status == OrderExport.READY:
+            try:
+                file = open(export_path(export), 'rb')
+            except FileNotFoundError:
+                raise Http404('The file of this export was deleted.')
+
+            return FileResponse(file, as_attachment=True, content_type=EXPORT_FORMATS[export.output][1],
+                                filename='shop-%d-orders.%s' % (export.shop_id, export.output))
+
+        data = serializers.OrderExportSerializer(export, context={'request': request}).data
+        return Response(data, status=status.HTTP_202_ACCEPTED if export.status == OrderExport.PENDING else 200)
+
+
+class OrderRUDView(InstrumentedViewMixin, ConditionalGetMixin, SparseQuerysetMixin,
+                   generics.RetrieveDestroyAPIView):
     """
     API view for retrieving, updating and destroying orders belonging to a shop.
 
     get:
-    Returns the detail for the order with the provided id.
+    Returns the detail for the order with the provided id, archived orders included.
 
     delete:
-    Deletes the order with the provided id.
+    Deletes the order with the provided id, archived orders can't be deleted.
     The authenticated user must be the order owner to perform this operation.
     """
 
@@ -167,11 +428,50 @@ class OrderRUDView(generics.RetrieveDestroyAPIView):
         if shop_id is None:
             return Order.objects.none()
 
-        shop_object = Shop.objects.get(pk=shop_id)
-        return shop_object.orders.all()
+        shop_object = resolve_shop(self.request, shop_id)
+        orders = shop_object.orders.all()
+        if self.wants_field('line_items'):
+            orders = orders.prefetch_related('line_items')
+        return orders
+
+    def get_object(self):
+        try:
+            return super(OrderRUDView, self).get_object()
+        except Http404:
+            if self.request.method not in permissions.SAFE_METHODS:
+                raise
+
+            shop_object = resolve_shop(self.request, self.kwargs.get('shop_id'))
+            order = archive.archived_order(shop_object, self.kwargs.get('pk'))
+            if order is None:
+                raise
+
+            self.check_object_permissions(self.request, order)
+            return order
+
+    def get_validators(self):
+        # The orders are on the shard of the shop
+        shop_object = resolve_shop(self.request, self.kwargs.get('shop_id'))
+        updated_at = shop_object.orders.filter(pk=self.kwargs.get('pk')).values_list('updated_at', flat=True).first()
+        if updated_at is None:
+            # Archived orders only change when they are archived
+            updated_at = shop_object.archived_orders.filter(pk=self.kwargs.get('pk')) \
+                .values_list('archived_at', flat=True).first()
+        return timestamp_validators(updated_at)
 
+    def perform_destroy(self, instance):
+        with sharding.atomic(resolve_shop(self.request, self.kwargs.get('shop_id'))):
+            line_items = list(instance.line_items.all())
+            order_id = instance.pk
+            deleted, _ = instance.delete()
 
-class LineItemAPIView(generics.ListCreateAPIView):
+            if deleted:
+                analytics.order_removed(instance, line_items)
+                changes.order_removed(instance, order_id)
+                inventory.release(inventory.quantities(line_items), instance.shop_id)
+
+
+class LineItemAPIView(InstrumentedViewMixin, FastListMixin, SparseQuerysetMixin, generics.ListCreateAPIView):
     """
     API view for listing and creating line items belonging to an order
 
@@ -180,11 +480,14 @@ class LineItemAPIView(generics.ListCreateAPIView):
     The authenticated user must be order owner or shop owner to perform this action.
 
     post:
-    Creates a new line item for the order with id=order_id.
+    Creates a new line item for the order with id=order_id, taking its quantity out of the product's stock.
+    Fails with 409 when the product doesn't have enough stock left.
     The authenticated user must be order owner to perform this action.
     """
 
     serializer_class = serializers.LineItemSerializer
+    values_serializer_class = LineItemValuesSerializer
+    pagination_class = KeysetOrLimitOffsetPagination
     permission_classes = [IsOrderOwnerOrShopOwnerReadOnly]
 
     def get_queryset(self):
@@ -192,21 +495,24 @@ class LineItemAPIView(generics.ListCreateAPIView):
         if order_id is None:
             return LineItem.objects.none()
 
-        order_object = Order.objects.get(pk=order_id)
+        order_object = resolve_order(self.request, self.kwargs.get('shop_id'), order_id)
         return order_object.line_items.all()
 
     def perform_create(self, serializer):
         order_id = self.kwargs.get('order_id')
-        order_object = Order.objects.get(pk=order_id)
+        order_object = resolve_order(self.request, self.kwargs.get('shop_id'), order_id)
 
         product_object = serializer.validated_data.get('product')
-        serializer.save(order=order_object, price=product_object.price)
 
-        order_object.update_total()
-        order_object.save()
+        with sharding.atomic(order_object.shop):
+            line_item = serializer.save(order=order_object, price=product_object.price)
+            order_object.adjust_total(line_item.subtotal)
+            analytics.line_item_added(line_item)
+            changes.line_item_added(line_item, order_object)
+            inventory.reserve({line_item.product_id: line_item.quantity}, order_object.shop_id)
 
 
-class LineItemRUDView(generics.RetrieveUpdateDestroyAPIView):
+class LineItemRUDView(InstrumentedViewMixin, SparseQuerysetMixin, generics.RetrieveUpdateDestroyAPIView):
     """
     API view for retrieving, updating and destroying line items belonging to an order.
 
@@ -237,20 +543,141 @@ class LineItemRUDView(generics.RetrieveUpdateDestroyAPIView):
         if order_id is None:
             return LineItem.objects.none()
 
-        order_object = Order.objects.get(pk=order_id)
+        order_object = resolve_order(self.request, self.kwargs.get('shop_id'), order_id)
         return order_object.line_items.all()
 
     def perform_update(self, serializer):
-        order_id = self.kwargs.get('order_id')
-        order = Order.objects.get(pk=order_id)
-        serializer.save()
-
-        order.update_total()
-        order.save()
+        with sharding.atomic(resolve_shop(self.request, self.kwargs.get('shop_id'))):
+            # Lock the line item so that the quantity we diff against can't change under us
+            previous = LineItem.objects.select_for_update().get(pk=serializer.instance.pk)
+            line_item = serializer.save()
+            line_item.order.adjust_total(line_item.subtotal - previous.subtotal)
+            analytics.line_item_changed(line_item, previous)
+            changes.line_item_changed(line_item, line_item.order)
+
+            shop_id = line_item.order.shop_id
+            if line_item.quantity > previous.quantity:
+                inventory.reserve({line_item.product_id: line_item.quantity - previous.quantity}, shop_id)
+            else:
+                inventory.release({line_item.product_id: previous.quantity - line_item.quantity}, shop_id)
 
     def perform_destroy(self, instance):
-        order = instance.order
-        instance.delete()
+        with sharding.atomic(resolve_shop(self.request, self.kwargs.get('shop_id'))):
+            order = instance.order
+            line_item_id = instance.pk
+            deleted, _ = instance.delete()
+
+            # A concurrent request may have removed the row first, it already took care of the total
+            if deleted:
+                order.adjust_total(-instance.subtotal)
+                analytics.line_item_removed(instance)
+                changes.line_item_removed(line_item_id, order)
+                inventory.release({instance.product_id: instance.quantity}, order.shop_id)
+
+
+class ShopAnalyticsView(InstrumentedViewMixin, views.APIView):
+    """
+    API view reporting the sales of a shop
+
+    get:
+    Returns the revenue, units sold and orders of the shop with id=shop_id for every day between `start` and `end`
+    (ISO dates, both included, defaulting to the last 30 days), along with the `top` (default 10) best selling products
+    of the period. Sales are counted on the day their order was placed.
+    The authenticated user must be the shop owner to perform this action.
+    """
+
+    permission_classes = [permissions.IsAuthenticated, IsShopOwner]
+    default_days = 30
+    max_top = 100
+
+    def get_date(self, name, default):
+        value = self.request.query_params.get(name)
+        if value is None:
+            return default
+
+        try:
+            date = parse_date(value)
+        except ValueError:
+            date = None
+        if date is None:
+            raise ValidationError({name: 'A valid date (YYYY-MM-DD) is required.'})
+        return date
+
+    def get(self, request, shop_id):
+        end = self.get_date('end', timezone.localdate())
+        start = self.get_date('start', end - datetime.timedelta(days=self.default_days - 1))
+        if start > end:
+            raise ValidationError({'start': 'Must not be after end.'})
+
+        try:
+            top = min(int(request.query_params.get('top', 10)), self.max_top)
+        except ValueError:
+            raise ValidationError({'top': 'A valid integer is required.'})
+
+        report = analytics.sales_report(int(shop_id), start, end, top=max(top, 0))
+        return Response(serializers.SalesReportSerializer(report).data)
+
+
+class TokenView(InstrumentedViewMixin, views.APIView):
+    """
+    API view issuing and revoking signed tokens
+
+    post:
+    Exchanges a username and password for a token expiring after SHOP_API_TOKEN_TTL seconds.
+    Requests authenticate with it by sending an `Authorization: Bearer <token>` header.
+
+    delete:
+    Revokes the token authenticating the request.
+    """
+
+    authentication_classes = [SignedTokenAuthentication]
+    permission_classes = [permissions.AllowAny]
+
+    def post(self, request):
+        serializer = serializers.TokenRequestSerializer(data=request.data, context={'request': request})
+        serializer.is_valid(raise_exception=True)
+
+        token, expires = issue_token(serializer.validated_data['user'])
+        expires = datetime.datetime.fromtimestamp(expires, timezone.utc)
+        return Response(serializers.TokenSerializer({'token': token, 'expires': expires}).data, status=201)
+
+    def delete(self, request):
+        if not isinstance(request.auth, dict):
+            raise NotAuthenticated()
+
+        get_revocation_list().revoke(request.auth)
+        return Response(status=204)
+
+
+class CatalogCacheStatsView(InstrumentedViewMixin, views.APIView):
+    """
+    API view exposing the catalog cache counters
+
+    get:
+    Returns the hit, miss and eviction counters of the catalog cache of the worker serving the request.
+    The authenticated user must be staff to perform this action.
+    """
+
+    permission_classes = [permissions.IsAdminUser]
+
+    def get(self, request):
+        return Response(get_catalog_cache().stats())
+
+
+class MetricsView(InstrumentedViewMixin, views.APIView):
+    """
+    API view serving the Prometheus metrics
+
+    get:
+    Returns the metrics of every worker of the gunicorn pool serving the request, in the Prometheus text format.
+    The authenticated user must be staff to perform this action, Prometheus scrapes with the basic auth of one.
+    """
+
+    permission_classes = [permissions.IsAdminUser]
+
+    def perform_content_negotiation(self, request, force=False):
+        # prometheus_client renders the response whatever the Accept header of the scraper
+        return super(MetricsView, self).perform_content_negotiation(request, force=True)
 
-        order.update_total()
-        order.save()
+    def get(self, request):
+        return HttpResponse(metrics.exposition(), content_type=CONTENT_TYPE_LATEST)
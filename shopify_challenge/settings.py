@@ -49,6 +49,8 @@ INSTALLED_APPS = [
 ]
 
 MIDDLEWARE = [
+    'shop_api.middleware.RequestInstrumentationMiddleware',
+    'shop_api.routers.ReplicaRoutingMiddleware',
     'django.middleware.security.SecurityMiddleware',
     'django.contrib.sessions.middleware.SessionMiddleware',
     'django.middleware.common.CommonMiddleware',
@@ -56,6 +58,7 @@ MIDDLEWARE = [
     'django.contrib.auth.middleware.AuthenticationMiddleware',
     'django.contrib.messages.middleware.MessageMiddleware',
     'django.middleware.clickjacking.XFrameOptionsMiddleware',
+    'shop_api.profiling.ProfilingMiddleware',
 ]
 
 ROOT_URLCONF = 'shopify_challenge.urls'
@@ -81,12 +84,179 @@ WSGI_APPLICATION = 'shopify_challenge.wsgi.application'
 
 # Database
 # https://docs.djangoproject.com/en/2.0/ref/settings/#databases
+#
+# API_DATABASE=mysql uses the MySQL server of kubernetes/services/mysqldb.yaml as the primary, SQLite is used otherwise.
+# API_DATABASE_REPLICAS lists the read replicas, comma separated: MySQL hosts, or SQLite files which
+# `python manage.py sync_sqlite_replicas` copies the primary to when developing locally.
+# API_DATABASE_SHARDS lists the other databases the orders and line items of shops may be moved to, see
+# shop_api.sharding. Locally an SQLite file stands in for a second shard.
+
+database_engine = os.environ.get('API_DATABASE', 'sqlite')
+
+# Seconds a connection is reused for, across requests
+database_max_age = int(os.environ.get('API_DATABASE_CONN_MAX_AGE', 600))
+
+
+def database(location):
+    if database_engine == 'mysql':
+        return {
+            'ENGINE': 'django.db.backends.mysql',
+            'HOST': location,
+            'PORT': os.environ.get('API_DATABASE_PORT', '3306'),
+            'NAME': os.environ.get('API_DATABASE_NAME', 'shop_api'),
+            'USER': os.environ.get('API_DATABASE_USER', 'root'),
+            'PASSWORD': os.environ.get('API_DATABASE_PASSWORD', ''),
+            'CONN_MAX_AGE': database_max_age,
+            'OPTIONS': {'charset': 'utf8mb4'},
+        }
+
+    return {
+        'ENGINE': 'django.db.backends.sqlite3',
+        'NAME': os.path.join(BASE_DIR, location),
+        'CONN_MAX_AGE': database_max_age,
+        # Seconds a writer waits for the others, the gunicorn workers and the management commands share the files
+        'OPTIONS': {'timeout': 20},
+    }
+
 
 DATABASES = {
+    'default': database(os.environ.get('API_DATABASE_HOST', 'mysql') if database_engine == 'mysql' else 'db.sqlite3'),
+}
+
+SHOP_API_READ_REPLICAS = []
+for location in os.environ.get('API_DATABASE_REPLICAS', '').split(','):
+    if location.strip():
+        alias = 'replica%d' % (len(SHOP_API_READ_REPLICAS) + 1)
+        # The tests read the rows they write, the replicas are the test database
+        DATABASES[alias] = dict(database(location.strip()), TEST={'MIRROR': 'default'})
+        SHOP_API_READ_REPLICAS.append(alias)
+
+SHOP_API_SHARDS = ['default']
+shard_locations = os.environ.get('API_DATABASE_SHARDS', 'db.shard1.sqlite3' if database_engine == 'sqlite' else '')
+for location in shard_locations.split(','):
+    if location.strip():
+        alias = 'shard%d' % len(SHOP_API_SHARDS)
+        DATABASES[alias] = database(location.strip())
+        SHOP_API_SHARDS.append(alias)
+
+DATABASE_ROUTERS = ['shop_api.routers.ShardRouter', 'shop_api.routers.PrimaryReplicaRouter']
+
+# Seconds a client which wrote reads from the primary for, longer than the replication lag
+SHOP_API_REPLICA_PIN_SECONDS = 5
+
+# Cache alias remembering the users of the token clients which wrote, as they don't keep the pin cookie. The users
+# are only pinned on the pod they wrote through unless the cache is shared by every pod, e.g. memcached
+SHOP_API_REPLICA_PIN_CACHE = 'replica_pins'
+
+# Seconds a replica which can't be reached is skipped for
+SHOP_API_REPLICA_RETRY = 30
+
+# Seconds a persistent connection may be idle before it is pinged at the start of a request
+SHOP_API_DATABASE_HEALTH_CHECK = 30
+
+
+# Caches
+# https://docs.djangoproject.com/en/2.0/topics/cache/
+
+CACHES = {
     'default': {
-        'ENGINE': 'django.db.backends.sqlite3',
-        'NAME': os.path.join(BASE_DIR, 'db.sqlite3'),
+        'BACKEND': 'django.core.cache.backends.locmem.LocMemCache',
+    },
+    # Shared by all the gunicorn workers of a pod
+    'catalog': {
+        'BACKEND': 'django.core.cache.backends.filebased.FileBasedCache',
+        'LOCATION': os.path.join(BASE_DIR, '.cache', 'catalog'),
+    },
+    # Shared by all the gunicorn workers of a pod
+    'replica_pins': {
+        'BACKEND': 'django.core.cache.backends.filebased.FileBasedCache',
+        'LOCATION': os.path.join(BASE_DIR, '.cache', 'replica_pins'),
+    },
+}
+
+# Read-through cache of the shop and product endpoints.
+# The in-process LRU only sees the invalidations of its own worker, the others serve entries for up to
+# 'timeout' seconds. The shared cache makes invalidations visible to every worker.
+if environment == "production":
+    SHOP_API_CATALOG_CACHE = {
+        'BACKEND': 'shop_api.cache.SharedCache',
+        'OPTIONS': {'alias': 'catalog', 'timeout': 300},
+    }
+else:
+    SHOP_API_CATALOG_CACHE = {
+        'BACKEND': 'shop_api.cache.LRUCache',
+        'OPTIONS': {'max_entries': 10000, 'timeout': 30},
     }
+
+# Product search, SQLiteFTSBackend needs the FTS5 table created by the migrations on SQLite and
+# MySQLFullTextBackend the FULLTEXT indexes they create on MySQL. shop_api.search.DatabaseBackend works on any
+# database but scans the products.
+SHOP_API_SEARCH = {
+    'BACKEND': 'shop_api.search.%s' % ('SQLiteFTSBackend' if database_engine == 'sqlite' else 'MySQLFullTextBackend'),
+    'OPTIONS': {'max_results': 1000},
+}
+
+# Maximum number of related ids (e.g. the products of a shop) embedded in a response
+SHOP_API_RELATION_LIMIT = 1000
+
+# Serialize the product, order and line item lists straight from values() rows instead of DRF serializers
+SHOP_API_FAST_SERIALIZERS = True
+
+# Seconds the front proxy may serve anonymous catalog reads without revalidating them
+SHOP_API_MICROCACHE_SECONDS = 1
+
+
+# Requests slower than this are logged with their slowest SQL statements to the shop_api.slow_requests logger
+SHOP_API_SLOW_REQUEST_MS = int(os.environ.get('API_SLOW_REQUEST_MS', 500))
+
+# Request profiles, staff trigger them with an "X-Profile: 1" header, a fraction of all the requests can be sampled too
+SHOP_API_PROFILE_DIR = os.path.join(BASE_DIR, 'profiles')
+SHOP_API_PROFILE_SAMPLE_RATE = float(os.environ.get('API_PROFILE_SAMPLE_RATE', 0))
+SHOP_API_PROFILE_INTERVAL = 0.001
+
+# Signed tokens issued by auth/token/, users are cached in each worker for 'timeout' seconds
+# and the tokens revoked by other workers are seen after at most SHOP_API_TOKEN_REVOCATION_REFRESH seconds
+SHOP_API_TOKEN_TTL = 24 * 3600
+SHOP_API_TOKEN_USER_CACHE = {'max_entries': 1000, 'timeout': 60}
+SHOP_API_TOKEN_REVOCATION_REFRESH = 5
+
+# Orders placed this many days ago are moved to the archive by the archive_orders command
+SHOP_API_ARCHIVE_AFTER_DAYS = int(os.environ.get('API_ARCHIVE_AFTER_DAYS', 365))
+
+# Change feed of the orders. compact_order_changes drops the events superseded by a later event of the same order or
+# line item once SHOP_API_CHANGE_FEED_COMPACT_AFTER seconds old, and every event after
+# SHOP_API_CHANGE_FEED_RETENTION_DAYS days.
+SHOP_API_CHANGE_FEED_COMPACT_AFTER = 3600
+SHOP_API_CHANGE_FEED_RETENTION_DAYS = int(os.environ.get('API_CHANGE_FEED_RETENTION_DAYS', 7))
+
+# Background tasks run by the run_workers processes. A worker holds a task for SHOP_API_TASK_LEASE seconds before
+# another may take it over, failed attempts are retried after SHOP_API_TASK_BACKOFF seconds doubling with every
+# attempt up to SHOP_API_TASK_MAX_BACKOFF, finished tasks are purged after SHOP_API_TASK_RETENTION_DAYS days.
+SHOP_API_TASK_WORKERS = int(os.environ.get('API_TASK_WORKERS', 2))
+SHOP_API_TASK_LEASE = 300
+SHOP_API_TASK_BACKOFF = 10
+SHOP_API_TASK_MAX_BACKOFF = 3600
+SHOP_API_TASK_RETENTION_DAYS = 7
+
+# Order exports written by the workers, a shop's exports are deleted after SHOP_API_EXPORT_RETENTION_HOURS hours
+SHOP_API_EXPORT_DIR = os.environ.get('API_EXPORT_DIR', os.path.join(BASE_DIR, 'exports'))
+SHOP_API_EXPORT_RETENTION_HOURS = 24
+
+LOGGING = {
+    'version': 1,
+    'disable_existing_loggers': False,
+    'handlers': {
+        'console': {
+            'class': 'logging.StreamHandler',
+        },
+    },
+    'loggers': {
+        'shop_api.slow_requests': {
+            'handlers': ['console'],
+            'level': 'WARNING',
+            'propagate': False,
+        },
+    },
 }
 
 
@@ -135,5 +305,12 @@ REST_FRAMEWORK = {
     'DEFAULT_PERMISSION_CLASSES': [
         'rest_framework.permissions.DjangoModelPermissionsOrAnonReadOnly',
     ],
+    # Requests without a session cookie skip SessionAuthentication without reading the session table.
+    # It stays first so that anonymous requests are still answered with 403 rather than a Bearer challenge.
+    'DEFAULT_AUTHENTICATION_CLASSES': [
+        'rest_framework.authentication.SessionAuthentication',
+        'shop_api.authentication.SignedTokenAuthentication',
+        'rest_framework.authentication.BasicAuthentication',
+    ],
     'DEFAULT_PAGINATION_CLASS': 'rest_framework.pagination.LimitOffsetPagination',
 }